@@ -5,18 +5,67 @@ import time
 import json
 from PIL import Image
 from io import BytesIO
-import streamlit as st
 import base64
+import tempfile
+import threading
+from concurrent.futures import Future
+from requests.adapters import HTTPAdapter
+from agents.image_backends import ImageBackend, ProceduralBackend, DiffusersBackend
+from utils.rate_limit import RateLimiter
+from utils.cache import DiskLRUCache, get_cache, content_hash
+from utils import tracing
 
-class KandinskyAPI:
-    def __init__(self, api_key, secret_key):
+STYLE_KEYWORDS = {
+    "Американский комикс 80-х": "80s comic book art, character-focused, bold outlines, halftone shading",
+    "Современная манга": "dynamic black and white manga art, clean sharp lines, screentone shading, character-focused",
+    "Нуарный детектив": "cinematic noir comic art, high-contrast black and white, dramatic chiaroscuro lighting",
+    "Детская иллюстрация": "charming children's book illustration, cute cartoon style, simple characters, pastel colors"
+}
+
+# Готовые кадры Kandinsky ждут верстки на диске, а не в памяти; файл удаляется, когда кадр прочитан.
+PANEL_SPILL_DIR = os.path.join(tempfile.gettempdir(), "comics-panels")
+# Размер куска base64 при декодировании (кратен 4).
+B64_CHUNK = 1024 * 1024
+
+
+def decode_to_file(image_base64: str, directory: str = PANEL_SPILL_DIR) -> tuple[str, int]:
+    """Декодирует base64 кусками во временный файл; возвращает (путь, размер в байтах)."""
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=".img", delete=False) as f:
+        for start in range(0, len(image_base64), B64_CHUNK):
+            f.write(base64.b64decode(image_base64[start:start + B64_CHUNK]))
+        return f.name, f.tell()
+
+class KandinskyAPI(ImageBackend):
+    """Удаленный бэкенд Kandinsky (FusionBrain API): финальные кадры."""
+    name = "kandinsky"
+    DEFAULT_URL = 'https://api-key.fusionbrain.ai/key/api/v1'
+
+    def __init__(self, api_key, secret_key, url: str | None = None, max_concurrency: int = 3, requests_per_second: float = 10.0,
+                 pipeline_ttl: float = 3600, image_cache: DiskLRUCache | None = None):
         self.API_KEY = api_key
         self.SECRET_KEY = secret_key
-        self.URL = 'https://api-key.fusionbrain.ai/key/api/v1' 
+        self.URL = url or self.DEFAULT_URL
         self.AUTH_HEADERS = {
             'X-Key': f'Key {self.API_KEY}',
             'X-Secret': f'Secret {self.SECRET_KEY}',
         }
+        # Общая keep-alive сессия: TCP+TLS рукопожатие один раз на соединение пула, а не на каждый запрос.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(4, 2 * max_concurrency))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update(self.AUTH_HEADERS)
+        self._rate_limiter = RateLimiter(requests_per_second, burst=max_concurrency)
+        # Не больше max_concurrency генераций одновременно находятся в очереди API.
+        self._executor = tracing.ContextThreadPool(max_workers=max_concurrency, thread_name_prefix="kandinsky")
+        # id пайплайна почти не меняется: запрашиваем /pipelines не чаще раза в pipeline_ttl секунд.
+        self.pipeline_ttl = pipeline_ttl
+        self._pipeline_id = None
+        self._pipeline_expires = 0.0
+        self._pipeline_lock = threading.Lock()
+        # Готовые изображения по ключу (финальный промпт, стиль, размер).
+        self.image_cache = image_cache
 
     def _handle_response(self, response: requests.Response):
         """Проверяет ответ сервера и выбрасывает исключение в случае ошибки."""
@@ -27,51 +76,148 @@ class KandinskyAPI:
             print(error_message)
             raise RuntimeError(error_message)
 
+    def _request(self, method: str, path: str, max_retries: int = 4, **kwargs):
+        """Запрос через общую сессию с ограничением частоты; на 429/503 ждет Retry-After и повторяет."""
+        for attempt in range(max_retries):
+            self._rate_limiter.acquire()
+            response = self.session.request(method, f'{self.URL}{path}', timeout=60, **kwargs)
+            if response.status_code in (429, 503) and attempt < max_retries - 1:
+                wait = float(response.headers.get('Retry-After', 2 ** attempt))
+                print(f"  API перегружен (статус {response.status_code}). Повтор через {wait:.0f} сек...")
+                tracing.current_span().add(retries=1)
+                time.sleep(wait)
+                continue
+            return self._handle_response(response)
+
     def get_model(self):
-        response = requests.get(f'{self.URL}/pipelines', headers=self.AUTH_HEADERS)
-        data = self._handle_response(response)
-        for model in data:
-            if model.get('name') == 'Kandinsky Split 3.0':
-                return model['id']
+        with self._pipeline_lock:
+            if self._pipeline_id and time.monotonic() < self._pipeline_expires:
+                return self._pipeline_id
+            data = self._request('GET', '/pipelines')
+            for model in data:
+                if model.get('name') == 'Kandinsky Split 3.0':
+                    self._pipeline_id = model['id']
+                    self._pipeline_expires = time.monotonic() + self.pipeline_ttl
+                    return self._pipeline_id
         raise RuntimeError("Не удалось найти модель Kandinsky Split 3.0 в списке доступных.")
 
+    def _forget_model(self):
+        with self._pipeline_lock:
+            self._pipeline_id = None
+
+    @tracing.traced("kandinsky.generate")
     def generate(self, prompt, pipeline_id, width=1024, height=1024):
         params = {"type": "GENERATE", "numImages": 1, "width": width, "height": height, "generateParams": {"query": prompt}}
         data = {'pipeline_id': (None, pipeline_id), 'params': (None, json.dumps(params), 'application/json')}
-        response = requests.post(f'{self.URL}/pipeline/run', headers=self.AUTH_HEADERS, files=data)
-        data = self._handle_response(response)
+        data = self._request('POST', '/pipeline/run', files=data)
         return data['uuid']
 
-    def check_generation(self, request_id, attempts=20, delay=10):
-        while attempts > 0:
-            response = requests.get(f'{self.URL}/pipeline/status/{request_id}', headers=self.AUTH_HEADERS)
-            data = self._handle_response(response)
+    @tracing.traced("kandinsky.check_generation")
+    def check_generation(self, request_id, attempts=20, delay=10, initial_delay=1.0, backoff=1.5):
+        """
+        Опрашивает статус генерации. Пауза между опросами растет от initial_delay до delay,
+        общее время ожидания то же, что у attempts опросов раз в delay секунд.
+        Готовое изображение декодируется в файл (см. decode_to_file); возвращается путь к нему.
+        """
+        deadline = time.monotonic() + attempts * delay
+        wait = initial_delay
+        while time.monotonic() < deadline:
+            data = self._request('GET', f'/pipeline/status/{request_id}')
+            tracing.current_span().add(polls=1)
             if data['status'] == 'DONE':
-                image_base64 = data['result']['files'][0]
-                image_bytes = base64.b64decode(image_base64)
-                return image_bytes
+                image_path, size = decode_to_file(data['result']['files'][0])
+                tracing.current_span().add(bytes=size)
+                return image_path
             
             if data['status'] == 'FAIL':
                 raise RuntimeError(f"Генерация не удалась. Ошибка: {data.get('errorDescription', 'Неизвестная ошибка')}")
 
-            print(f"  Статус: {data['status']}. Ожидание {delay} сек...")
-            attempts -= 1
-            time.sleep(delay)
+            print(f"  Статус: {data['status']}. Ожидание {wait:.1f} сек...")
+            time.sleep(min(wait, max(0, deadline - time.monotonic())))
+            wait = min(delay, wait * backoff)
         raise TimeoutError("Изображение не было сгенерировано за отведенное время.")
 
-@st.cache_resource
-def load_artist_models():
+    def _image_cache_key(self, prompt, style, width, height) -> str:
+        return content_hash("kandinsky", prompt, style, width, height)
+
+    def generate_image(self, prompt, width=1024, height=1024, style="", use_cache=True) -> bytes | str:
+        """
+        Полный цикл генерации одного изображения: кэш, запуск и ожидание результата.
+        Из кэша возвращаются байты, новое изображение — путем к временному файлу.
+        """
+        cache_key = self._image_cache_key(prompt, style, width, height)
+        if use_cache and self.image_cache is not None:
+            cached = self.image_cache.get(cache_key)
+            if cached is not None: return cached
+        pipeline_id = self.get_model()
+        try:
+            uuid = self.generate(prompt, pipeline_id, width, height)
+        except RuntimeError:
+            # id мог устареть: при следующем вызове запросим список пайплайнов заново.
+            self._forget_model()
+            raise
+        image_path = self.check_generation(uuid)
+        if self.image_cache is not None:
+            with open(image_path, 'rb') as f: self.image_cache.put(cache_key, f.read())
+        return image_path
+
+    def submit(self, prompt, width=1024, height=1024, style="", use_cache=True) -> Future:
+        """
+        Ставит генерацию в пул и сразу возвращает Future с изображением (байты из кэша или путь к файлу).
+        Закэшированные кадры возвращаются уже выполненным Future, не занимая место в пуле.
+        """
+        if use_cache and self.image_cache is not None:
+            cached = self.image_cache.get(self._image_cache_key(prompt, style, width, height))
+            if cached is not None:
+                future = Future(); future.set_result(cached)
+                return future
+        return self._executor.submit(self.generate_image, prompt, width, height, style, False)
+
+    def cache_stats(self) -> dict:
+        """Статистика кэша изображений (попадания, промахи, hit rate, размер)."""
+        return self.image_cache.stats() if self.image_cache is not None else {}
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+def create_artist_client() -> KandinskyAPI | None:
+    """Создает клиент Kandinsky API по переменным окружения (без Streamlit). Без ключей возвращает None."""
     print("Инициализация клиента Kandinsky API...")
     api_key = os.getenv("FUSION_API_KEY")
     secret_key = os.getenv("FUSION_SECRET_KEY")
     if not api_key or not secret_key:
-        st.error("Ключи FUSION_API_KEY или FUSION_SECRET_KEY не найдены в .env файле!")
+        print("Ключи FUSION_API_KEY или FUSION_SECRET_KEY не найдены в .env файле!")
         return None
-    client = KandinskyAPI(api_key, secret_key)
+    client = KandinskyAPI(api_key, secret_key, url=os.getenv("FUSION_API_URL"),
+                          max_concurrency=int(os.getenv("KANDINSKY_MAX_CONCURRENCY", "3")),
+                          requests_per_second=float(os.getenv("KANDINSKY_REQUESTS_PER_SECOND", "10")),
+                          image_cache=get_cache("images", default_max_mb=512))
     print("Клиент Kandinsky API готов.")
     return client
 
 
+def create_draft_client(backend: str | None = None) -> ImageBackend:
+    """
+    Локальный бэкенд черновиков (без сети и ключей): DRAFT_BACKEND=procedural (по умолчанию, мгновенно)
+    или diffusers (DIFFUSERS_MODEL, DIFFUSERS_STEPS). Финальные кадры потом рисует create_artist_client().
+    """
+    backend = backend or os.getenv("DRAFT_BACKEND", "procedural")
+    if backend == "diffusers":
+        return DiffusersBackend(model=os.getenv("DIFFUSERS_MODEL"), steps=int(os.getenv("DIFFUSERS_STEPS", "2")))
+    if backend != "procedural": raise ValueError(f"Неизвестный бэкенд черновиков: {backend}")
+    return ProceduralBackend()
+
+
+def load_artist_models():
+    """create_artist_client() для веб-интерфейса: без ключей показывает ошибку на странице."""
+    import streamlit as st
+    client = create_artist_client()
+    if client is None:
+        st.error("Ключи FUSION_API_KEY или FUSION_SECRET_KEY не найдены в .env файле!")
+    return client
+
+
 def build_and_truncate_prompt(action_prompt, location_desc, character_descs, style_keywords, max_len=950):
     """
     Интеллигентно собирает и обрезает промпт, чтобы он не превышал лимит API.
@@ -97,13 +243,8 @@ def build_and_truncate_prompt(action_prompt, location_desc, character_descs, sty
     return final_prompt.strip()
 
 
-def generate_panel_image(client: KandinskyAPI, scenario: dict, scene_index: int, style_keywords: str) -> Image.Image:
-    """
-    Собирает полный, контекстно-богатый промпт и генерирует изображение.
-    """
-    if not client:
-        return Image.new('RGB', (1024, 1024), 'grey')
-
+def build_panel_prompt(scenario: dict, scene_index: int, style_keywords: str) -> str:
+    """Собирает полный, контекстно-богатый промпт для кадра сценария."""
     scene = scenario['scenes'][scene_index]
     bible = scenario.get('story_bible', {})
     
@@ -114,16 +255,52 @@ def generate_panel_image(client: KandinskyAPI, scenario: dict, scene_index: int,
     for char in bible.get('main_characters', []):
         character_descs.append(f"{char.get('name', '')} ({char.get('description', '')})")
     
-    full_prompt = build_and_truncate_prompt(action_prompt, location_desc, character_descs, style_keywords)
-    
-    print(f"Генерирую изображение Kandinsky с ФИНАЛЬНЫМ промптом: {full_prompt}")
-    
-    try:
-        pipeline_id = client.get_model()
-        uuid = client.generate(full_prompt, pipeline_id)
-        image_bytes = client.check_generation(uuid)
-        return Image.open(BytesIO(image_bytes))
-    except Exception as e:
-        print(f"ОШИБКА при вызове Kandinsky API: {e}")
-        st.error(f"Произошла ошибка при генерации изображения: {e}")
-        return Image.new('RGB', (1024, 1024), 'red')
\ No newline at end of file
+    return build_and_truncate_prompt(action_prompt, location_desc, character_descs, style_keywords)
+
+
+def generate_panel_image(client: ImageBackend, scenario: dict, scene_index: int, style_keywords: str) -> Image.Image:
+    """
+    Собирает полный, контекстно-богатый промпт и генерирует изображение бэкендом client.
+    """
+    return collect_panel_images(submit_panel_images(client, scenario, style_keywords, scene_indices=[scene_index]))[0]
+
+
+def submit_panel_images(client: ImageBackend | None, scenario: dict, style_keywords: str, scene_indices: list[int] | None = None,
+                        use_cache: bool = True) -> list[Future]:
+    """
+    Ставит генерацию всех (или выбранных) кадров сценария одной пачкой в бэкенд, не дожидаясь результата.
+    use_cache=False рисует кадр заново (новый вариант заменит старый в кэше). Без бэкенда — серые заглушки.
+    """
+    if scene_indices is None: scene_indices = range(len(scenario['scenes']))
+    if not client:
+        futures = [Future() for _ in scene_indices]
+        for future in futures: future.set_result(Image.new('RGB', (1024, 1024), 'grey'))
+        return futures
+    prompts = [build_panel_prompt(scenario, scene_index, style_keywords) for scene_index in scene_indices]
+    for prompt in prompts: print(f"Генерирую изображение ({client.name}) с ФИНАЛЬНЫМ промптом: {prompt}")
+    return client.submit_batch(prompts, style=style_keywords, use_cache=use_cache)
+
+
+def collect_panel_images(futures: list[Future], failed: list[int] | None = None) -> list[Image.Image]:
+    """
+    Дожидается кадров; при ошибке генерации кадр заменяется красной заглушкой,
+    а его номер (по порядку futures) добавляется в failed, если список передан.
+    Результат бэкенда — PIL.Image, байты или путь к временному файлу (он удаляется после чтения).
+    """
+    images = []
+    for k, future in enumerate(futures):
+        try:
+            result = future.result()
+            if isinstance(result, str):
+                with Image.open(result) as image:
+                    image.load()
+                os.remove(result)
+                images.append(image)
+            else:
+                images.append(result if isinstance(result, Image.Image) else Image.open(BytesIO(result)))
+        except Exception as e:
+            # Без Streamlit: функция работает в фоновых задачах и в batch.py, ошибки показывает UI по failed.
+            print(f"ОШИБКА генерации кадра {k + 1}: {e}")
+            images.append(Image.new('RGB', (1024, 1024), 'red'))
+            if failed is not None: failed.append(k)
+    return images
@@ -0,0 +1,157 @@
+# agents/image_backends.py
+import abc
+import colorsys
+import random
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from agents.layout_agent import FONT_PATH, load_font
+from utils.cache import content_hash
+from utils import tracing
+
+
+class ImageBackend(abc.ABC):
+    """
+    Генератор изображений кадров. submit() возвращает Future с изображением (bytes или PIL.Image),
+    submit_batch() — по Future на промпт. draft=True у локальных бэкендов: их кадры — черновики,
+    которые потом перерисовываются удаленным (финальным) бэкендом.
+    """
+    name = "base"
+    draft = False
+
+    @abc.abstractmethod
+    def submit(self, prompt, width=1024, height=1024, style="", use_cache=True) -> Future:
+        ...
+
+    def submit_batch(self, prompts: list[str], width=1024, height=1024, style="", use_cache=True) -> list[Future]:
+        return [self.submit(prompt, width, height, style, use_cache) for prompt in prompts]
+
+    def cache_stats(self) -> dict:
+        return {}
+
+    def close(self):
+        pass
+
+
+class LocalBatchBackend(ImageBackend):
+    """
+    Основа локальных бэкендов: все кадры страницы рисуются одним вызовом render_batch в собственном потоке,
+    пачки выполняются по одной (рисование и так занимает все ядра). Кадры рисуются не больше size пикселей по стороне.
+    """
+    draft = True
+
+    def __init__(self, size: int = 512):
+        self.size = size
+        self._executor = tracing.ContextThreadPool(max_workers=1, thread_name_prefix=self.name)
+
+    @abc.abstractmethod
+    def render_batch(self, prompts: list[str], width: int, height: int, style: str) -> list[Image.Image]:
+        ...
+
+    def submit(self, prompt, width=1024, height=1024, style="", use_cache=True) -> Future:
+        return self.submit_batch([prompt], width, height, style, use_cache)[0]
+
+    def submit_batch(self, prompts: list[str], width=1024, height=1024, style="", use_cache=True) -> list[Future]:
+        futures = [Future() for _ in prompts]
+        width, height = min(width, self.size), min(height, self.size)
+
+        def run():
+            # Отмененные, пока пачка ждала в очереди, кадры не рисуются.
+            live = [(prompt, future) for prompt, future in zip(prompts, futures) if future.set_running_or_notify_cancel()]
+            if not live: return
+            try:
+                with tracing.span(f"{self.name}.render_batch", panels=len(live)):
+                    images = self.render_batch([prompt for prompt, _ in live], width, height, style)
+            except Exception as e:
+                for _, future in live: future.set_exception(e)
+                return
+            for (_, future), image in zip(live, images): future.set_result(image)
+
+        if prompts: self._executor.submit(run)
+        return futures
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class ProceduralBackend(LocalBatchBackend):
+    """
+    Мгновенные черновики без сети и моделей: градиентное небо, пол и фигуры персонажей (по числу описаний
+    "Имя (внешность)" в промпте). Цвета детерминированно выводятся из промпта, палитра — из стиля:
+    ч/б для манги и нуара, пастель для детской иллюстрации.
+    """
+    name = "procedural"
+
+    def render_batch(self, prompts: list[str], width: int, height: int, style: str) -> list[Image.Image]:
+        return [self._render(prompt, width, height, style) for prompt in prompts]
+
+    def _color(self, rng: random.Random, style: str) -> tuple[int, int, int]:
+        saturation = 0.25 if "pastel" in style else rng.uniform(0.35, 0.8)
+        value = rng.uniform(0.75, 0.95) if "pastel" in style else rng.uniform(0.35, 0.9)
+        return tuple(int(c * 255) for c in colorsys.hsv_to_rgb(rng.random(), saturation, value))
+
+    def _render(self, prompt: str, width: int, height: int, style: str) -> Image.Image:
+        rng = random.Random(int(content_hash(prompt, style)[:16], 16))
+        sky_top, sky_bottom, ground = (np.array(self._color(rng, style), dtype=np.float32) for _ in range(3))
+        t = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+        pixels = np.repeat(sky_top * (1 - t) + sky_bottom * t, width, axis=1)
+        horizon = int(height * rng.uniform(0.6, 0.75))
+        pixels[horizon:] = ground * 0.85
+        image = Image.fromarray(pixels.astype(np.uint8))
+        draw = ImageDraw.Draw(image)
+
+        figures = max(1, min(3, prompt.count("(")))
+        for k in range(figures):
+            x = int(width * (k + 1) / (figures + 1) + rng.uniform(-0.05, 0.05) * width)
+            body_h = int(height * rng.uniform(0.28, 0.38)); body_w = int(body_h * 0.45)
+            head = int(body_w * 0.45)
+            feet = horizon + int(height * 0.08)
+            draw.rounded_rectangle((x - body_w // 2, feet - body_h, x + body_w // 2, feet), radius=body_w // 4, fill=self._color(rng, style))
+            draw.ellipse((x - head, feet - body_h - 2 * head, x + head, feet - body_h), fill=self._color(rng, style))
+
+        font = load_font(FONT_PATH, max(10, height // 24))
+        draw.rectangle((0, 0, width, height // 14), fill=(255, 255, 255))
+        draw.text((height // 60, height // 120), "ЧЕРНОВИК", font=font, fill=(0, 0, 0))
+        if "black and white" in style: image = image.convert("L").convert("RGB")
+        return image
+
+
+class DiffusersBackend(LocalBatchBackend):
+    """
+    Дистиллированная диффузионная модель на CPU (по умолчанию stabilityai/sd-turbo: 1–4 шага, без guidance).
+    Пакеты не входят в requirements.txt: pip install diffusers transformers accelerate.
+    Модель загружается при первой отрисовке; кадры страницы генерируются батчами по batch_size.
+    """
+    name = "diffusers"
+    DEFAULT_MODEL = "stabilityai/sd-turbo"
+
+    def __init__(self, model: str | None = None, steps: int = 2, size: int = 512, batch_size: int = 4):
+        super().__init__(size)
+        self.model = model or self.DEFAULT_MODEL
+        self.steps = max(1, steps)
+        self.batch_size = max(1, batch_size)
+        self._pipe = None
+        self._pipe_lock = threading.Lock()
+
+    def _get_pipe(self):
+        with self._pipe_lock:
+            if self._pipe is None:
+                print(f"Загрузка локальной модели изображений {self.model}...")
+                with tracing.span("diffusers.load_model"):
+                    import torch
+                    from diffusers import AutoPipelineForText2Image
+                    self._pipe = AutoPipelineForText2Image.from_pretrained(self.model, torch_dtype=torch.float32)
+                    self._pipe.set_progress_bar_config(disable=True)
+            return self._pipe
+
+    def render_batch(self, prompts: list[str], width: int, height: int, style: str) -> list[Image.Image]:
+        pipe = self._get_pipe()
+        images = []
+        for k in range(0, len(prompts), self.batch_size):
+            result = pipe(prompt=prompts[k:k + self.batch_size], num_inference_steps=self.steps, guidance_scale=0.0,
+                          width=width // 8 * 8, height=height // 8 * 8)
+            images.extend(result.images)
+        return images
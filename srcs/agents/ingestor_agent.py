@@ -1,55 +1,479 @@
+import os
+import re
+import json
+import time
+import threading
 import fitz
-import easyocr
 import numpy as np
-from PIL import Image
-import io
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from utils.cache import get_cache, content_hash
+from utils import tracing
+from utils.tracing import peak_rss_mb
+from utils.text_chunks import HEADING_MARK
+
+PAGE_SEPARATOR = "\n\n--- Page Break ---\n\n"
+A4_SHORT_SIDE_PT = 595
+# Увеличивается при изменении алгоритма OCR, чтобы не использовать устаревшие записи кэша.
+OCR_CACHE_VERSION = 2
+# Блоки текстового слоя без изображений, с переносами слов, склеенными по строкам.
+TEXT_FLAGS = (fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES) | fitz.TEXT_DEHYPHENATE
+LIST_ITEM_RE = re.compile(r"^\s*([•·▪◦●\-–—*]|\d{1,2}[.)]|[а-яa-z][.)])\s")
+
+# Агент внутри процесса-воркера OCR (у каждого процесса свой easyocr.Reader).
+_worker_agent = None
+
+def _init_ocr_worker(settings: dict, torch_threads: int):
+    """Инициализатор процесса пула: загружает собственную OCR модель с теми же настройками, что и у родителя."""
+    global _worker_agent
+    _worker_agent = IngestorAgent(**settings, torch_threads=torch_threads, use_ocr_cache=False)
+    # Воркер пула нужен только для OCR: модель загружается сразу, а не на первой пачке страниц.
+    _worker_agent.warm_up(background=False)
+
+def _ocr_pages_worker(pdf_path: str, page_indices: list[int]) -> list[tuple[int, str, dict]]:
+    """Распознает пачку страниц в процессе-воркере. Документ открывается заново, т.к. fitz.Document не сериализуется."""
+    doc = fitz.open(pdf_path)
+    try:
+        results = _worker_agent._ocr_pages([doc[i] for i in page_indices])
+        return [(i, text, stats) for i, (text, stats) in zip(page_indices, results)]
+    finally:
+        doc.close()
 
 class IngestorAgent:
-    def __init__(self, languages=['ru', 'en']):
-        print("Загрузка OCR модели... Может занять некоторое время при первом запуске.")
-        self.ocr_reader = easyocr.Reader(languages)
-        print("OCR модель успешно загружена.")
+    def __init__(self, languages=['ru', 'en'], ocr_workers: int = 1, ocr_batch_size: int = 2,
+                 target_glyph_px: int = 32, body_font_pt: float = 11, min_dpi: int = 150, max_dpi: int = 400,
+                 low_confidence: float = 0.4, retry_dpi: int = 600, max_retry_regions: int = 20,
+                 use_ocr_cache: bool = True, recognizer_batch_size: int = 8, torch_threads: int | None = None,
+                 ocr_image_regions: bool = True, min_region_fraction: float = 0.03, region_text_chars: int = 20):
+        # Внутрипроцессный параллелизм torch: все ядра для одиночного процесса, в пуле — доля ядер на воркер.
+        self.torch_threads = max(1, torch_threads or os.cpu_count() or 1)
+        self.languages = list(languages)
+        # OCR модель (torch + веса easyocr) загружается при первом скане, см. ocr_reader и warm_up().
+        self._ocr_reader = None
+        self._ocr_reader_lock = threading.Lock()
+        self.ocr_workers = max(1, ocr_workers)
+        # Сколько страниц за раз проходит через детектор (и сколько страниц получает воркер пула).
+        self.ocr_batch_size = max(1, ocr_batch_size)
+        # Размер батча распознавателя строк (на CPU easyocr все равно распознает строки по одной).
+        self.recognizer_batch_size = max(1, recognizer_batch_size)
+        # Параметры растеризации: DPI подбирается так, чтобы кегль основного текста занимал ~target_glyph_px пикселей.
+        self.target_glyph_px = target_glyph_px
+        self.body_font_pt = body_font_pt
+        self.min_dpi, self.max_dpi = min_dpi, max_dpi
+        # Строки с уверенностью ниже low_confidence перераспознаются с более высоким DPI.
+        self.low_confidence = low_confidence
+        self.retry_dpi = retry_dpi
+        self.max_retry_regions = max_retry_regions
+        # На страницах с текстовым слоем распознаются только изображения (не меньше min_region_fraction площади листа),
+        # поверх которых лежит меньше region_text_chars символов текста.
+        self.ocr_image_regions = ocr_image_regions
+        self.min_region_fraction = min_region_fraction
+        self.region_text_chars = region_text_chars
+        # Распознанный текст страниц кэшируется на диске по хэшу содержимого страницы и настройкам OCR.
+        self.ocr_cache = get_cache("ocr", default_max_mb=64) if use_ocr_cache else None
+        self._ocr_pool = None
+        self._ocr_pool_workers = 0
+        # Один агент обслуживает несколько документов одновременно (batch.py --ocr-parallel): пул создается под замком.
+        self._ocr_pool_lock = threading.RLock()
+
+    @property
+    def ocr_reader(self):
+        """easyocr.Reader, создаваемый при первом обращении: документы с текстовым слоем обходятся без torch и весов модели."""
+        if self._ocr_reader is None:
+            with self._ocr_reader_lock:
+                if self._ocr_reader is None:
+                    print("Загрузка OCR модели... Может занять некоторое время при первом запуске.")
+                    start = time.perf_counter()
+                    with tracing.span("ocr.load_model"):
+                        import torch
+                        import easyocr
+                        torch.set_num_threads(self.torch_threads)
+                        self._ocr_reader = easyocr.Reader(self.languages)
+                    print(f"OCR модель успешно загружена за {time.perf_counter() - start:.1f} с.")
+        return self._ocr_reader
+
+    def warm_up(self, background: bool = True) -> threading.Thread | None:
+        """Загружает OCR модель заранее: в фоновом потоке (не блокируя запуск) или сразу."""
+        if not background:
+            self.ocr_reader
+            return None
+        thread = threading.Thread(target=lambda: self.ocr_reader, name="ocr-warm-up", daemon=True)
+        thread.start()
+        return thread
 
     def _is_scanned_page(self, page, text_threshold=100):
+        return self._analyze_page(page, text_threshold)["kind"] == "scanned"
 
-        text = page.get_text("text")
-        return len(text.strip()) < text_threshold
+    def _text_blocks(self, page) -> list[dict]:
+        """
+        Текстовые блоки страницы за один вызов get_text("dict") в порядке потока содержимого (он, в отличие от сортировки
+        по координатам, сохраняет колонки): {"rect", "text", "heading"}. Строки блока склеиваются в абзац
+        (пункт списка после законченной строки начинается с новой); заголовком считается
+        короткий блок, набранный крупнее основного текста или целиком полужирным.
+        """
+        blocks, sizes, bold_chars = [], {}, 0
+        for block in page.get_text("dict", flags=TEXT_FLAGS)["blocks"]:
+            if block.get("type") != 0: continue
+            lines, max_size, bold = [], 0.0, True
+            for line in block["lines"]:
+                spans = [span for span in line["spans"] if span["text"].strip()]
+                if not spans: continue
+                lines.append("".join(span["text"] for span in line["spans"]).strip())
+                for span in spans:
+                    size = round(span["size"], 1)
+                    sizes[size] = sizes.get(size, 0) + len(span["text"])
+                    max_size = max(max_size, size)
+                    span_bold = bool(span["flags"] & fitz.TEXT_FONT_BOLD)
+                    bold_chars += len(span["text"]) if span_bold else 0
+                    bold = bold and span_bold
+            if not lines: continue
+            paragraphs = []
+            for line in lines:
+                if paragraphs and (paragraphs[-1][-1].isalnum() or not LIST_ITEM_RE.match(line)): paragraphs[-1] += " " + line
+                else: paragraphs.append(line)
+            blocks.append({"rect": fitz.Rect(block["bbox"]), "text": "\n".join(paragraphs), "size": max_size, "bold": bold, "lines": len(lines)})
 
-    def _ocr_page(self, page):
-        pix = page.get_pixmap(dpi=800)
-        img_bytes = pix.tobytes("png")
-        image = Image.open(io.BytesIO(img_bytes))
-        
-        image_np = np.array(image)
-        
-        result = self.ocr_reader.readtext(image_np, detail=0, paragraph=True)
-        
-        return "\n".join(result)
+        body_size = max(sizes, key=sizes.get) if sizes else 0
+        # Если полужирным набрана большая часть текста, полужирность заголовок не выделяет.
+        bold_marks_heading = bold_chars < 0.5 * sum(sizes.values())
+        for block in blocks:
+            size, bold, lines = block.pop("size"), block.pop("bold"), block.pop("lines")
+            short = lines <= 3 and len(block["text"]) <= 150 and any(c.isalpha() for c in block["text"])
+            block["heading"] = short and (size >= body_size * 1.15 or (bold and bold_marks_heading))
+            if block["heading"]: block["text"] = block["text"].replace("\n", " ")
+        return blocks
+
+    def _image_regions(self, page) -> list:
+        """Крупные изображения страницы (пересекающиеся объединены) в координатах page.rect."""
+        min_area = self.min_region_fraction * page.rect.get_area()
+        regions = []
+        for info in page.get_image_info():
+            rect = fitz.Rect(info["bbox"]) & page.rect
+            if rect.is_empty or rect.get_area() < min_area: continue
+            merged = True
+            while merged:
+                merged = False
+                for other in regions:
+                    if other.intersects(rect):
+                        regions.remove(other); rect |= other; merged = True
+                        break
+            regions.append(rect)
+        return regions
+
+    def _analyze_page(self, page, text_threshold: int = 100) -> dict:
+        """
+        Классификация страницы за один проход: "scanned" (текстового слоя нет — OCR всей страницы),
+        "mixed" (текст + изображения без текста поверх — OCR только этих областей) или "text".
+        Возвращает kind, blocks (см. _text_blocks) и regions (области для OCR на смешанной странице).
+        """
+        blocks = self._text_blocks(page)
+        chars = sum(len(block["text"]) for block in blocks)
+        if chars < text_threshold: return {"kind": "scanned", "blocks": blocks, "regions": []}
+        regions = []
+        for rect in self._image_regions(page):
+            # Подложка под текстовым слоем (фон, рамка, логотип с подписью) не распознается.
+            covered = sum(len(block["text"]) for block in blocks
+                          if rect.contains(fitz.Point((block["rect"].x0 + block["rect"].x1) / 2, (block["rect"].y0 + block["rect"].y1) / 2)))
+            if covered < self.region_text_chars: regions.append(rect)
+        return {"kind": "mixed" if regions else "text", "blocks": blocks, "regions": regions}
+
+    def _blocks_to_text(self, blocks: list[dict], image_blocks: list[dict] = ()) -> str:
+        """
+        Текст страницы из блоков; заголовки — отдельными строками с HEADING_MARK. Распознанный текст изображения
+        встает перед первым блоком той же колонки, который начинается ниже изображения.
+        """
+        blocks = list(blocks)
+        for image_block in image_blocks:
+            rect = image_block["rect"]
+            position = next((k for k, block in enumerate(blocks)
+                             if block["rect"].y0 >= rect.y0 and block["rect"].x0 < rect.x1 and block["rect"].x1 > rect.x0), len(blocks))
+            blocks.insert(position, image_block)
+        return "\n".join(f"{HEADING_MARK}{block['text']}" if block["heading"] else block["text"] for block in blocks)
+
+    def _scan_clip(self, page):
+        """
+        Область скана для OCR страницы без текстового слоя: объединение крупных изображений, если они
+        покрывают хотя бы половину листа (поля вокруг скана не растеризуются), иначе None — вся страница.
+        """
+        regions = self._image_regions(page)
+        if not regions: return None
+        clip = fitz.Rect(regions[0])
+        for rect in regions[1:]: clip |= rect
+        return clip if clip.get_area() >= 0.5 * page.rect.get_area() else None
+
+    def _native_image_dpi(self, page, clip=None) -> float | None:
+        """Собственное разрешение самого крупного встроенного изображения (в области clip): рендер выше него не добавляет деталей."""
+        best_area, native_dpi = 0, None
+        for info in page.get_image_info():
+            bbox = fitz.Rect(info["bbox"])
+            if bbox.is_empty or not info.get("width"): continue
+            if clip is not None and not bbox.intersects(clip): continue
+            if bbox.get_area() > best_area:
+                best_area, native_dpi = bbox.get_area(), info["width"] / (bbox.width / 72)
+        return native_dpi
+
+    def _choose_dpi(self, page, clip=None) -> int:
+        """Подбирает DPI по размеру страницы и целевой высоте глифа в пикселях."""
+        # Считаем, что кегль основного текста пропорционален формату листа (body_font_pt для A4).
+        page_scale = min(page.rect.width, page.rect.height) / A4_SHORT_SIDE_PT
+        dpi = self.target_glyph_px * 72 / (self.body_font_pt * page_scale)
+        native_dpi = self._native_image_dpi(page, clip)
+        if native_dpi: dpi = min(dpi, native_dpi)
+        return int(max(self.min_dpi, min(self.max_dpi, dpi)))
+
+    def _render_page(self, page, dpi: int, clip=None):
+        """
+        Растеризует страницу сразу в NumPy-массив поверх буфера сэмплов fitz.Pixmap, без PNG-кодирования.
+        Возвращает (массив, pixmap): pixmap должен жить, пока используется массив.
+        """
+        pix = page.get_pixmap(dpi=dpi, clip=clip, alpha=False)
+        samples = pix.samples_mv if hasattr(pix, "samples_mv") else pix.samples
+        image_np = np.frombuffer(samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+        return image_np, pix
 
-    def process_pdf(self, pdf_path: str) -> str:
+    def _retry_low_confidence(self, page, raw_result: list, dpi: int, origin=None) -> tuple[list, int]:
+        """
+        Перераспознает с повышенным DPI только области строк с низкой уверенностью.
+        origin — левый верхний угол растеризованной области, если распознавалась не вся страница.
+        """
+        if dpi >= self.retry_dpi: return raw_result, 0
+        # clip для get_pixmap задается в координатах page.rect (с учетом поворота), т.е. пиксели / масштаб + сдвиг области.
+        x0, y0 = (origin.x, origin.y) if origin is not None else (0, 0)
+        to_page = fitz.Matrix(72 / dpi, 0, 0, 72 / dpi, x0, y0)
+        margin = 2
+        retries = 0
+        result = []
+        for box, text, confidence in raw_result:
+            if confidence >= self.low_confidence or retries >= self.max_retry_regions:
+                result.append((box, text, confidence)); continue
+            xs = [p[0] for p in box]; ys = [p[1] for p in box]
+            clip = (fitz.Rect(min(xs), min(ys), max(xs), max(ys)) * to_page + (-margin, -margin, margin, margin)) & page.rect
+            if clip.is_empty:
+                result.append((box, text, confidence)); continue
+            retries += 1
+            region_np, region_pix = self._render_page(page, self.retry_dpi, clip=clip)
+            region_result = self.ocr_reader.readtext(region_np, detail=1, paragraph=False)
+            del region_np, region_pix
+            if region_result:
+                region_confidence = sum(r[2] for r in region_result) / len(region_result)
+                if region_confidence > confidence:
+                    text, confidence = " ".join(r[1] for r in region_result), region_confidence
+            result.append((box, text, confidence))
+        return result, retries
+
+    def ocr_images(self, images: list[np.ndarray], batch_size: int | None = None) -> list[list]:
+        """
+        Пакетный OCR набора изображений (страниц или вырезанных строк).
+        Изображения одного размера проходят через детектор пачками по batch_size (readtext_batched),
+        для каждого возвращается список (box, text, confidence) — тот же, что дал бы readtext.
+        """
+        batch_size = max(1, batch_size or self.ocr_batch_size)
+        results = [None] * len(images)
+        by_shape = {}
+        for idx, image in enumerate(images): by_shape.setdefault(image.shape, []).append(idx)
+        for indices in by_shape.values():
+            for k in range(0, len(indices), batch_size):
+                chunk = indices[k:k + batch_size]
+                if len(chunk) == 1:
+                    chunk_results = [self.ocr_reader.readtext(images[chunk[0]], detail=1, paragraph=False, batch_size=self.recognizer_batch_size)]
+                else:
+                    chunk_results = self.ocr_reader.readtext_batched([images[i] for i in chunk], detail=1, paragraph=False, batch_size=self.recognizer_batch_size)
+                for idx, result in zip(chunk, chunk_results): results[idx] = result
+        return results
+
+    def _ocr_pages(self, pages: list) -> list[tuple[str, dict]]:
+        """Распознает несколько страниц-сканов за один проход моделей (растеризуется только область скана)."""
+        return self._ocr_regions([(page, self._scan_clip(page)) for page in pages])
+
+    def _ocr_regions(self, regions: list[tuple]) -> list[tuple[str, dict]]:
+        """
+        Распознает области страниц (page, clip) за один проход моделей, clip=None — вся страница.
+        Для каждой возвращает текст и статистику растеризации/OCR для подбора числа воркеров.
+        """
+        rendered = []
+        for page, clip in regions:
+            dpi = self._choose_dpi(page, clip)
+            start = time.perf_counter()
+            image_np, pix = self._render_page(page, dpi, clip=clip)
+            area = clip.get_area() / page.rect.get_area() if clip is not None else 1.0
+            rendered.append({"page": page, "clip": clip, "area": area, "dpi": dpi, "image": image_np, "pix": pix,
+                             "render_time": time.perf_counter() - start})
+
+        from easyocr import utils as easyocr_utils
+        start = time.perf_counter()
+        raw_results = self.ocr_images([r["image"] for r in rendered])
+        batch_ocr_time = (time.perf_counter() - start) / len(regions)
+
+        results = []
+        for r, raw_result in zip(rendered, raw_results):
+            page, dpi, clip = r["page"], r["dpi"], r["clip"]
+            image_mb = r.pop("image").nbytes / 2**20
+            r.pop("pix")
+            start = time.perf_counter()
+            raw_result, retries = self._retry_low_confidence(page, raw_result, dpi, origin=clip.tl if clip is not None else None)
+            ocr_time = batch_ocr_time + time.perf_counter() - start
+
+            stats = {"page": page.number + 1, "dpi": dpi, "render_ms": round(r["render_time"] * 1000, 1),
+                     "ocr_ms": round(ocr_time * 1000, 1), "image_mb": round(image_mb, 1), "ocr_area": round(r["area"], 3),
+                     "retried_regions": retries, "peak_rss_mb": round(peak_rss_mb(), 1)}
+            print(f"  Страница {stats['page']}: {dpi} DPI, область {stats['ocr_area']:.0%} листа, рендер {stats['render_ms']} мс, "
+                  f"OCR {stats['ocr_ms']} мс, изображение {stats['image_mb']} МБ, повторов {retries}, пик RSS {stats['peak_rss_mb']} МБ")
+
+            paragraphs = easyocr_utils.get_paragraph(raw_result, x_ths=1.0, y_ths=0.5, mode='ltr')
+            results.append(("\n".join(item[1] for item in paragraphs), stats))
+        return results
+
+    def _ocr_page(self, page) -> tuple[str, dict]:
+        """Распознает одну страницу."""
+        return self._ocr_pages([page])[0]
+
+    def _ocr_settings(self) -> dict:
+        """Настройки OCR, с которыми создаются агенты в процессах пула."""
+        return {"languages": self.languages, "ocr_batch_size": self.ocr_batch_size, "target_glyph_px": self.target_glyph_px,
+                "body_font_pt": self.body_font_pt, "min_dpi": self.min_dpi, "max_dpi": self.max_dpi,
+                "low_confidence": self.low_confidence, "retry_dpi": self.retry_dpi,
+                "max_retry_regions": self.max_retry_regions, "recognizer_batch_size": self.recognizer_batch_size,
+                "ocr_image_regions": self.ocr_image_regions, "min_region_fraction": self.min_region_fraction,
+                "region_text_chars": self.region_text_chars}
+
+    def _page_cache_key(self, doc, page) -> str:
+        """Ключ кэша: хэш потока содержимого и встроенных изображений страницы + язык и параметры растеризации."""
+        parts = [OCR_CACHE_VERSION, page.read_contents(), tuple(page.rect), page.rotation]
+        for image in page.get_images(full=True):
+            parts.append(doc.xref_stream_raw(image[0]) or b"")
+        parts.append((tuple(self.languages), self.target_glyph_px, self.body_font_pt, self.min_dpi, self.max_dpi,
+                      self.low_confidence, self.retry_dpi, self.max_retry_regions, self.min_region_fraction))
+        return content_hash(*parts)
+
+    def _ocr_image_blocks(self, doc, page, regions: list, ocr_stats: list) -> list[dict]:
+        """
+        OCR изображений смешанной страницы (только вырезанные области). Результат — блоки для _blocks_to_text,
+        встающие в порядок чтения по месту изображения; тексты областей кэшируются вместе.
+        """
+        key = texts = None
+        if self.ocr_cache is not None:
+            key = content_hash(self._page_cache_key(doc, page), "regions", [tuple(rect) for rect in regions])
+            cached = self.ocr_cache.get_text(key)
+            if cached is not None: texts = json.loads(cached)
+        if texts is None:
+            results = self._ocr_regions([(page, rect) for rect in regions])
+            texts = [text for text, _ in results]
+            ocr_stats.extend(stats for _, stats in results)
+            if key is not None: self.ocr_cache.put_text(key, json.dumps(texts, ensure_ascii=False))
+        return [{"rect": rect, "text": text, "heading": False} for rect, text in zip(regions, texts) if text.strip()]
+
+    def _get_ocr_pool(self, workers: int) -> ProcessPoolExecutor:
+        """Пул процессов переиспользуется между вызовами, чтобы не загружать модели в воркеры заново."""
+        with self._ocr_pool_lock:
+            if self._ocr_pool is None or self._ocr_pool_workers != workers:
+                self.close()
+                print(f"Запуск пула OCR из {workers} процессов...")
+                torch_threads = max(1, (os.cpu_count() or 1) // workers)
+                self._ocr_pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=mp.get_context("spawn"),
+                    initializer=_init_ocr_worker,
+                    initargs=(self._ocr_settings(), torch_threads),
+                )
+                self._ocr_pool_workers = workers
+            return self._ocr_pool
+
+    def _ocr_pages_parallel(self, pdf_path: str, page_indices: list[int], workers: int, batch_size: int) -> dict[int, tuple[str, dict]]:
+        """Раздает страницы-сканы пачками по процессам пула и собирает результат по номерам страниц."""
+        pool = self._get_ocr_pool(workers)
+        batches = [page_indices[k:k + batch_size] for k in range(0, len(page_indices), batch_size)]
+        futures = [pool.submit(_ocr_pages_worker, pdf_path, batch) for batch in batches]
+        results = {}
+        for future in as_completed(futures):
+            for i, text, stats in future.result():
+                print(f"  OCR страницы {i + 1} завершен ({stats['dpi']} DPI, {stats['render_ms'] + stats['ocr_ms']:.0f} мс).")
+                results[i] = (text, stats)
+        return results
+
+    def close(self):
+        """Останавливает пул OCR-процессов, если он был запущен."""
+        with self._ocr_pool_lock:
+            if self._ocr_pool is not None:
+                self._ocr_pool.shutdown()
+                self._ocr_pool = None
+                self._ocr_pool_workers = 0
+
+    @tracing.traced("ingest.process_pdf")
+    def process_pdf(self, pdf_path: str, workers: int | None = None, batch_size: int | None = None, page_stats: list | None = None) -> str:
+        """
+        Извлекает текст документа. При workers > 1 страницы-сканы распознаются параллельно
+        в пуле процессов, текстовые страницы извлекаются напрямую.
+        В page_stats (если передан) добавляется статистика по каждой распознанной странице.
+        """
         print(f"Обработка документа: {pdf_path}")
+        workers = max(1, workers or self.ocr_workers)
+        batch_size = max(1, batch_size or self.ocr_batch_size)
         try:
             doc = fitz.open(pdf_path)
         except Exception as e:
             print(f"Ошибка при открытии PDF: {e}")
             return ""
 
-        full_text = []
+        tracing.current_span().set(pages=len(doc), bytes=os.path.getsize(pdf_path))
+        full_text = [""] * len(doc)
+        scanned_pages = []
+        mixed_pages = {}
         
         for i, page in enumerate(doc):
             print(f"Обработка страницы {i + 1}/{len(doc)}...")
-            if self._is_scanned_page(page):
+            layout = self._analyze_page(page)
+            if layout["kind"] == "scanned":
                 print(f"  Страница {i + 1} определена как скан. Запуск OCR...")
-                text = self._ocr_page(page)
-                full_text.append(text)
+                scanned_pages.append(i)
+                continue
+            full_text[i] = self._blocks_to_text(layout["blocks"])
+            if layout["kind"] == "mixed" and self.ocr_image_regions:
+                area = sum(rect.get_area() for rect in layout["regions"]) / page.rect.get_area()
+                print(f"  Страница {i + 1} содержит текст и {len(layout['regions'])} изобр. без текстового слоя "
+                      f"({area:.0%} листа). OCR только этих областей.")
+                mixed_pages[i] = layout
             else:
                 print(f"  Страница {i + 1} содержит текст. Прямое извлечение.")
-                text = page.get_text("text")
-                full_text.append(text)
+
+        cache_keys = {}
+        if self.ocr_cache is not None and scanned_pages:
+            pages_to_ocr = []
+            for i in scanned_pages:
+                cache_keys[i] = self._page_cache_key(doc, doc[i])
+                cached_text = self.ocr_cache.get_text(cache_keys[i])
+                if cached_text is None: pages_to_ocr.append(i)
+                else: full_text[i] = cached_text
+            print(f"Кэш OCR: {len(scanned_pages) - len(pages_to_ocr)} стр. из кэша, {len(pages_to_ocr)} стр. к распознаванию.")
+        else:
+            pages_to_ocr = scanned_pages
+
+        ocr_stats = []
+        if workers > 1 and len(pages_to_ocr) > 1:
+            for i, (text, stats) in sorted(self._ocr_pages_parallel(pdf_path, pages_to_ocr, workers, batch_size).items()):
+                full_text[i] = text; ocr_stats.append(stats)
+        else:
+            for k in range(0, len(pages_to_ocr), batch_size):
+                batch = pages_to_ocr[k:k + batch_size]
+                for i, (text, stats) in zip(batch, self._ocr_pages([doc[i] for i in batch])):
+                    full_text[i] = text; ocr_stats.append(stats)
+        if self.ocr_cache is not None:
+            for i in pages_to_ocr: self.ocr_cache.put_text(cache_keys[i], full_text[i])
+
+        for i, layout in mixed_pages.items():
+            full_text[i] = self._blocks_to_text(layout["blocks"], self._ocr_image_blocks(doc, doc[i], layout["regions"], ocr_stats))
         
         doc.close()
+        if ocr_stats:
+            print(f"OCR: {len(ocr_stats)} обл., площадь {sum(s['ocr_area'] for s in ocr_stats):.1f} листа из {len(full_text)}, "
+                  f"средний рендер {sum(s['render_ms'] for s in ocr_stats) / len(ocr_stats):.0f} мс, "
+                  f"макс. изображение {max(s['image_mb'] for s in ocr_stats)} МБ, пик RSS {max(s['peak_rss_mb'] for s in ocr_stats)} МБ")
+        # OCR мог идти в процессах пула, поэтому span'ы страниц строятся по их статистике.
+        for stats in ocr_stats:
+            tracing.record("ocr.page", (stats['render_ms'] + stats['ocr_ms']) / 1000, page=stats['page'], dpi=stats['dpi'], area=stats['ocr_area'],
+                           bytes=int(stats['image_mb'] * 2**20), retries=stats['retried_regions'], peak_rss_mb=stats['peak_rss_mb'])
+        if page_stats is not None: page_stats.extend(ocr_stats)
         print("Обработка документа завершена.")
-        return "\n\n--- Page Break ---\n\n".join(full_text)
+        return PAGE_SEPARATOR.join(full_text)
 
 if __name__ == '__main__':
     ingestor = IngestorAgent()
@@ -59,4 +483,4 @@ if __name__ == '__main__':
         print("\n--- РЕЗУЛЬТАТ ---")
         print(document_text)
     except FileNotFoundError:
-        print("\nОшибка: Тестовый PDF не найден. Укажите правильный путь.")
\ No newline at end of file
+        print("\nОшибка: Тестовый PDF не найден. Укажите правильный путь.")
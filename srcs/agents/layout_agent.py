@@ -1,6 +1,74 @@
 # agents/layout_agent.py
 from PIL import Image, ImageDraw, ImageFont
+from functools import lru_cache
+from textwrap import TextWrapper
+import math
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 import os
+from utils import tracing
+
+FONT_PATH = os.path.join(os.path.dirname(__file__), '..', 'fonts', 'DejaVuSans.ttf')
+# Черновой холст для измерения текста в том же режиме, что и страница.
+_MEASURE_DRAW = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+
+
+@lru_cache(maxsize=64)
+def load_font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    """Шрифт читается с диска один раз на пару (путь, кегль)."""
+    return ImageFont.truetype(path, size)
+
+
+@lru_cache(maxsize=16384)
+def _text_width(font: ImageFont.FreeTypeFont, text: str) -> float:
+    return _MEASURE_DRAW.textlength(text, font=font)
+
+
+def wrap_text(text: str, font: ImageFont.FreeTypeFont, max_width: float) -> str:
+    """
+    Жадный перенос по словам. Ширина строки считается суммой закэшированных ширин слов;
+    вблизи границы (возможный кернинг) строка перемеряется целиком.
+    """
+    lines, current_words, current_width = [], [], 0.0
+    for word in text.split():
+        word_width = _text_width(font, word + ' ')
+        candidate_width = current_width + word_width
+        if abs(candidate_width - max_width) <= 2:
+            candidate_width = _MEASURE_DRAW.textlength(''.join(w + ' ' for w in current_words) + word + ' ', font=font)
+        if candidate_width <= max_width:
+            current_words.append(word); current_width = candidate_width
+        else:
+            lines.append(' '.join(current_words))
+            current_words, current_width = [word], word_width
+    lines.append(' '.join(current_words))
+    return "\n".join(lines)
+
+
+def fit_text(draw: ImageDraw.ImageDraw, text: str, font_path: str, max_width: float, max_height: float,
+             max_size: int = 22, min_size: int = 10) -> tuple[ImageFont.FreeTypeFont, str]:
+    """
+    Бинарным поиском находит наибольший кегль из [min_size, max_size], при котором перенесенный текст
+    помещается по высоте. Если не помещается даже min_size, возвращается min_size.
+    """
+    def layout(size):
+        font = load_font(font_path, size)
+        wrapped = wrap_text(text, font, max_width)
+        bbox = draw.multiline_textbbox((0, 0), wrapped, font=font)
+        return font, wrapped, bbox[3] - bbox[1] <= max_height
+
+    low, high = min_size, max_size
+    best = None
+    while low <= high:
+        size = (low + high) // 2
+        font, wrapped, fits = layout(size)
+        if fits:
+            best = (font, wrapped); low = size + 1
+        else:
+            high = size - 1
+    if best is None:
+        font, wrapped, _ = layout(min_size)
+        best = (font, wrapped)
+    return best
 
 def format_dialogue(dialogue_data) -> str:
     """
@@ -22,18 +90,130 @@ def format_dialogue(dialogue_data) -> str:
     return ""
 
 
-def create_comic_page(scenario: dict, images: list[Image.Image], style: str) -> Image.Image:
-    if not images: return Image.new('RGB', (850, 1100), 'white')
-    page_width, page_height = 850, 1100
-    padding = 25
+# Базовая страница 8.5x11 дюймов при 100 DPI; для печати все размеры масштабируются под нужный DPI.
+BASE_PAGE_SIZE = (850, 1100)
+BASE_DPI = 100
+
+# Шаблоны раскладки: имя -> (максимум кадров, функция (число кадров) -> список (ряд, колонка, ширина в колонках) и сетка).
+LAYOUTS = {}
+
+
+def register_layout(name: str, max_panels: int):
+    """Регистрирует шаблон раскладки. Шаблоны перебираются по возрастанию max_panels."""
+    def decorator(func):
+        LAYOUTS[name] = (max_panels, func)
+        return func
+    return decorator
+
+
+def _grid(count: int, rows: int, cols: int):
+    """Сетка rows x cols; неполный последний ряд растягивается на всю ширину."""
+    cells = []
+    for index in range(count):
+        row, col = divmod(index, cols)
+        in_row = min(cols, count - row * cols)
+        cells.append((row, col, in_row))
+    return rows, cells
+
+
+@register_layout("single", 1)
+def _single_layout(count):
+    return _grid(count, 1, 1)
+
+
+@register_layout("strip", 2)
+def _strip_layout(count):
+    return _grid(count, 2, 1)
+
+
+@register_layout("top_wide", 3)
+def _top_wide_layout(count):
+    # Широкий кадр сверху и два под ним.
+    return 2, [(0, 0, 1), (1, 0, 2), (1, 1, 2)][:count]
+
+
+@register_layout("grid_2x2", 4)
+def _grid_2x2_layout(count):
+    return _grid(count, 2, 2)
+
+
+@register_layout("grid_2x3", 6)
+def _grid_2x3_layout(count):
+    return _grid(count, 3, 2)
+
+
+@register_layout("grid_3x3", 9)
+def _grid_3x3_layout(count):
+    return _grid(count, 3, 3)
+
+
+def choose_layout(count: int) -> str:
+    """Самый компактный шаблон, вмещающий count кадров (None — динамическая сетка в 3 колонки)."""
+    for name, (max_panels, _) in sorted(LAYOUTS.items(), key=lambda item: item[1][0]):
+        if count <= max_panels: return name
+    return None
+
+
+def panel_rects(count: int, left: int, top: int, right: int, bottom: int, gap: int, layout: str | None = None) -> list[tuple[int, int, int, int]]:
+    """
+    Координаты кадров (x1, y1, x2, y2) внутри области страницы по выбранному шаблону.
+    Если в заданный layout кадры не помещаются, шаблон подбирается по их числу.
+    """
+    if layout is not None and layout not in LAYOUTS: raise ValueError(f"Неизвестный шаблон раскладки: {layout}")
+    if layout is not None and LAYOUTS[layout][0] < count:
+        print(f"Шаблон {layout} вмещает {LAYOUTS[layout][0]} кадр., а кадров {count}: подбираю шаблон по числу кадров.")
+        layout = None
+    layout = layout or choose_layout(count)
+    if layout is None:
+        rows, cells = _grid(count, math.ceil(count / 3), 3)
+    else:
+        rows, cells = LAYOUTS[layout][1](count)
+    panel_height = max(1, (bottom - top - (rows - 1) * gap) // rows)
+    rects = []
+    for row, col, in_row in cells:
+        panel_width = (right - left - (in_row - 1) * gap) // in_row
+        x1 = left + col * (panel_width + gap)
+        y1 = top + row * (panel_height + gap)
+        rects.append((x1, y1, x1 + panel_width, y1 + panel_height))
+    return rects
+
+
+def fit_panel_image(img: Image.Image, size: tuple[int, int]) -> Image.Image:
+    """
+    Вырезает из кадра центральную область с пропорциями ячейки и уменьшает ее
+    одним качественным ресемплингом (LANCZOS) сразу до размера ячейки.
+    """
+    width, height = size
+    src_width, src_height = img.size
+    target_ratio = width / height
+    if src_width / src_height > target_ratio:
+        crop_width = src_height * target_ratio
+        box = ((src_width - crop_width) / 2, 0, (src_width + crop_width) / 2, src_height)
+    else:
+        crop_height = src_width / target_ratio
+        box = (0, (src_height - crop_height) / 2, src_width, (src_height + crop_height) / 2)
+    resized = img.resize(size, Image.LANCZOS, box=box, reducing_gap=3.0)
+    return resized if resized.mode == 'RGB' else resized.convert('RGB')
+
+
+@tracing.traced("layout.create_comic_page")
+def create_comic_page(scenario: dict, images: list[Image.Image], style: str, layout: str | None = None, dpi: int | None = None) -> Image.Image:
+    """
+    Верстает страницу: заголовок и кадры по шаблону, подобранному по числу кадров (или заданному layout).
+    dpi задает разрешение для печати (по умолчанию 100 DPI, 850x1100).
+    """
+    scale = (dpi or BASE_DPI) / BASE_DPI
+    page_width, page_height = round(BASE_PAGE_SIZE[0] * scale), round(BASE_PAGE_SIZE[1] * scale)
+    if not images: return Image.new('RGB', (page_width, page_height), 'white')
+    padding = round(25 * scale)
     canvas = Image.new('RGB', (page_width, page_height), 'white')
+    if dpi: canvas.info['dpi'] = (dpi, dpi)
     draw = ImageDraw.Draw(canvas)
+    font_path = FONT_PATH
     try:
-        font_path = os.path.join(os.path.dirname(__file__), '..', 'fonts', 'DejaVuSans.ttf')
-        title_font = ImageFont.truetype(font_path, 30)
+        title_font = load_font(font_path, round(30 * scale))
     except IOError:
         title_font = ImageFont.load_default()
-    from textwrap import TextWrapper
     title_text = scenario.get("title", "My Comic")
     char_width_approx = title_font.size * 0.6
     wrapper = TextWrapper(width=int((page_width - 2 * padding) / char_width_approx) if char_width_approx > 0 else 50)
@@ -41,53 +221,72 @@ def create_comic_page(scenario: dict, images: list[Image.Image], style: str) ->
     draw.multiline_text((padding, padding), wrapped_title, font=title_font, fill="black")
     title_bbox = draw.multiline_textbbox((padding, padding), wrapped_title, font=title_font)
     panels_start_y = title_bbox[3] + padding
-    panel_width = (page_width - 3 * padding) // 2
-    remaining_height_for_panels = page_height - panels_start_y - 3 * padding
-    panel_height = remaining_height_for_panels // 2
-    if panel_height <= 0: panel_height = 100
-    positions = [
-        (padding, panels_start_y), (padding * 2 + panel_width, panels_start_y),
-        (padding, panels_start_y + panel_height + padding), (padding * 2 + panel_width, panels_start_y + panel_height + padding)
-    ]
+    positions = panel_rects(len(images), padding, panels_start_y, page_width - padding, page_height - 2 * padding, padding, layout)
+    scenes = scenario.get("scenes", [])
 
     for i, img in enumerate(images):
-        if i >= len(positions) or not isinstance(img, Image.Image): continue
+        if not isinstance(img, Image.Image): continue
         
-        img = img.resize((panel_width, panel_height))
-        canvas.paste(img, positions[i])
+        x1, y1, x2, y2 = positions[i]
+        canvas.paste(fit_panel_image(img, (x2 - x1, y2 - y1)), (x1, y1))
+        draw.rectangle([x1, y1, x2, y2], outline="black", width=round(4 * scale))
         
-        x1, y1 = positions[i]; x2, y2 = x1 + panel_width, y1 + panel_height
-        draw.rectangle([x1, y1, x2, y2], outline="black", width=4)
-        
-        dialogue_raw = scenario["scenes"][i].get("dialogue") or scenario["scenes"][i].get("caption", "")
+        if i >= len(scenes): continue
+        dialogue_raw = scenes[i].get("dialogue") or scenes[i].get("caption", "")
         
         dialogue = format_dialogue(dialogue_raw)
         
         if dialogue:
-            text_box_padding = 10
-            box_x1, box_y1 = x1 + 8, y2 - 100
-            box_x2, box_y2 = x2 - 8, y2 - 8
+            text_box_padding = round(10 * scale)
+            box_margin = round(8 * scale)
+            box_height = min(round(100 * scale), int((y2 - y1) * 0.4))
+            box_x1, box_y1 = x1 + box_margin, y2 - box_height
+            box_x2, box_y2 = x2 - box_margin, y2 - box_margin
             text_area_width = box_x2 - box_x1 - 2 * text_box_padding
             text_area_height = box_y2 - box_y1 - 2 * text_box_padding
-            font_size = 22; font = None; wrapped_text = dialogue
-            while font_size > 9:
-                font = ImageFont.truetype(font_path, font_size)
-                temp_wrapped_lines = []
-                words = dialogue.split() 
-                current_line = ""
-                for word in words:
-                    if draw.textlength(current_line + word + ' ', font=font) <= text_area_width:
-                        current_line += word + ' '
-                    else:
-                        temp_wrapped_lines.append(current_line.strip())
-                        current_line = word + ' '
-                temp_wrapped_lines.append(current_line.strip())
-                wrapped_text = "\n".join(temp_wrapped_lines)
-                text_bbox = draw.multiline_textbbox((0, 0), wrapped_text, font=font)
-                text_height = text_bbox[3] - text_bbox[1]
-                if text_height <= text_area_height: break
-                font_size -= 1
-            draw.rectangle([box_x1, box_y1, box_x2, box_y2], fill="white", outline="black", width=2)
+            font, wrapped_text = fit_text(draw, dialogue, font_path, text_area_width, text_area_height,
+                                          max_size=round(22 * scale), min_size=round(10 * scale))
+            draw.rectangle([box_x1, box_y1, box_x2, box_y2], fill="white", outline="black", width=round(2 * scale))
             draw.multiline_text((box_x1 + text_box_padding, box_y1 + text_box_padding), wrapped_text, font=font, fill="black")
             
-    return canvas
\ No newline at end of file
+    tracing.current_span().set(panels=len(images), bytes=canvas.width * canvas.height * 3)
+    return canvas
+
+
+def _load_panel(path: str) -> Image.Image:
+    """Кадр с диска; отсутствующий заменяется серой заглушкой (как в ComicRun.load_panels)."""
+    try:
+        with Image.open(path) as img: return img.convert('RGB')
+    except OSError:
+        return Image.new('RGB', (1024, 1024), 'grey')
+
+
+def compose_page_file(scenario: dict, panel_paths: list[str], style: str, page_path: str, **kwargs) -> str:
+    """Верстает страницу из файлов кадров и пишет PNG в page_path (через временный файл); возвращает page_path."""
+    page = create_comic_page(scenario, [_load_panel(path) for path in panel_paths], style, **kwargs)
+    os.makedirs(os.path.dirname(page_path) or ".", exist_ok=True)
+    tmp_path = f"{page_path}.{os.getpid()}.tmp"
+    page.save(tmp_path, format="PNG")
+    os.replace(tmp_path, page_path)
+    return page_path
+
+
+def _compose_page_job(job: tuple) -> str:
+    scenario, panel_paths, style, page_path, kwargs = job
+    return compose_page_file(scenario, panel_paths, style, page_path, **kwargs)
+
+
+def create_comic_pages(jobs: list[tuple[dict, list[str], str, str]], workers: int | None = None, **kwargs) -> list[str]:
+    """
+    Верстает много страниц сразу, распределяя их по процессам (по умолчанию — по числу ядер).
+    jobs — список (scenario, пути PNG кадров, style, путь PNG страницы): процессам передаются только пути,
+    кадры каждый читает с диска сам и сразу пишет страницу на диск, так что изображения не сериализуются
+    и в памяти родителя не копятся. kwargs передаются в create_comic_page. Возвращает пути страниц.
+    """
+    workers = min(len(jobs), workers or os.cpu_count() or 1)
+    with tracing.span("layout.create_comic_pages", pages=len(jobs), workers=workers):
+        if workers <= 1:
+            return [compose_page_file(scenario, panel_paths, style, page_path, **kwargs) for scenario, panel_paths, style, page_path in jobs]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as pool:
+            return list(pool.map(_compose_page_job, [(scenario, panel_paths, style, page_path, kwargs)
+                                                     for scenario, panel_paths, style, page_path in jobs]))
@@ -2,8 +2,24 @@
 import os
 import json
 import time
-from gigachat import GigaChat
-from gigachat.models import Chat, Messages, MessagesRole
+import threading
+from concurrent.futures import as_completed
+from utils.rate_limit import RateLimiter
+from utils.cache import get_cache, content_hash
+from utils.text_chunks import PAGE_BREAK, HEADING_MARK, split_into_chunks, strip_heading_marks, estimate_tokens
+from utils.json_repair import parse_json, check_fields
+from utils import tracing
+
+# Сценарий страницы — 4 кадра (см. prompts/scripter_prompt.txt).
+SCENES_PER_PAGE = 4
+# Сколько раз сжимать выжимку длинного документа, если она сама не укладывается в порог map-reduce.
+MAX_REDUCE_ROUNDS = 3
+# Обязательные поля элементов ответов модели: без них элемент отбрасывается (и при необходимости дозапрашивается).
+THEME_SCHEMA = {"theme_summary": str}
+TOPIC_SCHEMA = {"topic_summary": str}
+CHARACTER_SCHEMA = {"name": str, "description": str}
+BIBLE_SCHEMA = {"main_location": str, "main_characters": list}
+SCENE_SCHEMA = {"image_prompt": str, "dialogue": (str, list, dict)}
 
 def is_predominantly_cyrillic(text: str, threshold: float = 0.7) -> bool:
     if not text or not text.strip(): return False
@@ -20,11 +36,24 @@ def is_predominantly_latin(text: str, threshold: float = 0.7) -> bool:
     return (latin_chars / total_letters) >= threshold
 
 class ScripterAgent:
-    def __init__(self):
+    def __init__(self, max_parallel: int = 4, requests_per_second: float = 2.0, map_reduce_threshold_tokens: int = 6000, chunk_tokens: int = 3000):
         print("Загрузка агента-сценариста...")
         self.script_prompt_template = self._load_prompt_template("scripter_prompt.txt")
         self.theme_prompt_template = self._load_prompt_template("theme_extractor_prompt.txt")
         self.global_char_prompt_template = self._load_prompt_template("global_character_prompt.txt")
+        self.chunk_summary_prompt_template = self._load_prompt_template("chunk_summary_prompt.txt")
+        self.missing_parts_prompt_template = self._load_prompt_template("missing_parts_prompt.txt")
+        # Документы длиннее порога анализируются по кускам (map-reduce); сводки кусков кэшируются на диске.
+        self.map_reduce_threshold_tokens = map_reduce_threshold_tokens
+        self.chunk_tokens = chunk_tokens
+        self.chunk_cache = get_cache("chunks", default_max_mb=32)
+        # Один долгоживущий клиент GigaChat на агента: токен и соединения переиспользуются между вызовами.
+        self._client = None
+        self._client_lock = threading.Lock()
+        # Не больше max_parallel одновременных запросов к LLM и не чаще requests_per_second в секунду.
+        self.max_parallel = max(1, max_parallel)
+        self._executor = tracing.ContextThreadPool(max_workers=self.max_parallel, thread_name_prefix="gigachat")
+        self._rate_limiter = RateLimiter(requests_per_second, burst=self.max_parallel)
 
     def _load_prompt_template(self, filename: str):
         current_dir = os.path.dirname(os.path.abspath(__file__)); filepath = os.path.join(current_dir, '..', 'prompts', filename)
@@ -33,26 +62,52 @@ class ScripterAgent:
         except FileNotFoundError:
             print(f"ОШИБКА: Файл с промптом не найден: {filepath}"); return None
         
-    def _clean_and_filter_text(self, text: str) -> str:
+    def _clean_and_filter_text(self, text: str, keep_page_breaks: bool = False) -> str:
         print("Очистка и фильтрация всего документа (сохраняем RU/EN)...")
-        text_no_breaks = text.replace("--- Page Break ---", "\n"); cleaned_lines = []
+        text_no_breaks = text if keep_page_breaks else text.replace(PAGE_BREAK, "\n"); cleaned_lines = []
         for line in text_no_breaks.split('\n'):
-            if not (is_predominantly_cyrillic(line) or is_predominantly_latin(line)):
+            if keep_page_breaks and line.strip() == PAGE_BREAK: cleaned_lines.append(PAGE_BREAK); continue
+            content = line.removeprefix(HEADING_MARK)
+            if not (is_predominantly_cyrillic(content) or is_predominantly_latin(content)):
                 if line.strip(): print(f"    Фильтрую строку на другом языке: {line[:70]}...")
                 continue
-            alpha_chars = sum(c.isalpha() for c in line); total_chars = sum(1 for c in line if not c.isspace())
+            alpha_chars = sum(c.isalpha() for c in content); total_chars = sum(1 for c in content if not c.isspace())
             if total_chars > 5 and (alpha_chars / total_chars < 0.6): print(f"    Фильтрую OCR-мусор: {line}"); continue
             cleaned_lines.append(line)
         return "\n".join(cleaned_lines)
     
+    def _get_client(self):
+        """
+        Создает клиента GigaChat при первом обращении; токен он обновляет сам по истечении срока.
+        Пакет gigachat (httpx, pydantic) импортируется здесь же, а не при загрузке агента.
+        """
+        with self._client_lock:
+            if self._client is None:
+                from gigachat import GigaChat
+                credentials = os.getenv("GIGACHAT_CREDENTIALS")
+                if not credentials: raise ValueError("GIGACHAT_CREDENTIALS не найдены.")
+                self._client = GigaChat(credentials=credentials, verify_ssl_certs=False)
+            return self._client
+
+    @tracing.traced("gigachat.call")
     def _call_giga_chat(self, prompt: str, temperature: float = 0.7) -> str:
         """Универсальная функция для вызова GigaChat."""
-        credentials = os.getenv("GIGACHAT_CREDENTIALS")
-        if not credentials: raise ValueError("GIGACHAT_CREDENTIALS не найдены.")
-        with GigaChat(credentials=credentials, verify_ssl_certs=False) as giga:
-            chat = Chat(messages=[Messages(role=MessagesRole.USER, content=prompt)], temperature=temperature, max_tokens=2000)
-            response = giga.chat(chat)
-            return response.choices[0].message.content
+        from gigachat.models import Chat, Messages, MessagesRole
+        giga = self._get_client()
+        chat = Chat(messages=[Messages(role=MessagesRole.USER, content=prompt)], temperature=temperature, max_tokens=2000)
+        self._rate_limiter.acquire()
+        response = giga.chat(chat)
+        content = response.choices[0].message.content
+        tracing.current_span().add(bytes=len(prompt.encode('utf-8')) + len(content.encode('utf-8')))
+        return content
+
+    def close(self):
+        """Закрывает соединения клиента GigaChat и пул потоков."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        with self._client_lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
 
     def _extract_themes(self, document_text: str, num_themes: int) -> list[dict]:
         """Этап 1: Вызывает GigaChat для выделения заданного числа тем."""
@@ -64,17 +119,85 @@ class ScripterAgent:
         filled_prompt = self.theme_prompt_template.format(document_text=document_text, num_themes=num_themes)
         
         try:
-            response_str = self._call_giga_chat(filled_prompt, temperature=0.5)
-            start = response_str.find('[')
-            end = response_str.rfind(']') + 1
-            if start == -1 or end == 0: raise ValueError("JSON-массив не найден")
-            themes = json.loads(response_str[start:end])
+            repairs = []
+            themes = parse_json(self._call_giga_chat(filled_prompt, temperature=0.5), list, repairs)
+            if themes is None: raise ValueError("JSON-массив не найден")
+            if repairs: print(f"  Ответ исправлен: {', '.join(repairs)}.")
+            themes = [theme for theme in themes if not check_fields(theme, THEME_SCHEMA)]
+            if "truncated" in repairs and len(themes) < num_themes:
+                titles = {theme.get("theme_title") for theme in themes}
+                more = self._request_missing(filled_prompt, themes, f"еще {num_themes - len(themes)} тем(ы) — JSON-массив", list, 0.5) or []
+                themes += [theme for theme in more if not check_fields(theme, THEME_SCHEMA) and theme.get("theme_title") not in titles]
+                themes = themes[:num_themes]
             print(f"  Успешно выделено {len(themes)} тем.")
             return themes
         except Exception as e:
             print(f"  ОШИБКА при выделении тем: {e}")
             return []
+
+    def _request_missing(self, original_prompt: str, partial, missing: str, expect: type, temperature: float):
+        """
+        Дозапрос только недостающей части ответа (оборванного по лимиту или с испорченными элементами)
+        вместо повторной генерации целиком. Возвращает разобранный JSON типа expect или None.
+        """
+        if not self.missing_parts_prompt_template: return None
+        print(f"      Дозапрашиваю только недостающее: {missing}")
+        prompt = self.missing_parts_prompt_template.format(
+            original_prompt=original_prompt, partial_json=json.dumps(partial, ensure_ascii=False, indent=2), missing=missing)
+        try:
+            return parse_json(self._call_giga_chat(prompt, temperature=temperature), expect)
+        except Exception as e:
+            print(f"      ОШИБКА дозапроса: {e}")
+            return None
     
+    def _summarize_chunk(self, chunk_text: str) -> list[dict]:
+        """Map-этап: темы одного куска документа. Результат кэшируется по хэшу куска и промпта."""
+        cache_key = content_hash(self.chunk_summary_prompt_template, chunk_text)
+        cached = self.chunk_cache.get_text(cache_key)
+        if cached is not None: return json.loads(cached)
+
+        filled_prompt = self.chunk_summary_prompt_template.format(chunk_text=chunk_text)
+        try:
+            topics = parse_json(self._call_giga_chat(filled_prompt, temperature=0.3), list)
+            if topics is None: raise ValueError("JSON-массив не найден")
+            topics = [t for t in topics if not check_fields(t, TOPIC_SCHEMA)]
+        except Exception as e:
+            print(f"    ОШИБКА при обработке фрагмента: {e}")
+            return []
+        self.chunk_cache.put_text(cache_key, json.dumps(topics, ensure_ascii=False))
+        return topics
+
+    def _summarize_chunks(self, chunks: list[str]) -> str:
+        """Параллельно получает темы каждого куска и склеивает их в выжимку."""
+        digest_parts = []
+        for topics in self._executor.map(self._summarize_chunk, chunks):
+            for topic in topics:
+                digest_parts.append(f"{topic.get('topic_title', '').strip()}\n{topic['topic_summary'].strip()}")
+        print(f"  Собрано {len(digest_parts)} тем-кандидатов из {len(chunks)} фрагментов.")
+        return "\n\n".join(digest_parts)
+
+    def _build_document_digest(self, marked_document: str) -> str:
+        """
+        Map-этап для длинных документов: режет текст на куски по заголовкам и страницам,
+        параллельно получает темы каждого куска и склеивает их в сжатую выжимку документа.
+        Если выжимка сама длиннее порога, она так же режется и сжимается еще раз (иерархический reduce),
+        пока не уложится в порог, но не больше MAX_REDUCE_ROUNDS раз и пока выжимка сокращается.
+        """
+        chunks = [strip_heading_marks(chunk) for chunk in split_into_chunks(marked_document, max_tokens=self.chunk_tokens)]
+        print(f"  Документ длинный: анализ по {len(chunks)} фрагментам (map-reduce)...")
+        digest = self._summarize_chunks(chunks)
+        for level in range(1, MAX_REDUCE_ROUNDS + 1):
+            tokens = estimate_tokens(digest)
+            if tokens <= self.map_reduce_threshold_tokens: break
+            chunks = split_into_chunks(digest, max_tokens=self.chunk_tokens)
+            print(f"  Выжимка длиннее порога (~{tokens} токенов): сжатие, уровень {level}, фрагментов {len(chunks)}...")
+            reduced = self._summarize_chunks(chunks)
+            if not reduced or estimate_tokens(reduced) >= tokens:
+                print("  Выжимка больше не сокращается, используется текущая.")
+                break
+            digest = reduced
+        return digest
+
     def _create_global_story_bible(self, document_text: str) -> list | None:
         """Шаг 0, "Кастинг". Создает глобальных персонажей."""
         print("  Шаг 0: Создание глобальных персонажей для всего комикса...")
@@ -83,11 +206,11 @@ class ScripterAgent:
         filled_prompt = self.global_char_prompt_template.format(document_text=document_text)
         try:
             response_str = self._call_giga_chat(filled_prompt)
-            start = response_str.find('{')
-            end = response_str.rfind('}') + 1
-            if start == -1 or end == 0: raise ValueError("JSON-объект не найден")
-            bible = json.loads(response_str[start:end])
-            characters = bible.get("main_characters")
+            bible = parse_json(response_str, dict)
+            # Модель иногда отвечает сразу списком персонажей, без обертки {"main_characters": [...]}.
+            characters = bible.get("main_characters") if bible and "main_characters" in bible else parse_json(response_str, list)
+            if characters is None: raise ValueError("JSON с персонажами не найден")
+            characters = [c for c in characters if not check_fields(c, CHARACTER_SCHEMA)] if isinstance(characters, list) else []
             if characters: print(f"  Успешно создано {len(characters)} глобальных персонажей."); return characters
             return None
         except Exception as e:
@@ -110,54 +233,126 @@ class ScripterAgent:
         for attempt in range(max_retries):
             print(f"      Попытка {attempt + 1}/{max_retries}...");
             try:
-                response_str = self._call_giga_chat(filled_prompt, temperature=0.7 + (attempt*0.1))
-                start = response_str.find('{')
-                end = response_str.rfind('}') + 1
-                if start == -1 or end == 0: raise ValueError("JSON-объект не найден")
-                parsed_json = json.loads(response_str[start:end])
+                temperature = 0.7 + (attempt*0.1)
+                repairs = []
+                parsed_json = parse_json(self._call_giga_chat(filled_prompt, temperature=temperature), dict, repairs)
+                if parsed_json is None: raise ValueError("JSON-объект не найден")
+                if repairs: print(f"      Ответ исправлен: {', '.join(repairs)}.")
+                parsed_json = self._complete_scenario(parsed_json, filled_prompt, global_characters, temperature)
+                if not parsed_json["scenes"]: raise ValueError("в сценарии нет ни одной годной сцены")
                 print("      Успешная генерация и парсинг JSON!")
                 return parsed_json
-            except (json.JSONDecodeError, ValueError) as e:
+            except ValueError as e:
                 print(f"      ОШИБКА парсинга JSON на попытке {attempt + 1}: {e}")
                 if attempt < max_retries - 1: print("      Пробую сгенерировать заново..."); time.sleep(1)
                 else: print("      Достигнут лимит попыток."); return {}
         return {}
 
-    def generate_themed_scripts(self, document_text: str, style: str, audience: str, max_pages: int, use_consistent_characters: bool = False) -> list[dict]:
-        """Главный метод, который теперь принимает max_pages от пользователя."""
-        if not document_text.strip(): return []
-        
-        cleaned_document = self._clean_and_filter_text(document_text)
+    def _complete_scenario(self, scenario: dict, filled_prompt: str, global_characters: list | None, temperature: float) -> dict:
+        """
+        Проверяет сценарий по схеме: оставляет годные сцены (не больше SCENES_PER_PAGE) и персонажей,
+        без story_bible подставляет общих персонажей. Если сцен не хватает или story_bible неполна,
+        дозапрашивает только недостающее. Пустые location/characters сцен берутся из story_bible.
+        """
+        bible = scenario.get("story_bible") if isinstance(scenario.get("story_bible"), dict) else {}
+        characters = bible.get("main_characters") if isinstance(bible.get("main_characters"), list) else []
+        bible["main_characters"] = [c for c in characters if not check_fields(c, CHARACTER_SCHEMA)] or list(global_characters or [])
+        scenes = scenario.get("scenes") if isinstance(scenario.get("scenes"), list) else []
+        scenes = [scene for scene in scenes if not check_fields(scene, SCENE_SCHEMA)][:SCENES_PER_PAGE]
+
+        missing = []
+        if check_fields(bible, BIBLE_SCHEMA): missing.append('"story_bible" (' + ", ".join(check_fields(bible, BIBLE_SCHEMA)) + ")")
+        if len(scenes) < SCENES_PER_PAGE:
+            missing.append(f'сцены {", ".join(str(k) for k in range(len(scenes) + 1, SCENES_PER_PAGE + 1))} в ключе "scenes"')
+        if missing:
+            partial = {**scenario, "story_bible": bible, "scenes": scenes}
+            extra = self._request_missing(filled_prompt, partial, " и ".join(missing) + " — JSON-объект", dict, temperature) or {}
+            extra_bible = extra.get("story_bible") if isinstance(extra.get("story_bible"), dict) else {}
+            for field in check_fields(bible, BIBLE_SCHEMA):
+                if not check_fields(extra_bible, {field: BIBLE_SCHEMA[field]}): bible[field] = extra_bible[field]
+            extra_scenes = extra.get("scenes") if isinstance(extra.get("scenes"), list) else []
+            scenes += [scene for scene in extra_scenes if not check_fields(scene, SCENE_SCHEMA)][:SCENES_PER_PAGE - len(scenes)]
+
+        names = ", ".join(c.get("name", "") for c in bible["main_characters"] if isinstance(c, dict))
+        for k, scene in enumerate(scenes):
+            scene["panel"] = k + 1
+            if not scene.get("location"): scene["location"] = bible.get("main_location", "")
+            if not scene.get("characters"): scene["characters"] = names
+        return {**scenario, "story_bible": bible, "scenes": scenes}
+
+    def create_page_script(self, theme: dict, page_number: int, style: str, audience: str, global_characters: list = None) -> dict | None:
+        """Сценарий одной страницы по теме (с заголовком, сводкой и номером страницы) или None."""
+        script = self._create_scenario_from_summary(theme.get("theme_summary"), style, audience, global_characters=global_characters)
+        if not script or not script.get("scenes"):
+            print(f"  Не удалось сгенерировать сценарий для темы {page_number}.")
+            return None
+        script['title'] = theme.get('theme_title', f"Комикс по теме {page_number}")
+        script['summary'] = theme.get("theme_summary")
+        script['page_number'] = page_number
+        return script
+
+    def analyze_document(self, document_text: str, max_pages: int, use_consistent_characters: bool = False) -> tuple[list[dict], list | None]:
+        """Темы страниц и (если нужны) общие персонажи документа; ([], None), если текста слишком мало."""
+        if not document_text.strip(): return [], None
+
+        marked_document = self._clean_and_filter_text(document_text, keep_page_breaks=True)
+        # Разрывы страниц и метки заголовков остаются только в marked_document (для нарезки на куски).
+        cleaned_document = strip_heading_marks("\n".join(line for line in marked_document.split("\n") if line != PAGE_BREAK))
         if len(cleaned_document) < 200:
             print("Мало текста после очистки.")
-            return []
-        
-        global_characters = None
-        if use_consistent_characters:
-            global_characters = self._create_global_story_bible(cleaned_document)
-            if not global_characters:
-                print("  ПРЕДУПРЕЖДЕНИЕ: Не удалось создать глобальных персонажей.")
+            return [], None
+
+        # Длинный документ не помещается в один промпт: темы сводятся (reduce) из выжимок фрагментов.
+        analysis_text = cleaned_document
+        if estimate_tokens(cleaned_document) > self.map_reduce_threshold_tokens:
+            analysis_text = self._build_document_digest(marked_document) or cleaned_document
+
+        # "Кастинг" и выделение тем не зависят друг от друга и идут одновременно.
+        characters_future = self._executor.submit(self._create_global_story_bible, analysis_text) if use_consistent_characters else None
+        themes = self._extract_themes(analysis_text, num_themes=max_pages)
+        global_characters = characters_future.result() if characters_future else None
+        if use_consistent_characters and not global_characters:
+            print("  ПРЕДУПРЕЖДЕНИЕ: Не удалось создать глобальных персонажей.")
+        return themes, global_characters
+
+    def iter_themed_scripts(self, document_text: str, style: str, audience: str, max_pages: int, use_consistent_characters: bool = False,
+                            artifacts: dict | None = None, skip_pages=(), on_analysis=None):
+        """
+        Генератор: сценарии тем пишутся параллельно (не больше max_parallel запросов одновременно),
+        каждый отдается сразу после создания, номер страницы — в 'page_number'.
+        В artifacts (если передан) записываются темы и общие персонажи — для перегенерации отдельных страниц;
+        on_analysis(artifacts) вызывается сразу после анализа, до сценариев. Если темы в artifacts уже есть
+        (продолжение прерванного запуска), документ заново не анализируется, а страницы skip_pages пропускаются.
+        """
+        if artifacts and artifacts.get("themes"):
+            themes, global_characters = artifacts["themes"], artifacts.get("global_characters")
+        else:
+            themes, global_characters = self.analyze_document(document_text, max_pages, use_consistent_characters)
+            if artifacts is not None: artifacts.update(themes=themes, global_characters=global_characters)
+            if on_analysis: on_analysis({"themes": themes, "global_characters": global_characters})
 
-        themes = self._extract_themes(cleaned_document, num_themes=max_pages)
         if not themes:
             print("Не удалось выделить темы.")
-            return []
+            return
             
-        all_scenarios = []
+        futures = []
         for i, theme in enumerate(themes):
+            if i + 1 in skip_pages: continue
             print(f"\n--- Обработка темы {i+1}/{len(themes)}: '{theme.get('theme_title', 'Без названия')}' ---")
             theme_summary = theme.get("theme_summary")
             if not theme_summary:
                 print("  Пропуск темы без содержания.")
                 continue
-            
-            script = self._create_scenario_from_summary(theme_summary, style, audience, global_characters=global_characters)
-            
-            if script and script.get("scenes"):
-                script['title'] = theme.get('theme_title', f"Комикс по теме {i+1}")
-                script['summary'] = theme_summary
-                all_scenarios.append(script)
-            else:
-                print(f"  Не удалось сгенерировать сценарий для темы.")
-                
-        return all_scenarios
\ No newline at end of file
+            futures.append(self._executor.submit(self.create_page_script, theme, i + 1, style, audience, global_characters))
+
+        try:
+            for future in as_completed(futures):
+                script = future.result()
+                if script: yield script
+        finally:
+            for future in futures: future.cancel()
+
+    def generate_themed_scripts(self, document_text: str, style: str, audience: str, max_pages: int, use_consistent_characters: bool = False) -> list[dict]:
+        """Главный метод, который теперь принимает max_pages от пользователя."""
+        scripts = self.iter_themed_scripts(document_text, style, audience, max_pages, use_consistent_characters)
+        return sorted(scripts, key=lambda script: script['page_number'])
@@ -1,15 +1,25 @@
 # srcs/app.py
 import streamlit as st
 import os
+import json
+import shutil
+import tempfile
 from dotenv import load_dotenv
-from io import BytesIO
 
 load_dotenv()
 
 from agents.ingestor_agent import IngestorAgent
 from agents.scripter_agent import ScripterAgent
-from agents.artist_agent import load_artist_models, generate_panel_image
-from agents.layout_agent import create_comic_page
+from agents.artist_agent import load_artist_models, create_draft_client, STYLE_KEYWORDS
+from jobs import ComicJob, JobRunner, RegenerateJob
+from utils import tracing
+from utils.memory_budget import MemoryBudget, page_bytes
+
+# Лимит памяти сессии на PNG готовых страниц (МБ); сверх него страницы читаются с диска. 0 — без лимита.
+SESSION_MEMORY_MB = float(os.getenv("COMICS_SESSION_MEMORY_MB", "0"))
+UPLOAD_CHUNK = 1024 * 1024
+# Общая папка загрузок: у каждой задачи свой файл, задача удаляет его, как только документ прочитан.
+UPLOAD_DIR = os.path.join(tempfile.gettempdir(), "comics-uploads")
 
 st.set_page_config(layout="wide")
 st.title("AI-конвертер документов в комиксы 📜➡️🖼️")
@@ -18,82 +28,166 @@ if 'comic_generated' not in st.session_state:
     st.session_state.comic_generated = False
 if 'generated_pages' not in st.session_state:
     st.session_state.generated_pages = []
+if 'regen_jobs' not in st.session_state:
+    st.session_state.regen_jobs = {}
+if 'memory_budget' not in st.session_state:
+    st.session_state.memory_budget = MemoryBudget(SESSION_MEMORY_MB)
 
 @st.cache_resource
 def load_all_models():
-    print("Загрузка всех агентов и клиентов..."); ingestor = IngestorAgent(); scripter = ScripterAgent(); artist_client = load_artist_models()
+    print("Загрузка всех агентов и клиентов..."); ingestor = IngestorAgent(ocr_workers=int(os.getenv("OCR_WORKERS", "1")), ocr_batch_size=int(os.getenv("OCR_BATCH_SIZE", "2"))); scripter = ScripterAgent(max_parallel=int(os.getenv("GIGACHAT_MAX_PARALLEL", "4")), requests_per_second=float(os.getenv("GIGACHAT_REQUESTS_PER_SECOND", "2"))); artist_client = load_artist_models()
+    # OCR модель грузится при первом скане; OCR_WARMUP=1 загружает ее в фоне сразу, не задерживая интерфейс.
+    if os.getenv("OCR_WARMUP", "0") == "1": ingestor.warm_up()
     print("Все агенты и клиенты готовы."); return ingestor, scripter, artist_client
 
 ingestor_agent, scripter_agent, artist_client = load_all_models()
 
 st.sidebar.header("Настройки комикса")
-style_choice = st.sidebar.selectbox("1. Выберите стиль комикса:", ("Американский комикс 80-х", "Современная манга", "Нуарный детектив", "Детская иллюстрация"))
+style_choice = st.sidebar.selectbox("1. Выберите стиль комикса:", tuple(STYLE_KEYWORDS))
 audience_choice = st.sidebar.selectbox("2. Выберите целевую аудиторию:", ("Для детей 10 лет", "Для подростков", "Для взрослых экспертов"))
 max_pages_choice = st.sidebar.slider("3. Количество страниц:", min_value=1, max_value=5, value=3, help="Выберите, сколько тематических страниц комикса сгенерировать.")
 consistent_chars = st.sidebar.checkbox("Единые персонажи для всего комикса", value=True, help="Если включено, AI придумает одних и тех же героев для всех страниц.")
-STYLE_KEYWORDS = {
-    "Американский комикс 80-х": "80s comic book art, character-focused, bold outlines, halftone shading",
-    "Современная манга": "dynamic black and white manga art, clean sharp lines, screentone shading, character-focused",
-    "Нуарный детектив": "cinematic noir comic art, high-contrast black and white, dramatic chiaroscuro lighting",
-    "Детская иллюстрация": "charming children's book illustration, cute cartoon style, simple characters, pastel colors"
-}
+draft_mode = st.sidebar.checkbox("Черновик: кадры рисуются локально", value=artist_client is None,
+                                 help="Мгновенные кадры без сети (DRAFT_BACKEND); черновые кадры потом можно перерисовать в Kandinsky кнопкой под страницей.")
+# Замеры включаются для задач этой сессии; у других пользователей трассировка не меняется.
+trace_jobs = st.sidebar.checkbox("Замерять время этапов", value=tracing.is_enabled(), help="OCR, запросы к GigaChat и Kandinsky, верстка: время, объем данных, повторы и пик памяти.")
+if artist_client:
+    image_cache_stats = artist_client.cache_stats()
+    if image_cache_stats:
+        st.sidebar.caption(f"Кэш изображений: {image_cache_stats['entries']} шт., hit rate {image_cache_stats['hit_rate']:.0%}")
+
+@st.cache_resource
+def get_draft_client():
+    return create_draft_client()
+
+draft_client = get_draft_client()
+
+@st.cache_resource
+def get_job_runner():
+    return JobRunner(ingestor_agent, scripter_agent, artist_client, max_jobs=int(os.getenv("COMIC_MAX_JOBS", "2")), draft_client=draft_client)
+
+job_runner = get_job_runner()
 
 uploaded_file = st.file_uploader("Загрузите ваш PDF документ", type="pdf")
-temp_pdf_path = "temp_uploaded_file.pdf"
 
 if uploaded_file is not None:
-    with open(temp_pdf_path, "wb") as f: f.write(uploaded_file.getbuffer())
-
     if st.button("✨ Создать комикс!", key="generate_button"):
+        previous_job = job_runner.get(st.session_state.get("job_id"))
+        if previous_job: previous_job.release()
+        # PDF копируется кусками, без лишней копии в памяти, и дальше fitz читает его с диска.
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        uploaded_file.seek(0)
+        with tempfile.NamedTemporaryFile(suffix=".pdf", dir=UPLOAD_DIR, delete=False) as f:
+            shutil.copyfileobj(uploaded_file, f, UPLOAD_CHUNK)
+        job = ComicJob(f.name, style_choice, audience_choice, max_pages_choice, use_consistent_characters=consistent_chars,
+                       draft=draft_mode, memory=st.session_state.memory_budget,
+                       trace=trace_jobs)
+        st.session_state.job_id = job_runner.submit(job)
         st.session_state.comic_generated = False
         st.session_state.generated_pages = []
-        
-        with st.spinner("Шаг 1/N: Читаю и распознаю документ..."):
-            document_text = ingestor_agent.process_pdf(temp_pdf_path)
-        st.success("Документ успешно прочитан!")
-        
-        with st.spinner("Шаг 2/N: Анализирую документ и пишу сценарии по темам..."):
-            scenarios = scripter_agent.generate_themed_scripts(document_text, style_choice, audience_choice, max_pages=max_pages_choice, use_consistent_characters=consistent_chars)
-        
-        if not scenarios:
-            st.error("Не удалось сгенерировать ни одного сценария.")
-        else:
-            st.success(f"Сценарии для {len(scenarios)} страниц комикса готовы!")
-            
-            all_pages_data = []
-            for i, scenario in enumerate(scenarios):
-                page_num = i + 1
-                with st.spinner(f"Генерация страницы {page_num}/{len(scenarios)}: \"{scenario.get('title', '')}\"..."):
-                    if scenario and scenario.get("scenes"):
-                        images = []
-                        for j, scene in enumerate(scenario["scenes"]):
-                            style_keywords = STYLE_KEYWORDS.get(style_choice, "comic book style")
-                            generated_image = generate_panel_image(client=artist_client, scenario=scenario, scene_index=j, style_keywords=style_keywords)
-                            images.append(generated_image)
-                        final_comic_page = create_comic_page(scenario, images, style_choice)
-                        page_filename = f"comic_page_{page_num}_{style_choice.replace(' ', '_')}.png"
-                        all_pages_data.append((final_comic_page, page_filename))
-            st.session_state.generated_pages = all_pages_data
-            st.session_state.comic_generated = True
+        st.session_state.regen_jobs = {}
+
+def show_pages(pages: list[dict], with_downloads: bool):
+    for i, page in enumerate(pages):
+        caption = (f"Страница {i+1}" if with_downloads else page["title"]) + (" (черновик)" if page.get("draft_panels") else "")
+        png = page_bytes(page)
+        if png is None:
+            st.info(f"{caption}: файл удален по сроку хранения, сгенерируйте комикс заново.")
+            continue
+        st.image(png, caption=caption, use_column_width=True)
+        if page.get("failed_panels"):
+            st.warning("Не удалось нарисовать кадры: " + ", ".join(str(k + 1) for k in page["failed_panels"]) + " (на странице — красные заглушки).")
+        if with_downloads:
+            st.download_button(
+                label=f"📥 Скачать страницу {i+1}",
+                data=png,
+                file_name=page["filename"],
+                mime="image/png",
+                key=f"download_button_{i}"
+            )
+            show_regenerate_controls(i, page)
+            st.markdown("---")
+
+def show_regenerate_controls(i: int, page: dict):
+    """Перерисовка одного кадра или страницы по сохраненным артефактам запуска: без OCR и без остальных страниц, в фоне."""
+    regen_job = job_runner.get(st.session_state.regen_jobs.get(i))
+    if regen_job is not None and not regen_job.finished:
+        show_regenerate_progress(regen_job.job_id)
+        return
+    if regen_job is not None:
+        del st.session_state.regen_jobs[i]
+        if regen_job.status == "done":
+            st.session_state.generated_pages[i] = regen_job.info
+            st.rerun()
+        st.error(f"Не удалось перерисовать: {regen_job.error}")
+
+    failed, drafts = set(page.get("failed_panels", [])), set(page.get("draft_panels", []))
+    # Черновые кадры перерисовываются Kandinsky отдельным пунктом; остальное — тем же бэкендом, что и генерация.
+    finalize = bool(drafts and artist_client)
+    options = ["Все кадры страницы", "Новый сценарий и все кадры"] + [
+        f"Кадр {k+1}" + (" — ошибка генерации" if k in failed else " — черновик" if k in drafts else "") for k in range(page["panels"])]
+    if finalize: options.append(f"Финальная отрисовка черновых кадров (Kandinsky, {len(drafts)} шт.)")
+    label = f"🔄 Перерисовать страницу {i+1}" + (f" (кадров с ошибкой: {len(failed)})" if failed else "")
+    with st.expander(label, expanded=bool(failed)):
+        index = min(failed) + 2 if failed else len(options) - 1 if finalize else 0
+        choice = st.selectbox("Что перерисовать:", range(len(options)), index=index, format_func=options.__getitem__, key=f"regen_choice_{i}")
+        if not st.button("Перерисовать", key=f"regen_button_{i}"): return
+        if finalize and choice == len(options) - 1: action, scene_indices = "finalize", None
+        elif choice == 0: action, scene_indices = "panels", None
+        elif choice == 1: action, scene_indices = "rewrite", None
+        else: action, scene_indices = "panels", [choice - 2]
+        job = RegenerateJob(page["run_id"], page["page_number"], action, scene_indices, draft=bool(drafts) or artist_client is None)
+        st.session_state.regen_jobs[i] = job_runner.submit(job)
+        st.rerun()
+
+@st.fragment(run_every=1.0)
+def show_regenerate_progress(job_id: str):
+    """Опрашивает перерисовку страницы раз в секунду; по завершении перезапускает скрипт, чтобы показать новую страницу."""
+    job = job_runner.get(job_id)
+    if job is None or job.finished:
+        st.rerun()
+    st.info(job.stage)
+
+@st.fragment(run_every=1.0)
+def show_job_progress(job_id: str):
+    """Опрашивает фоновую задачу раз в секунду, перерисовывая только этот блок, а не всю страницу."""
+    job = job_runner.get(job_id)
+    if job is None: return
+    snapshot = job.snapshot()
+    if job.finished:
+        st.rerun()
+    st.info(snapshot["stage"])
+    if snapshot["pages"]:
+        st.caption(f"Готово страниц: {len(snapshot['pages'])} из {snapshot['max_pages']} (первая — через {snapshot['first_page_s']:.0f} с)")
+        show_pages(snapshot["pages"], with_downloads=False)
+    if st.button("⏹ Остановить", key="cancel_button"): job.cancel()
+
+current_job = job_runner.get(st.session_state.get("job_id"))
+if current_job is not None and not current_job.finished:
+    show_job_progress(current_job.job_id)
+elif current_job is not None and not st.session_state.comic_generated:
+    snapshot = current_job.snapshot()
+    if snapshot["status"] == "failed": st.error(snapshot["error"])
+    elif snapshot["status"] == "cancelled": st.warning("Генерация остановлена.")
+    if snapshot["pages"]:
+        st.success(f"Готово страниц комикса: {len(snapshot['pages'])}!")
+        st.session_state.generated_pages = [dict(page) for page in snapshot["pages"]]
+        st.session_state.comic_generated = True
+
+if current_job is not None:
+    memory = st.session_state.memory_budget.stats()
+    st.sidebar.caption(f"PNG готовых страниц в памяти сессии: {memory['held_mb']} МБ" + (f" из {memory['limit_mb']} МБ" if memory["limit_mb"] else " (без лимита)")
+                       + (f", выгружено на диск: {memory['spilled_pages']} стр." if memory["spilled_pages"] else ""))
 
+if current_job is not None and current_job.trace and tracing.spans(current_job.job_id):
+    st.sidebar.subheader("Профиль последнего запуска")
+    st.sidebar.dataframe(tracing.summary(current_job.job_id), hide_index=True)
+    st.sidebar.download_button("📥 Трасса (Chrome trace)", data=json.dumps(tracing.chrome_trace(current_job.job_id), ensure_ascii=False),
+                               file_name="comic_trace.json", mime="application/json")
 
 if st.session_state.comic_generated and st.session_state.generated_pages:
     st.markdown("---")
     st.header("Готовые комиксы:")
-    
-    for i, (page_image, page_filename) in enumerate(st.session_state.generated_pages):
-        st.image(page_image, caption=f"Страница {i+1}", use_column_width=True)
-        buf = BytesIO()
-        page_image.save(buf, format="PNG")
-        byte_im = buf.getvalue()
-        st.download_button(
-            label=f"📥 Скачать страницу {i+1}",
-            data=byte_im,
-            file_name=page_filename,
-            mime="image/png",
-            key=f"download_button_{i}"
-        )
-        st.markdown("---")
-
-if os.path.exists(temp_pdf_path):
-    os.remove(temp_pdf_path)
\ No newline at end of file
+    # PNG-байты закодированы один раз в фоновой задаче и переиспользуются при каждом перезапуске скрипта;
+    # страницы сверх лимита памяти сессии читаются с диска.
+    show_pages(st.session_state.generated_pages, with_downloads=True)
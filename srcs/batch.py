@@ -0,0 +1,294 @@
+# srcs/batch.py
+"""
+Пакетная конвертация PDF в комиксы без UI.
+
+    python srcs/batch.py pdf/ -o outputs/batch --pages 3 --jobs 2
+
+Для каждого документа в папке результата создается подпапка с текстом, сценариями и страницами,
+общий отчет — в manifest.json. Повторный запуск продолжает с места остановки: готовые документы
+и уже сверстанные страницы пропускаются.
+"""
+import argparse
+import glob
+import hashlib
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from agents.ingestor_agent import IngestorAgent
+from agents.scripter_agent import ScripterAgent
+from agents.artist_agent import STYLE_KEYWORDS, create_artist_client, create_draft_client, submit_panel_images, collect_panel_images
+from pipeline import ComicRun, encode_png, stream_comic_pages
+from utils.run_store import RunStore
+from utils import tracing
+
+MANIFEST_NAME = "manifest.json"
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""): digest.update(block)
+    return digest.hexdigest()
+
+
+def find_pdfs(inputs: list[str]) -> list[str]:
+    pdf_paths = []
+    for item in inputs:
+        if os.path.isdir(item): pdf_paths.extend(sorted(glob.glob(os.path.join(item, "*.pdf"))))
+        else: pdf_paths.append(item)
+    seen = set()
+    return [path for path in pdf_paths if not (os.path.abspath(path) in seen or seen.add(os.path.abspath(path)))]
+
+
+def document_name(pdf_path: str) -> str:
+    """Имя папки документа в --output и ключ в manifest.json."""
+    return os.path.splitext(os.path.basename(pdf_path))[0]
+
+
+def name_clashes(pdf_paths: list[str]) -> dict[str, list[str]]:
+    """Разные PDF с одинаковым именем файла: их результаты попали бы в одну папку."""
+    by_name = {}
+    for path in pdf_paths: by_name.setdefault(document_name(path), []).append(path)
+    return {name: paths for name, paths in by_name.items() if len(paths) > 1}
+
+
+def positive_int(value: str) -> int:
+    try: number = int(value)
+    except ValueError: raise argparse.ArgumentTypeError(f"нужно целое число >= 1, получено {value!r}")
+    if number < 1: raise argparse.ArgumentTypeError(f"нужно целое число >= 1, получено {value!r}")
+    return number
+
+
+class BatchRunner:
+    """
+    Прогоняет документы через агентов с ограниченным параллелизмом на каждом этапе:
+    jobs документов одновременно, не больше ocr_parallel одновременных OCR, запросы к GigaChat
+    и Kandinsky ограничены пулами самих агентов (общих для всех документов).
+    """
+    def __init__(self, ingestor: IngestorAgent, scripter: ScripterAgent, artist_client, output_dir: str, style: str,
+                 audience: str, max_pages: int, use_consistent_characters: bool = False, ocr_parallel: int = 1,
+                 layout_workers: int | None = None):
+        self.ingestor = ingestor
+        self.scripter = scripter
+        self.artist_client = artist_client
+        self.store = RunStore(output_dir)
+        self.style = style
+        self.settings = {"style": style, "audience": audience, "max_pages": max_pages, "use_consistent_characters": use_consistent_characters}
+        self._ocr_slots = threading.Semaphore(max(1, ocr_parallel))
+        # Процессов для верстки досчитываемых страниц (None — по числу ядер).
+        self.layout_workers = layout_workers
+        self._manifest_lock = threading.Lock()
+        self.manifest = self.store.read_json(MANIFEST_NAME) or {"documents": {}}
+
+    def _update_document(self, name: str, **fields) -> dict:
+        with self._manifest_lock:
+            entry = self.manifest["documents"].setdefault(name, {})
+            entry.update(fields)
+            self.manifest["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            self.store.write_json(MANIFEST_NAME, self.manifest)
+            return dict(entry)
+
+    def _is_done(self, entry: dict | None, sha256: str, doc_run: ComicRun) -> bool:
+        return bool(entry) and entry.get("status") == "done" and entry.get("sha256") == sha256 \
+            and entry.get("settings") == self.settings and all(doc_run.store.exists(page["file"]) for page in entry.get("pages", []))
+
+    def _render_missing_pages(self, doc_run: ComicRun) -> list[dict]:
+        """
+        Страницы с уже написанными сценариями (scenarios/page_<N>.json): готовые берутся с диска, страницы с готовыми
+        кадрами только верстаются, для остальных кадры всех страниц ставятся в пул сразу. Верстка — в пуле процессов
+        (ComicRun.compose_pages), процессы читают кадры с диска.
+        """
+        style_keywords = STYLE_KEYWORDS.get(self.style, "comic book style")
+        pages, pending, compose = [], [], []
+        for page_number in doc_run.page_numbers():
+            if doc_run.has_page(page_number):
+                pages.append(doc_run.page_info(page_number))
+            elif doc_run.has_panels(page_number):
+                compose.append(page_number)
+            else:
+                scenario = doc_run.load_scenario(page_number)
+                pending.append((scenario, submit_panel_images(self.artist_client, scenario, style_keywords)))
+        print(f"  Страниц на диске: {len(pages)}, к верстке: {len(compose)}, к генерации: {len(pending)}.")
+        draft = bool(getattr(self.artist_client, "draft", False))
+        while pending:
+            scenario, panel_futures = pending.pop(0)
+            failed = []
+            panels = collect_panel_images(panel_futures, failed=failed)
+            draft_panels = [k for k in range(len(panels)) if k not in failed] if draft else []
+            doc_run.save_panels(scenario, panels, failed, draft_panels)
+            compose.append(scenario["page_number"])
+            del panels, panel_futures
+        if compose: pages.extend(doc_run.compose_pages(compose, workers=self.layout_workers))
+        return pages
+
+    def process_document(self, pdf_path: str) -> dict:
+        name = document_name(pdf_path)
+        doc_run = ComicRun(self.store.path(name), settings=self.settings)
+        doc_store = doc_run.store
+        sha256 = file_sha256(pdf_path)
+        entry = self.manifest["documents"].get(name)
+        if self._is_done(entry, sha256, doc_run):
+            print(f"[{name}] уже готов, пропуск.")
+            return entry
+        if entry and (entry.get("sha256") != sha256 or entry.get("settings") != self.settings):
+            print(f"[{name}] документ или настройки изменились, начинаю заново.")
+            for artifact in ("text.txt", "themes.json", "characters.json", "scenarios", "panels", "pages"): doc_store.remove(artifact)
+
+        start = time.perf_counter()
+        self._update_document(name, source=os.path.abspath(pdf_path), sha256=sha256, settings=self.settings,
+                              status="running", error=None, output_dir=name)
+        try:
+            document_text = doc_store.read_text("text.txt")
+            if document_text is None:
+                with self._ocr_slots:
+                    document_text = self.ingestor.process_pdf(pdf_path)
+                doc_run.save_text(document_text)
+            if not document_text.strip():
+                return self._update_document(name, status="failed", error="Не удалось извлечь текст.")
+            self._update_document(name, status="ingested")
+
+            # Темы и персонажи сохраняются сразу после анализа, сценарий и страница — по мере готовности каждой страницы.
+            # При продолжении заново пишутся только сценарии страниц, которых нет на диске.
+            themes = doc_store.read_json("themes.json")
+            if not themes:
+                for artifact in ("scenarios", "panels", "pages"): doc_store.remove(artifact)
+            artifacts = {"themes": themes, "global_characters": doc_store.read_json("characters.json")} if themes else {}
+            pages = self._render_missing_pages(doc_run)
+            scripted = {page["page_number"] for page in pages}
+            if not themes or len(scripted) < len(themes):
+                for page in stream_comic_pages(self.scripter, self.artist_client, document_text, self.style,
+                                               self.settings["audience"], self.settings["max_pages"],
+                                               self.settings["use_consistent_characters"], artifacts=artifacts,
+                                               skip_pages=scripted, on_analysis=doc_run.save_analysis):
+                    pages.append(doc_run.save_page(page["scenario"], page["panels"], encode_png(page["image"]),
+                                                   page["failed_panels"], page["draft_panels"]))
+                    print(f"[{name}] страница {page['page_number']} готова ({page['elapsed']:.0f} с).")
+                    del page["image"], page["panels"]
+
+            if not pages:
+                return self._update_document(name, status="failed", error="Не удалось сгенерировать ни одного сценария.")
+            pages.sort(key=lambda page: page["page_number"])
+            return self._update_document(name, status="done", pages=pages, elapsed=round(time.perf_counter() - start, 1))
+        except Exception as e:
+            print(f"[{name}] ОШИБКА: {e}")
+            return self._update_document(name, status="failed", error=str(e), elapsed=round(time.perf_counter() - start, 1))
+
+    def regenerate_page(self, name: str, page_number: int, panel_numbers: list[int] | None = None, rewrite: bool = False) -> dict:
+        """Перерисовывает кадры (или пишет новый сценарий) одной страницы готового документа и обновляет manifest.json."""
+        doc_run = ComicRun.open(name, runs_dir=self.store.root)
+        if rewrite: info = doc_run.rewrite_page(self.scripter, self.artist_client, page_number)
+        else: info = doc_run.regenerate_panels(self.artist_client, page_number, [k - 1 for k in panel_numbers] if panel_numbers else None)
+        self._replace_pages(name, [info])
+        return info
+
+    def finalize_document(self, name: str, page_number: int | None = None) -> list[dict]:
+        """Финальный проход по черновику: черновые кадры страниц (всех или одной) перерисовывает artist_client."""
+        doc_run = ComicRun.open(name, runs_dir=self.store.root)
+        numbers = [page_number] if page_number else doc_run.page_numbers()
+        redrawn = [n for n in numbers if doc_run.load_scenario(n).get("draft_panels")]
+        for n in redrawn: doc_run.finalize_page(self.artist_client, n, compose=False)
+        composed = {info["page_number"]: info for info in doc_run.compose_pages(redrawn, workers=self.layout_workers)} if redrawn else {}
+        infos = [composed.get(n) or doc_run.page_info(n) for n in numbers]
+        self._replace_pages(name, infos)
+        return infos
+
+    def _replace_pages(self, name: str, infos: list[dict]):
+        numbers = {info["page_number"] for info in infos}
+        pages = [page for page in self.manifest["documents"].get(name, {}).get("pages", []) if page["page_number"] not in numbers]
+        self._update_document(name, pages=sorted(pages + infos, key=lambda page: page["page_number"]))
+
+    def run(self, pdf_paths: list[str], jobs: int = 1) -> dict:
+        with ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix="batch") as executor:
+            futures = {executor.submit(self.process_document, pdf_path): pdf_path for pdf_path in pdf_paths}
+            for future in as_completed(futures):
+                entry = future.result()
+                print(f"Документ {os.path.basename(futures[future])}: {entry.get('status')}")
+        return self.manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетная конвертация PDF в комиксы (без UI).")
+    parser.add_argument("inputs", nargs="*", help="PDF-файлы или папки с ними")
+    parser.add_argument("-o", "--output", default=os.path.join("outputs", "batch"), help="папка для результатов и manifest.json")
+    parser.add_argument("--style", choices=tuple(STYLE_KEYWORDS), default=next(iter(STYLE_KEYWORDS)))
+    parser.add_argument("--audience", default="Для подростков")
+    parser.add_argument("--pages", type=positive_int, default=3, help="страниц комикса на документ")
+    parser.add_argument("--consistent-characters", action="store_true", help="единые персонажи для всего комикса")
+    parser.add_argument("--jobs", type=positive_int, default=2, help="документов одновременно")
+    parser.add_argument("--ocr-parallel", type=positive_int, default=1, help="документов одновременно на этапе OCR")
+    parser.add_argument("--layout-workers", type=positive_int, help="процессов для верстки страниц при продолжении и --final (по умолчанию по числу ядер)")
+    parser.add_argument("--trace", help="сохранить замеры этапов: *.jsonl или Chrome trace (*.json)")
+    parser.add_argument("--regenerate", metavar="DOC", help="перерисовать страницу готового документа (имя его папки в --output)")
+    parser.add_argument("--page", type=positive_int, help="номер страницы для --regenerate")
+    parser.add_argument("--panels", type=positive_int, nargs="+", help="номера кадров для --regenerate (по умолчанию все)")
+    parser.add_argument("--rewrite", action="store_true", help="для --regenerate: новый сценарий страницы по сохраненной теме")
+    parser.add_argument("--draft", action="store_true", help="рисовать кадры локальным бэкендом черновиков (DRAFT_BACKEND), без сети")
+    parser.add_argument("--final", action="store_true", help="для --regenerate: перерисовать Kandinsky черновые кадры (всех страниц или --page)")
+    args = parser.parse_args()
+    if args.regenerate and not (args.page or args.final): parser.error("--regenerate требует --page или --final")
+    if not args.regenerate and not args.inputs: parser.error("укажите PDF-файлы или папки")
+    if args.panels and (args.rewrite or args.final): parser.error("--panels нельзя сочетать с --rewrite и --final")
+    if args.regenerate:
+        try:
+            doc_run = ComicRun.open(args.regenerate, runs_dir=args.output)
+            if args.page is not None and args.page not in doc_run.page_numbers():
+                parser.error(f"в {args.regenerate} нет страницы {args.page}, есть: {doc_run.page_numbers() or 'ни одной'}")
+            if args.panels:
+                count = len(doc_run.load_scenario(args.page)["scenes"])
+                wrong = sorted(set(k for k in args.panels if k > count))
+                if wrong: parser.error(f"на странице {args.page} кадров {count}, нет кадров {wrong}")
+        except (FileNotFoundError, KeyError) as e:
+            parser.error(f"не удалось открыть {args.regenerate} в {args.output}: {e}")
+
+    if args.trace: tracing.enable()
+    pdf_paths = find_pdfs(args.inputs)
+    clashes = name_clashes(pdf_paths)
+    if clashes:
+        parser.error("у разных PDF одинаковые имена, их результаты перезаписали бы друг друга; переименуйте файлы:\n" +
+                     "\n".join(f"  {name}: {', '.join(paths)}" for name, paths in clashes.items()))
+    if not pdf_paths and not args.regenerate:
+        print("PDF-файлы не найдены.")
+        return 1
+
+    ingestor = IngestorAgent(ocr_workers=int(os.getenv("OCR_WORKERS", "1")), ocr_batch_size=int(os.getenv("OCR_BATCH_SIZE", "2")))
+    scripter = ScripterAgent(max_parallel=int(os.getenv("GIGACHAT_MAX_PARALLEL", "4")),
+                             requests_per_second=float(os.getenv("GIGACHAT_REQUESTS_PER_SECOND", "2")))
+    artist_client = create_draft_client() if args.draft and not args.final else create_artist_client()
+    if args.final and artist_client is None:
+        print("Для финальной отрисовки нужны ключи FUSION_API_KEY и FUSION_SECRET_KEY.")
+        return 1
+    runner = BatchRunner(ingestor, scripter, artist_client, args.output, args.style, args.audience, args.pages,
+                         args.consistent_characters, ocr_parallel=args.ocr_parallel, layout_workers=args.layout_workers)
+    try:
+        if args.regenerate and args.final:
+            infos = runner.finalize_document(args.regenerate, args.page)
+            print(f"Финальная отрисовка: {len(infos)} стр., черновых кадров осталось {sum(len(info['draft_panels']) for info in infos)}.")
+            return 0
+        if args.regenerate:
+            info = runner.regenerate_page(args.regenerate, args.page, args.panels, rewrite=args.rewrite)
+            print(f"Страница перерисована: {runner.store.path(os.path.join(args.regenerate, info['file']))}")
+            return 0
+        manifest = runner.run(pdf_paths, jobs=args.jobs)
+    finally:
+        ingestor.close(); scripter.close()
+        if artist_client: artist_client.close()
+        if args.trace:
+            for row in tracing.summary():
+                print(f"  {row['stage']}: {row['count']} шт., всего {row['total_s']} с, p50 {row['p50_ms']} мс, p95 {row['p95_ms']} мс, "
+                      f"повторов {row['retries']}, пик RSS {row['peak_rss_mb']} МБ")
+            print(f"Замеры сохранены: {tracing.export(args.trace)}")
+
+    statuses = [manifest["documents"].get(document_name(p), {}).get("status") for p in pdf_paths]
+    print(f"Готово документов: {statuses.count('done')} из {len(pdf_paths)}. Отчет: {runner.store.path(MANIFEST_NAME)}")
+    return 0 if statuses.count('done') == len(pdf_paths) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1 @@
+# Бенчмарки конвейера (запускаются из папки srcs: python -m benchmarks.<имя>)
@@ -0,0 +1,69 @@
+# benchmarks/bench_ingest.py
+"""
+Сравнение режимов IngestorAgent.process_pdf (постранично, пачками, в пуле процессов, из кэша)
+на документах из папки pdf/. Тексты всех режимов должны совпадать.
+
+Запуск из папки srcs:
+    python -m benchmarks.bench_ingest --workers 4 --batch-size 2
+"""
+import argparse
+import glob
+import os
+import tempfile
+import time
+
+import fitz
+
+from agents.ingestor_agent import IngestorAgent
+from utils.cache import DiskLRUCache
+
+PDF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'pdf')
+
+
+def run_mode(ingestor: IngestorAgent, pdf_path: str, workers: int, batch_size: int) -> tuple[str, float]:
+    start = time.perf_counter()
+    text = ingestor.process_pdf(pdf_path, workers=workers, batch_size=batch_size)
+    return text, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк извлечения текста из PDF.")
+    parser.add_argument("pdfs", nargs="*", help="PDF файлы (по умолчанию все из pdf/)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=2)
+    args = parser.parse_args()
+
+    pdf_paths = args.pdfs or sorted(glob.glob(os.path.join(PDF_DIR, "*.pdf")))
+    # Кэш OCR отключен, чтобы сравнивать сами режимы распознавания; отдельно меряется повтор через временный кэш.
+    ingestor = IngestorAgent(use_ocr_cache=False)
+    # Модель загружается заранее, чтобы ее загрузка не попала в замер первого документа.
+    ingestor.warm_up(background=False)
+    rows = []
+    try:
+        for pdf_path in pdf_paths:
+            with fitz.open(pdf_path) as doc:
+                num_pages = len(doc)
+            # Первый прогон параллельного режима прогревает пул, чтобы не учитывать загрузку моделей в воркеры.
+            if args.workers > 1: ingestor.process_pdf(pdf_path, workers=args.workers, batch_size=args.batch_size)
+            single_text, single_time = run_mode(ingestor, pdf_path, 1, 1)
+            batched_text, batched_time = run_mode(ingestor, pdf_path, 1, args.batch_size)
+            par_text, par_time = run_mode(ingestor, pdf_path, args.workers, args.batch_size)
+            with tempfile.TemporaryDirectory() as cache_dir:
+                ingestor.ocr_cache = DiskLRUCache(os.path.join(cache_dir, "ocr.sqlite"))
+                run_mode(ingestor, pdf_path, 1, args.batch_size)
+                cached_text, cached_time = run_mode(ingestor, pdf_path, 1, args.batch_size)
+                ingestor.ocr_cache.close(); ingestor.ocr_cache = None
+            same = single_text == batched_text == par_text == cached_text
+            rows.append((os.path.basename(pdf_path), num_pages, single_time, batched_time, par_time, cached_time, same))
+    finally:
+        ingestor.close()
+
+    print(f"\nстр/с по режимам: по одной странице | пачками по {args.batch_size} | {args.workers} процессов | повтор из кэша")
+    print(f"{'Документ':60} {'стр.':>5} {'по одной':>9} {'пачками':>9} {'паралл.':>9} {'кэш':>9}  совпад.")
+    for name, num_pages, single_time, batched_time, par_time, cached_time, same in rows:
+        rates = " ".join(f"{num_pages / t:9.2f}" for t in (single_time, batched_time, par_time, cached_time))
+        print(f"{name[:60]:60} {num_pages:5d} {rates}  {'да' if same else 'НЕТ'}")
+
+
+if __name__ == '__main__':
+    main()
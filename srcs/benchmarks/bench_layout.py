@@ -0,0 +1,46 @@
+# benchmarks/bench_layout.py
+"""
+Время верстки страницы create_comic_page на синтетических сценариях с диалогами разной длины.
+
+Запуск из папки srcs:
+    python -m benchmarks.bench_layout --pages 30
+"""
+import argparse
+import random
+import time
+
+from PIL import Image
+
+from agents.layout_agent import create_comic_page
+
+WORDS = ("При обнаружении пожара немедленно сообщите по телефону 101 назовите адрес объекта "
+         "место возникновения пожара и свою фамилию примите меры по эвакуации людей").split()
+
+
+def make_scenario(rng: random.Random) -> dict:
+    scenes = [{"dialogue": " ".join(rng.choice(WORDS) for _ in range(rng.choice([5, 15, 30, 60, 120])))} for _ in range(4)]
+    return {"title": " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12))), "scenes": scenes}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк верстки страниц комикса.")
+    parser.add_argument("--pages", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    scenarios = [make_scenario(rng) for _ in range(args.pages)]
+    images = [Image.new('RGB', (1024, 1024), color) for color in ('red', 'green', 'blue', 'grey')]
+
+    timings = []
+    for scenario in scenarios:
+        start = time.perf_counter()
+        create_comic_page(scenario, images, "bench")
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    print(f"{len(timings)} стр.: среднее {1000 * sum(timings) / len(timings):.0f} мс, "
+          f"медиана {1000 * timings[len(timings) // 2]:.0f} мс, максимум {1000 * timings[-1]:.0f} мс")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# benchmarks/bench_pipeline.py
+"""
+Офлайн-бенчмарк конвейера на PDF из папки pdf/ без ключей и сети.
+
+Собственный код (извлечение текста, очистка, разбор ответов LLM, сборка промптов, верстка) меряется
+с мгновенными заглушками, чтобы его регрессии не тонули в задержках внешних API. Затем весь конвейер
+прогоняется с заглушками GigaChat и Kandinsky API, у которых задержка задается распределением.
+
+Запуск из папки srcs:
+    python -m benchmarks.bench_pipeline --llm-latency lognormal:2,0.4 --image-latency lognormal:4,0.3
+    python -m benchmarks.bench_pipeline --responses recorded.jsonl --json bench.json
+"""
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import time
+
+from PIL import Image
+
+from agents.ingestor_agent import IngestorAgent
+from agents.scripter_agent import ScripterAgent
+from agents.artist_agent import STYLE_KEYWORDS, KandinskyAPI, build_panel_prompt, create_draft_client
+from agents.layout_agent import create_comic_page
+from benchmarks.fake_gigachat import FakeGigaChat, RecordingGigaChat, install
+from benchmarks.kandinsky_stub import start_stub_server
+from benchmarks.latency import LatencyModel, latency_row, print_rows
+from pipeline import stream_comic_pages
+from utils import tracing
+
+PDF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'pdf')
+STYLE = next(iter(STYLE_KEYWORDS))
+AUDIENCE = "Для подростков"
+
+
+class _NullCache:
+    def get_text(self, key): return None
+    def put_text(self, key, value): pass
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_own_code(pdf_paths: list[str], max_pages: int, repeat: int, responses_path: str | None, record_path: str | None) -> list[dict]:
+    """Этапы собственного кода; ответы LLM — без задержки (записанные или синтетические)."""
+    ingestor = IngestorAgent(use_ocr_cache=False)
+    ingestor.warm_up(background=False)
+    # Ограничение частоты запросов к LLM снято: здесь меряется только собственный код.
+    scripter = ScripterAgent(requests_per_second=0)
+    if record_path: install(scripter, RecordingGigaChat(scripter._get_client(), record_path))
+    else: install(scripter, FakeGigaChat(latency=0, responses_path=responses_path))
+    # Кэш выжимок фрагментов выключен, чтобы map-этап выполнялся при каждом прогоне.
+    scripter.chunk_cache = _NullCache()
+    panels = [Image.new('RGB', (1024, 1024), color) for color in ('red', 'green', 'blue', 'grey')]
+    durations = {name: [] for name in ("ingest", "clean", "script.themes", "script.scenario", "prompt_build", "layout")}
+    items = dict.fromkeys(durations, 0)
+    try:
+        for pdf_path in pdf_paths:
+            page_stats = []
+            text, seconds = timed(ingestor.process_pdf, pdf_path, page_stats=page_stats)
+            durations["ingest"].append(seconds); items["ingest"] += text.count("--- Page Break ---") + 1
+            for _ in range(max(1, repeat)):
+                cleaned, seconds = timed(scripter._clean_and_filter_text, text, keep_page_breaks=True)
+                durations["clean"].append(seconds); items["clean"] += 1
+            if len(cleaned) < 200: continue
+
+            # Тот же путь, что в конвейере: очистка, для длинных документов — map-reduce выжимка, затем темы.
+            (themes, _), seconds = timed(scripter.analyze_document, text, max_pages)
+            durations["script.themes"].append(seconds); items["script.themes"] += 1
+            for theme in themes:
+                scenario, seconds = timed(scripter._create_scenario_from_summary, theme.get("theme_summary", ""), STYLE, AUDIENCE)
+                durations["script.scenario"].append(seconds); items["script.scenario"] += 1
+                if not scenario.get("scenes"): continue
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    for k in range(len(scenario["scenes"])): build_panel_prompt(scenario, k, STYLE_KEYWORDS[STYLE])
+                    durations["prompt_build"].append(time.perf_counter() - start); items["prompt_build"] += len(scenario["scenes"])
+                scenario.setdefault("title", theme.get("theme_title", ""))
+                _, seconds = timed(create_comic_page, scenario, panels[:len(scenario["scenes"])], STYLE)
+                durations["layout"].append(seconds); items["layout"] += 1
+    finally:
+        ingestor.close(); scripter.close()
+    return [latency_row(name, values, items[name]) for name, values in durations.items() if values]
+
+
+def bench_end_to_end(pdf_paths: list[str], max_pages: int, llm_latency: str, image_latency: str, concurrency: int,
+                     responses_path: str | None, malformed: float = 0.0, image_backend: str = "kandinsky") -> tuple[list[dict], list[dict]]:
+    """
+    Весь конвейер с заглушками внешних API: время до первой страницы, до последней и замеры вызовов API.
+    image_backend="procedural" или "diffusers" рисует кадры локальным бэкендом черновиков вместо заглушки Kandinsky.
+    """
+    ingestor = IngestorAgent()
+    ingestor.warm_up(background=False)
+    scripter = ScripterAgent()
+    install(scripter, FakeGigaChat(latency=llm_latency, responses_path=responses_path, malformed=malformed))
+    server = None
+    if image_backend == "kandinsky":
+        server, base_url = start_stub_server(latency_model=LatencyModel(image_latency, seed=0), max_queue=concurrency)
+        client = KandinskyAPI("bench", "bench", url=base_url, max_concurrency=concurrency)
+    else:
+        client = create_draft_client(image_backend)
+    first_page, all_pages, page_latency = [], [], []
+    tracing.enable(); tracing.reset()
+    try:
+        for pdf_path in pdf_paths:
+            text = ingestor.process_pdf(pdf_path)
+            elapsed = [page["elapsed"] for page in stream_comic_pages(scripter, client, text, STYLE, AUDIENCE, max_pages)]
+            if not elapsed: continue
+            first_page.append(min(elapsed)); all_pages.append(max(elapsed)); page_latency.extend(elapsed)
+    finally:
+        tracing.enable(False)
+        client.close(); ingestor.close(); scripter.close()
+        if server: server.shutdown()
+    rows = [latency_row("e2e.first_page", first_page, len(first_page)),
+            latency_row("e2e.all_pages", all_pages, len(page_latency)),
+            latency_row("e2e.page_ready", page_latency)]
+    upstream = [row for row in tracing.summary() if row["stage"].startswith(("gigachat", client.name))]
+    return rows, upstream
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк конвейера с заглушками GigaChat и Kandinsky API.")
+    parser.add_argument("pdfs", nargs="*", help="PDF файлы (по умолчанию все из pdf/)")
+    parser.add_argument("--max-pages", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5, help="повторов для быстрых этапов (очистка, сборка промптов)")
+    parser.add_argument("--llm-latency", default="lognormal:2,0.4", help="задержка GigaChat: 2 | normal:2,0.5 | lognormal:2,0.4 | uniform:1,3")
+    parser.add_argument("--image-latency", default="lognormal:4,0.3", help="задержка генерации Kandinsky (в том же формате)")
+    parser.add_argument("--concurrency", type=int, default=3, help="одновременных генераций Kandinsky")
+    parser.add_argument("--responses", help="JSONL с записанными ответами GigaChat вместо синтетических")
+    parser.add_argument("--record", help="записать ответы настоящего GigaChat в JSONL (нужны GIGACHAT_CREDENTIALS)")
+    parser.add_argument("--malformed", type=float, default=0.0, help="доля испорченных ответов GigaChat (обрыв, висячая запятая, ```)")
+    parser.add_argument("--image-backend", choices=("kandinsky", "procedural", "diffusers"), default="kandinsky",
+                        help="чем рисовать кадры: заглушка Kandinsky или локальный бэкенд черновиков")
+    parser.add_argument("--skip-e2e", action="store_true", help="только этапы собственного кода")
+    parser.add_argument("--json", help="сохранить результаты в JSON для сравнения между версиями")
+    parser.add_argument("--verbose", action="store_true", help="не скрывать вывод агентов")
+    args = parser.parse_args()
+
+    pdf_paths = args.pdfs or sorted(glob.glob(os.path.join(PDF_DIR, "*.pdf")))
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        own_rows = bench_own_code(pdf_paths, args.max_pages, args.repeat, args.responses, args.record)
+        e2e_rows, upstream_rows = ([], []) if args.skip_e2e else bench_end_to_end(
+            pdf_paths, args.max_pages, args.llm_latency, args.image_latency, args.concurrency, args.record or args.responses, args.malformed, args.image_backend)
+
+    print(f"\nСобственный код ({len(pdf_paths)} док., ответы LLM без задержки):")
+    print_rows(own_rows)
+    if e2e_rows:
+        images = f"Kandinsky {args.image_latency} с, {args.concurrency} генераций одновременно" if args.image_backend == "kandinsky" else f"кадры: {args.image_backend}"
+        print(f"\nКонвейер целиком (GigaChat {args.llm_latency} с, {images}):")
+        print_rows(e2e_rows)
+        print("\nВызовы внешних API (по замерам tracing):")
+        for row in upstream_rows:
+            print(f"  {row['stage']:28} {row['count']:>5} шт., p50 {row['p50_ms']} мс, p95 {row['p95_ms']} мс, повторов {row['retries']}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"settings": vars(args), "own_code": own_rows, "end_to_end": e2e_rows, "upstream": upstream_rows}, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты сохранены: {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# benchmarks/bench_startup.py
+"""
+Холодный старт: импорт агентов, их создание, первый документ с текстовым слоем и (если установлен easyocr)
+загрузка OCR модели. Каждый прогон — в новом интерпретаторе, как на свежем контейнере; печатаются
+перцентили времени, пик RSS и какие тяжелые пакеты к этому моменту уже импортированы.
+
+Запуск из папки srcs:
+    python -m benchmarks.bench_startup --repeat 5
+    python -m benchmarks.bench_startup --with-ocr --json startup.json
+"""
+import argparse
+import glob
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+import fitz
+
+from benchmarks.latency import latency_row, print_rows
+
+SRCS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PDF_DIR = os.path.join(SRCS_DIR, '..', 'pdf')
+HEAVY_MODULES = ("torch", "easyocr", "gigachat", "streamlit")
+
+# Выполняется в отдельном процессе; последней строкой печатает JSON с замерами этапов.
+_CHILD = r'''
+import contextlib, io, json, sys, time
+from utils.tracing import peak_rss_mb
+HEAVY_MODULES, pdf_path, with_ocr = json.loads(sys.argv[1]), sys.argv[2], sys.argv[3] == "1"
+result = {}
+def mark(stage, start):
+    result[stage] = {"s": time.perf_counter() - start, "rss_mb": round(peak_rss_mb(), 1),
+                     "loaded": [name for name in HEAVY_MODULES if name in sys.modules]}
+with contextlib.redirect_stdout(io.StringIO()):
+    start = time.perf_counter()
+    from agents.ingestor_agent import IngestorAgent
+    from agents.scripter_agent import ScripterAgent
+    from agents.artist_agent import create_artist_client
+    import agents.layout_agent, pipeline, jobs
+    mark("import", start)
+    start = time.perf_counter()
+    ingestor, scripter, artist_client = IngestorAgent(use_ocr_cache=False), ScripterAgent(), create_artist_client()
+    mark("agents", start)
+    start = time.perf_counter()
+    ingestor.process_pdf(pdf_path)
+    mark("text_pdf", start)
+    if with_ocr:
+        start = time.perf_counter()
+        ingestor.warm_up(background=False)
+        mark("ocr_model", start)
+    scripter.close()
+print(json.dumps(result))
+'''
+
+
+def text_layer_pdf(pdf_paths: list[str]) -> str | None:
+    """Первый документ, у которого на первой странице есть текстовый слой (OCR ему не нужен)."""
+    for pdf_path in pdf_paths:
+        with fitz.open(pdf_path) as doc:
+            if len(doc) and len(doc[0].get_text("text").strip()) >= 100: return pdf_path
+    return None
+
+
+def run_cold_start(pdf_path: str, with_ocr: bool) -> dict:
+    env = {**os.environ, "FUSION_API_KEY": "", "FUSION_SECRET_KEY": ""}
+    completed = subprocess.run([sys.executable, "-c", _CHILD, json.dumps(HEAVY_MODULES), pdf_path, "1" if with_ocr else "0"],
+                               cwd=SRCS_DIR, env=env, capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк холодного старта агентов.")
+    parser.add_argument("pdf", nargs="?", help="PDF с текстовым слоем (по умолчанию первый такой из pdf/)")
+    parser.add_argument("--repeat", type=int, default=5, help="прогонов, каждый в новом процессе")
+    parser.add_argument("--with-ocr", action="store_true", help="дополнительно замерить загрузку OCR модели")
+    parser.add_argument("--json", help="сохранить результаты в JSON для сравнения между версиями")
+    args = parser.parse_args()
+
+    pdf_path = args.pdf or text_layer_pdf(sorted(glob.glob(os.path.join(PDF_DIR, "*.pdf"))))
+    if not pdf_path: parser.error("Не найден PDF с текстовым слоем.")
+    with_ocr = args.with_ocr and importlib.util.find_spec("easyocr") is not None
+    if args.with_ocr and not with_ocr: print("easyocr не установлен: загрузка OCR модели не замеряется.")
+
+    runs = [run_cold_start(pdf_path, with_ocr) for _ in range(max(1, args.repeat))]
+    stages = list(runs[0])
+    rows = [latency_row(stage, [run[stage]["s"] for run in runs]) for stage in stages]
+    print(f"\nХолодный старт, {len(runs)} прогонов (документ: {os.path.basename(pdf_path)}):")
+    print_rows(rows)
+    print(f"\n{'Этап':28} {'пик RSS, МБ':>12}  импортированы")
+    for stage in stages:
+        last = runs[-1][stage]
+        print(f"{stage:28} {last['rss_mb']:>12}  {', '.join(last['loaded']) or '-'}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"settings": vars(args), "pdf": pdf_path, "stages": rows, "runs": runs}, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты сохранены: {args.json}")
+
+
+if __name__ == '__main__':
+    main()
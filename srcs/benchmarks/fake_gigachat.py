@@ -0,0 +1,191 @@
+# benchmarks/fake_gigachat.py
+"""
+Подмена клиента GigaChat для офлайн-бенчмарков. Тип запроса (темы, фрагмент, кастинг, сценарий) и его поля
+определяются по шаблонам из prompts/, ответ — записанный (JSONL) или синтетический, но того же формата,
+что у настоящей модели, с задержкой из LatencyModel. Агент при этом работает как обычно:
+ScripterAgent._call_giga_chat, ограничение частоты, разбор JSON — свои, подменяется только клиент.
+
+    fake = FakeGigaChat(latency="lognormal:3,0.4")
+    install(scripter, fake)
+
+Запись ответов настоящей модели для последующего воспроизведения: install(scripter, RecordingGigaChat(scripter._get_client(), path)).
+"""
+import itertools
+import json
+import os
+import random
+import re
+import string
+import threading
+from types import SimpleNamespace
+
+from benchmarks.latency import LatencyModel
+
+PROMPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'prompts')
+# Дозапрос недостающего содержит исходный промпт целиком, поэтому его шаблон проверяется первым.
+PROMPT_KINDS = {
+    "missing_parts_prompt.txt": "missing",
+    "theme_extractor_prompt.txt": "themes",
+    "chunk_summary_prompt.txt": "chunk",
+    "global_character_prompt.txt": "characters",
+    "scripter_prompt.txt": "scenario",
+}
+
+
+def _template_pattern(template: str) -> re.Pattern:
+    """Регулярное выражение, совпадающее с заполненным шаблоном; поля шаблона становятся именованными группами."""
+    parts, seen = [], set()
+    for literal, field, _, _ in string.Formatter().parse(template):
+        parts.append(re.escape(literal))
+        if field is None: continue
+        parts.append(f"(?P={field})" if field in seen else f"(?P<{field}>.*?)")
+        seen.add(field)
+    return re.compile("".join(parts), re.DOTALL)
+
+
+def _load_patterns() -> list[tuple[str, re.Pattern]]:
+    patterns = []
+    for filename, kind in PROMPT_KINDS.items():
+        with open(os.path.join(PROMPTS_DIR, filename), 'r', encoding='utf-8') as f:
+            patterns.append((kind, _template_pattern(f.read())))
+    return patterns
+
+
+_PATTERNS = _load_patterns()
+
+
+def classify_prompt(prompt: str) -> tuple[str, dict]:
+    """Тип запроса и значения полей шаблона; для незнакомого промпта — ("unknown", {})."""
+    for kind, pattern in _PATTERNS:
+        match = pattern.fullmatch(prompt)
+        if match: return kind, match.groupdict()
+    return "unknown", {}
+
+
+def _sentences(text: str) -> list[str]:
+    sentences = [s.strip() for s in re.split(r'(?<=[.!?;:])\s+|\n+', text) if len(s.strip()) > 20]
+    return sentences or [text.strip() or "Текст документа."]
+
+
+def _split_evenly(items: list, parts: int) -> list[list]:
+    size = max(1, -(-len(items) // max(1, parts)))
+    return [items[k:k + size] for k in range(0, len(items), size)][:parts]
+
+
+def _title(sentence: str) -> str:
+    return " ".join(sentence.split()[:6]).rstrip(".,;:")
+
+
+CHARACTERS = [
+    {"name": "Вера, инспектор", "description": "Женщина 35 лет, короткие темные волосы, синяя форменная куртка, планшет в руках, взгляд внимательный."},
+    {"name": "Миша, стажер", "description": "Юноша 20 лет, светлые волосы, клетчатая рубашка, рюкзак на плече, любопытный и немного растерянный."},
+]
+
+
+def synthetic_response(kind: str, fields: dict) -> str:
+    """Ответ в формате, который просит соответствующий шаблон (JSON в окружении текста, как у модели)."""
+    if kind == "themes":
+        num_themes = int(re.sub(r"\D", "", fields.get("num_themes", "")) or 3)
+        groups = _split_evenly(_sentences(fields.get("document_text", "")), num_themes)
+        payload = [{"theme_title": _title(group[0]), "theme_summary": " ".join(group)[:1500]} for group in groups]
+        return "Вот выделенные темы:\n" + json.dumps(payload, ensure_ascii=False, indent=2)
+    if kind == "chunk":
+        groups = _split_evenly(_sentences(fields.get("chunk_text", "")), 2)
+        payload = [{"topic_title": _title(group[0]), "topic_summary": " ".join(group)[:800]} for group in groups]
+        return json.dumps(payload, ensure_ascii=False, indent=2)
+    if kind == "characters":
+        return "```json\n" + json.dumps({"main_characters": CHARACTERS}, ensure_ascii=False, indent=2) + "\n```"
+    if kind == "scenario":
+        sentences = _sentences(fields.get("summary_text", ""))
+        scenes = [{
+            "panel": k + 1,
+            "location": "Светлый офис с плакатами на стенах",
+            "characters": ", ".join(c["name"] for c in CHARACTERS),
+            "dialogue": sentences[k % len(sentences)][:300],
+            "image_prompt": "points at a poster on the wall, explains calmly, colleague listens attentively",
+        } for k in range(4)]
+        payload = {"title": _title(sentences[0]),
+                   "story_bible": {"main_location": "Светлый офис с плакатами по технике безопасности", "main_characters": CHARACTERS},
+                   "scenes": scenes}
+        return "Конечно! Вот сценарий страницы:\n" + json.dumps(payload, ensure_ascii=False, indent=2) + "\nНадеюсь, он подойдет."
+    if kind == "missing":
+        # Ответ на исходное задание целиком: агент сам берет из него только недостающее.
+        return synthetic_response(*classify_prompt(fields.get("original_prompt", "")))
+    return "Не удалось понять запрос."
+
+
+def malform(content: str, rng) -> str:
+    """Типичные поломки ответа модели: обрыв по лимиту токенов, висячая запятая, markdown-ограждение."""
+    damage = rng.choice(("truncate", "trailing_comma", "fence"))
+    if damage == "truncate": return content[:int(len(content) * rng.uniform(0.5, 0.9))]
+    if damage == "trailing_comma": return re.sub(r"\}(\s*)\]", r"},\1]", content, count=1)
+    return "```json\n" + content + "\n```"
+
+
+def _response(content: str):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class FakeGigaChat:
+    """
+    Заменитель gigachat.GigaChat с методами chat()/close(). Ответы берутся из записанного JSONL
+    (строки {"kind": ..., "content": ...}, по кругу для каждого типа) или строятся синтетически.
+    Доля malformed ответов (кроме дозапросов) портится функцией malform.
+    """
+    def __init__(self, latency: str | float | LatencyModel = 0.0, responses_path: str | None = None, seed: int | None = 0,
+                 malformed: float = 0.0):
+        self.latency = latency if isinstance(latency, LatencyModel) else LatencyModel(latency, seed=seed)
+        self.malformed = malformed
+        self._rng = random.Random(seed)
+        self._recorded = {}
+        if responses_path:
+            recorded = {}
+            with open(responses_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        item = json.loads(line)
+                        recorded.setdefault(item["kind"], []).append(item["content"])
+            self._recorded = {kind: itertools.cycle(contents) for kind, contents in recorded.items()}
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def chat(self, chat):
+        prompt = chat.messages[-1].content
+        kind, fields = classify_prompt(prompt)
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            recorded = next(self._recorded[kind]) if kind in self._recorded else None
+            damaged = kind != "missing" and self._rng.random() < self.malformed
+        content = recorded if recorded is not None else synthetic_response(kind, fields)
+        if damaged:
+            with self._lock: content = malform(content, self._rng)
+        self.latency.sleep()
+        return _response(content)
+
+    def close(self):
+        pass
+
+
+class RecordingGigaChat:
+    """Обертка над настоящим клиентом: пропускает запросы и дописывает ответы в JSONL для FakeGigaChat."""
+    def __init__(self, client, path: str):
+        self.client = client
+        self.path = path
+        self._lock = threading.Lock()
+
+    def chat(self, chat):
+        response = self.client.chat(chat)
+        kind, _ = classify_prompt(chat.messages[-1].content)
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({"kind": kind, "content": response.choices[0].message.content}, ensure_ascii=False) + "\n")
+        return response
+
+    def close(self):
+        self.client.close()
+
+
+def install(scripter, client):
+    """Подставляет клиента в ScripterAgent вместо настоящего GigaChat (учетные данные не нужны)."""
+    with scripter._client_lock:
+        scripter._client = client
+    return client
@@ -0,0 +1,162 @@
+# benchmarks/kandinsky_stub.py
+"""
+Локальная заглушка Kandinsky API (FusionBrain): /pipelines, /pipeline/run, /pipeline/status/<uuid>.
+Генерация "длится" заданное время, ответы содержат настоящую PNG-картинку в base64.
+
+Самопроверка клиента (из папки srcs):
+    python -m benchmarks.kandinsky_stub --panels 12 --latency 3
+"""
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from PIL import Image
+
+from benchmarks.latency import LatencyModel
+
+API_PREFIX = "/key/api/v1"
+
+
+class StubState:
+    """Настройки и счетчики заглушки, общие для всех обработчиков."""
+    def __init__(self, latency: float = 2.0, jitter: float = 0.0, fail_rate: float = 0.0, max_queue: int = 0, image_size: int = 64,
+                 latency_model: LatencyModel | None = None):
+        self.latency = latency
+        self.jitter = jitter
+        # Если задана модель задержки, она заменяет latency/jitter (например, логнормальный "хвост" очереди).
+        self.latency_model = latency_model
+        self.fail_rate = fail_rate
+        # Если max_queue > 0, при большем числе незавершенных генераций отвечаем 429 (как ограничение API).
+        self.max_queue = max_queue
+        buf = BytesIO()
+        Image.new('RGB', (image_size, image_size), 'skyblue').save(buf, format='PNG')
+        self.image_base64 = base64.b64encode(buf.getvalue()).decode('ascii')
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.counters = {"pipelines": 0, "run": 0, "status": 0, "throttled": 0, "connections": 0}
+
+    def pending(self) -> int:
+        now = time.monotonic()
+        return sum(1 for job in self.jobs.values() if job["ready_at"] > now)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: StubState = None
+
+    def setup(self):
+        super().setup()
+        with self.state.lock: self.state.counters["connections"] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items(): self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self) -> bool:
+        if self.headers.get("X-Key", "").startswith("Key ") and self.headers.get("X-Secret", "").startswith("Secret "):
+            return True
+        self._send_json({"error": "unauthorized"}, status=401)
+        return False
+
+    def do_GET(self):
+        if not self._authorized(): return
+        state = self.state
+        if self.path == f"{API_PREFIX}/pipelines":
+            with state.lock: state.counters["pipelines"] += 1
+            self._send_json([{"id": "stub-pipeline", "name": "Kandinsky Split 3.0", "status": "ACTIVE"}])
+        elif self.path.startswith(f"{API_PREFIX}/pipeline/status/"):
+            job_id = self.path.rsplit("/", 1)[-1]
+            with state.lock:
+                state.counters["status"] += 1
+                job = state.jobs.get(job_id)
+            if job is None:
+                self._send_json({"error": "not found"}, status=404)
+            elif job["ready_at"] > time.monotonic():
+                self._send_json({"uuid": job_id, "status": "PROCESSING"})
+            elif job["fail"]:
+                self._send_json({"uuid": job_id, "status": "FAIL", "errorDescription": "stub failure"})
+            else:
+                self._send_json({"uuid": job_id, "status": "DONE", "result": {"files": [state.image_base64], "censored": False}})
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self._authorized(): return
+        state = self.state
+        if self.path != f"{API_PREFIX}/pipeline/run":
+            self._send_json({"error": "not found"}, status=404); return
+        with state.lock:
+            if state.max_queue and state.pending() >= state.max_queue:
+                state.counters["throttled"] += 1
+                throttled = True
+            else:
+                throttled = False
+                state.counters["run"] += 1
+                job_id = str(uuid.uuid4())
+                if state.latency_model is not None: latency = state.latency_model.sample()
+                else: latency = max(0.0, random.gauss(state.latency, state.jitter)) if state.jitter else state.latency
+                state.jobs[job_id] = {"ready_at": time.monotonic() + latency, "fail": random.random() < state.fail_rate}
+        if throttled:
+            self._send_json({"error": "too many requests"}, status=429, headers={"Retry-After": "1"})
+        else:
+            self._send_json({"uuid": job_id, "status": "INITIAL"}, status=201)
+
+
+def start_stub_server(port: int = 0, **state_kwargs) -> tuple[ThreadingHTTPServer, str]:
+    """Запускает заглушку в фоновом потоке. Возвращает сервер и базовый URL для KandinskyAPI(url=...)."""
+    handler = type("ConfiguredStubHandler", (StubHandler,), {"state": StubState(**state_kwargs)})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}{API_PREFIX}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Kandinsky API и самопроверка клиента.")
+    parser.add_argument("--panels", type=int, default=12)
+    parser.add_argument("--latency", type=float, default=3.0)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--serve", action="store_true", help="только запустить заглушку и ждать запросов")
+    parser.add_argument("--port", type=int, default=0)
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(args.port, latency=args.latency, max_queue=args.concurrency)
+    print(f"Заглушка Kandinsky API: {base_url}")
+    try:
+        if args.serve:
+            # Сервер уже обслуживает запросы в фоновом потоке: ждем Ctrl+C.
+            threading.Event().wait()
+            return
+
+        from agents.artist_agent import KandinskyAPI, collect_panel_images
+        client = KandinskyAPI("stub", "stub", url=base_url, max_concurrency=args.concurrency)
+        start = time.perf_counter()
+        images = collect_panel_images([client.submit(f"panel {i}") for i in range(args.panels)])
+        elapsed = time.perf_counter() - start
+        client.close()
+        serial = args.panels * args.latency
+        print(f"{len(images)} кадров за {elapsed:.1f} с (последовательно было бы >= {serial:.0f} с). Счетчики: {server.RequestHandlerClass.state.counters}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# benchmarks/latency.py
+"""Распределения задержек для заглушек внешних API и перцентили для отчетов бенчмарков."""
+import random
+import time
+
+DISTRIBUTIONS = ("fixed", "normal", "lognormal", "uniform")
+
+
+class LatencyModel:
+    """
+    Задержка в секундах по строке-описанию:
+        "2" или "fixed:2"          — всегда 2 с;
+        "normal:2,0.5"             — нормальное (среднее, ст. отклонение), не меньше 0;
+        "lognormal:2,0.5"          — логнормальное (медиана, сигма логарифма) — длинный "хвост", как у очередей API;
+        "uniform:1,3"              — равномерное на отрезке.
+    """
+    def __init__(self, spec: str | float = 0.0, seed: int | None = None):
+        self.spec = str(spec)
+        kind, _, params = self.spec.partition(":") if ":" in self.spec else ("fixed", "", self.spec)
+        if kind not in DISTRIBUTIONS: raise ValueError(f"Неизвестное распределение задержки: {self.spec}")
+        self.kind = kind
+        self.params = [float(value) for value in params.split(",") if value.strip()]
+        self._rng = random.Random(seed)
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            return self.params[0] if self.params else 0.0
+        if self.kind == "normal":
+            return max(0.0, self._rng.gauss(self.params[0], self.params[1]))
+        if self.kind == "lognormal":
+            return self.params[0] * self._rng.lognormvariate(0.0, self.params[1])
+        return self._rng.uniform(self.params[0], self.params[1])
+
+    def sleep(self):
+        delay = self.sample()
+        if delay > 0: time.sleep(delay)
+
+    def __repr__(self):
+        return f"LatencyModel({self.spec!r})"
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """Перцентиль по отсортированному списку (ближайший ранг)."""
+    if not sorted_values: return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values) + 0.5) - 1))]
+
+
+def latency_row(stage: str, durations: list[float], items: int | None = None) -> dict:
+    """Строка отчета: число замеров, пропускная способность (элементов/с) и перцентили задержки в мс."""
+    values = sorted(durations)
+    total = sum(values)
+    items = len(values) if items is None else items
+    return {
+        "stage": stage,
+        "count": len(values),
+        "items": items,
+        "throughput_per_s": round(items / total, 2) if total else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p90_ms": round(percentile(values, 90) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2) if values else 0.0,
+    }
+
+
+def print_rows(rows: list[dict]):
+    print(f"{'Этап':28} {'замеров':>8} {'эл./с':>10} {'p50, мс':>10} {'p90, мс':>10} {'p99, мс':>10} {'макс, мс':>10}")
+    for row in rows:
+        print(f"{row['stage']:28} {row['count']:>8} {row['throughput_per_s']:>10} {row['p50_ms']:>10} "
+              f"{row['p90_ms']:>10} {row['p99_ms']:>10} {row['max_ms']:>10}")
@@ -0,0 +1,236 @@
+# srcs/jobs.py
+import contextlib
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from pipeline import RUNS_DIR, ComicRun, encode_png, stream_comic_pages
+from utils import tracing
+from utils.memory_budget import MemoryBudget
+
+
+class BackgroundJob:
+    """
+    Общее у фоновых задач JobRunner: job_id, этап и статус для UI, отмена, время завершения и последнего обращения
+    (по нему JobRunner забывает задачу). Работа — в _run(ingestor, scripter, artist_client).
+    """
+    def __init__(self, draft: bool = False, trace: bool = False):
+        self.job_id = uuid.uuid4().hex
+        # Черновик: кадры рисует локальный бэкенд (JobRunner.draft_client).
+        self.draft = draft
+        self.status = "queued"
+        self.stage = "В очереди..."
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.last_seen = self.created_at
+        # Замеры этапов этой задачи (tracing.summary(job_id)), независимо от трассировки остальных.
+        self.trace = trace
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+    def cancel(self):
+        self._cancel.set()
+
+    def remove_run(self):
+        """Вызывается, когда JobRunner забывает задачу; задачи со своими артефактами на диске удаляют их здесь."""
+
+    def _set(self, **fields):
+        with self._lock:
+            for name, value in fields.items(): setattr(self, name, value)
+
+    def run(self, ingestor, scripter, artist_client):
+        with tracing.trace(self.job_id) if self.trace else contextlib.nullcontext():
+            self._run(ingestor, scripter, artist_client)
+
+    def _run(self, ingestor, scripter, artist_client):
+        raise NotImplementedError
+
+
+class ComicJob(BackgroundJob):
+    """
+    Генерация комикса в фоне: чтение PDF, сценарии, кадры, верстка. Состояние (этап, готовые страницы в PNG,
+    ошибка) читается из UI через snapshot(), поэтому перезапуски скрипта Streamlit не прерывают работу.
+    Промежуточные результаты сохраняются в ComicRun (run_id), чтобы потом перерисовать отдельную страницу или кадр.
+    Страницы в pages ссылаются на PNG на диске ("path"); байты ("png") держатся в памяти в пределах memory — общего
+    для всех задач сессии лимита на PNG готовых страниц (MemoryBudget), а после release() отпускаются совсем.
+    """
+    def __init__(self, pdf_path: str, style: str, audience: str, max_pages: int, use_consistent_characters: bool = False,
+                 remove_pdf: bool = True, draft: bool = False, memory: MemoryBudget | None = None,
+                 trace: bool = False):
+        super().__init__(draft=draft, trace=trace)
+        self.pdf_path = pdf_path
+        self.style = style
+        self.audience = audience
+        self.max_pages = max_pages
+        self.use_consistent_characters = use_consistent_characters
+        self.remove_pdf = remove_pdf
+        self.pages = []
+        self.first_page_s = None
+        self.run_id = None
+        self.run_dir = None
+        self._released = False
+        self.memory = memory or MemoryBudget()
+
+    def release(self):
+        """Задачу сменила новая: PNG ее страниц отпускаются из лимита сессии, а запуск удаляется с диска (по завершении задачи)."""
+        self.cancel()
+        with self._lock:
+            self._released = True
+            self.pages = [{**page, "png": None} for page in self.pages]
+            self.memory.fit([], owner=self.job_id)
+            finished = self.finished_at is not None
+        if finished: self.remove_run()
+
+    def remove_run(self):
+        """Удаляет артефакты запуска (ComicRun) с диска: после этого страницы задачи не перерисовать."""
+        if self.run_dir: shutil.rmtree(self.run_dir, ignore_errors=True)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"job_id": self.job_id, "run_id": self.run_id, "status": self.status, "stage": self.stage, "pages": list(self.pages),
+                    "error": self.error, "max_pages": self.max_pages, "first_page_s": self.first_page_s, "memory": self.memory.stats()}
+
+    def _run(self, ingestor, scripter, artist_client):
+        start = time.perf_counter()
+        try:
+            if self._cancel.is_set(): return self._set(status="cancelled", stage="Отменено.")
+            run = ComicRun.create({"style": self.style, "audience": self.audience, "max_pages": self.max_pages,
+                                   "use_consistent_characters": self.use_consistent_characters, "draft": self.draft})
+            self._set(status="running", run_id=run.run_id, run_dir=run.store.root, stage="Шаг 1/2: Читаю и распознаю документ...")
+            document_text = ingestor.process_pdf(self.pdf_path)
+            if self.remove_pdf and os.path.exists(self.pdf_path): os.remove(self.pdf_path)
+            run.save_text(document_text)
+
+            self._set(stage="Шаг 2/2: Пишу сценарии по темам и рисую страницы по мере готовности...")
+            artifacts = {}
+            pages = stream_comic_pages(scripter, artist_client, document_text, self.style, self.audience,
+                                       self.max_pages, self.use_consistent_characters, artifacts=artifacts, cancel=self._cancel)
+            try:
+                for page in pages:
+                    if self._cancel.is_set(): break
+                    png = encode_png(page["image"])
+                    info = run.save_page(page["scenario"], page["panels"], png, page["failed_panels"], page["draft_panels"])
+                    # Кадры и сверстанная страница уже на диске: отпускаем их, пока рисуется следующая.
+                    page.clear()
+                    ready = {**info, "path": run.store.path(info["file"]), "png": png}
+                    with self._lock:
+                        self.pages = sorted(self.pages + [ready], key=lambda p: p["page_number"])
+                        self.memory.fit(sorted(self.pages, key=lambda p: p is ready), owner=self.job_id)
+                        if self.first_page_s is None: self.first_page_s = time.perf_counter() - start
+            finally:
+                pages.close()
+                run.save_analysis(artifacts)
+
+            if self._cancel.is_set(): self._set(status="cancelled", stage="Отменено.")
+            elif not self.pages: self._set(status="failed", error="Не удалось сгенерировать ни одного сценария.")
+            else: self._set(status="done", stage=f"Готово страниц комикса: {len(self.pages)}!")
+        except Exception as e:
+            print(f"ОШИБКА фоновой задачи {self.job_id}: {e}")
+            self._set(status="failed", error=str(e))
+        finally:
+            if self.remove_pdf and os.path.exists(self.pdf_path): os.remove(self.pdf_path)
+            with self._lock:
+                self.finished_at = time.time()
+                released = self._released
+            if released: self.remove_run()
+
+
+class RegenerateJob(BackgroundJob):
+    """
+    Перерисовка одной страницы готового запуска в фоне, чтобы UI не ждал GigaChat и Kandinsky в обработчике кнопки.
+    action: "panels" — кадры scene_indices (по умолчанию все), "rewrite" — новый сценарий страницы и все кадры,
+    "finalize" — черновые кадры рисует удаленный бэкенд. Результат — описание страницы (ComicRun.page_info) в info.
+    """
+    ACTIONS = ("panels", "rewrite", "finalize")
+
+    def __init__(self, run_id: str, page_number: int, action: str = "panels", scene_indices: list[int] | None = None,
+                 draft: bool = False):
+        if action not in self.ACTIONS: raise ValueError(f"Неизвестное действие: {action}")
+        super().__init__(draft=draft and action != "finalize")
+        self.run_id = run_id
+        self.page_number = page_number
+        self.action = action
+        self.scene_indices = scene_indices
+        self.info = None
+
+    def _run(self, ingestor, scripter, artist_client):
+        try:
+            if self._cancel.is_set(): return self._set(status="cancelled", stage="Отменено.")
+            self._set(status="running", stage=f"Перерисовываю страницу {self.page_number}...")
+            run = ComicRun.open(self.run_id)
+            if self.action == "finalize": info = run.finalize_page(artist_client, self.page_number)
+            elif self.action == "rewrite": info = run.rewrite_page(scripter, artist_client, self.page_number)
+            else: info = run.regenerate_panels(artist_client, self.page_number, self.scene_indices)
+            self._set(status="done", stage=f"Страница {self.page_number} перерисована.",
+                      info={**info, "path": run.store.path(info["file"]), "png": None})
+        except Exception as e:
+            print(f"ОШИБКА перерисовки {self.job_id}: {e}")
+            self._set(status="failed", error=str(e))
+        finally:
+            self._set(finished_at=time.time())
+
+
+class JobRunner:
+    """
+    Пул фоновых задач, общий для всех сессий: не больше max_jobs генераций одновременно,
+    остальные ждут в очереди. Задачи ищутся по job_id; завершенные, к которым ttl секунд не обращались,
+    забываются вместе с папками их запусков. При старте удаляются запуски в RUNS_DIR старше ttl — от прежних процессов.
+    Задачи-черновики (job.draft) рисуют кадры локальным draft_client.
+    """
+    def __init__(self, ingestor, scripter, artist_client, max_jobs: int = 2, ttl: float = 3600, draft_client=None):
+        self.ingestor = ingestor
+        self.scripter = scripter
+        self.artist_client = artist_client
+        self.draft_client = draft_client
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_jobs), thread_name_prefix="comic-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.runs_dir = RUNS_DIR
+        sweep_runs(self.runs_dir, ttl)
+
+    def _purge_expired(self):
+        now = time.time()
+        expired = [old for old in self._jobs.values() if old.finished_at and now - max(old.finished_at, old.last_seen) > self.ttl]
+        for old in expired:
+            del self._jobs[old.job_id]
+            tracing.discard(old.job_id)
+            old.remove_run()
+
+    def submit(self, job: BackgroundJob) -> str:
+        with self._lock:
+            self._purge_expired()
+            self._jobs[job.job_id] = job
+        artist_client = self.draft_client if job.draft and self.draft_client else self.artist_client
+        self._executor.submit(job.run, self.ingestor, self.scripter, artist_client)
+        return job.job_id
+
+    def get(self, job_id: str | None) -> BackgroundJob | None:
+        """Задача по job_id; обращение продлевает срок ее хранения."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None: job.last_seen = time.time()
+            return job
+
+
+def sweep_runs(runs_dir: str, max_age: float) -> int:
+    """Удаляет папки запусков, которые не менялись дольше max_age секунд; возвращает их число."""
+    if not os.path.isdir(runs_dir): return 0
+    now, removed = time.time(), 0
+    for name in os.listdir(runs_dir):
+        root = os.path.join(runs_dir, name)
+        try:
+            if not os.path.isdir(root) or now - os.path.getmtime(root) <= max_age: continue
+        except OSError:
+            continue
+        shutil.rmtree(root, ignore_errors=True)
+        removed += 1
+    return removed
@@ -0,0 +1,299 @@
+# srcs/pipeline.py
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import wait
+from io import BytesIO
+
+from PIL import Image
+
+from agents.artist_agent import STYLE_KEYWORDS, submit_panel_images, collect_panel_images
+from agents.layout_agent import create_comic_page, create_comic_pages
+from utils import tracing
+from utils.run_store import RunStore
+
+RUNS_DIR = os.getenv("COMICS_RUNS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runs'))
+
+_SCRIPTS_DONE = object()
+
+
+def page_filename(page_number: int, style: str) -> str:
+    return f"comic_page_{page_number}_{style.replace(' ', '_')}.png"
+
+
+def encode_png(image: Image.Image) -> bytes:
+    """PNG-байты страницы; кодируется один раз, дальше UI и диск используют готовые байты."""
+    buf = BytesIO()
+    image.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _produce_scripts(scripter, artist_client, script_queue: queue.Queue, stopped, document_text, style, *args, **kwargs):
+    """
+    Поток-сценарист: как только сценарий готов, ставит все его кадры в пул генерации
+    и кладет в очередь (сценарий, futures кадров); по окончании — маркер _SCRIPTS_DONE.
+    После остановки (stopped()) новые кадры не ставятся, а уже поставленные отменяются.
+    """
+    style_keywords = STYLE_KEYWORDS.get(style, "comic book style")
+    scripts = scripter.iter_themed_scripts(document_text, style, *args, **kwargs)
+    try:
+        for scenario in scripts:
+            if stopped(): return
+            panel_futures = submit_panel_images(artist_client, scenario, style_keywords)
+            script_queue.put((scenario, panel_futures))
+            # Потребитель мог остановиться и разобрать очередь, пока кадры ставились: отменяем их сами.
+            if stopped():
+                _cancel_futures(panel_futures)
+                return
+    except Exception as e:
+        script_queue.put(e)
+    finally:
+        scripts.close()
+        script_queue.put(_SCRIPTS_DONE)
+
+
+def _cancel_futures(futures):
+    for future in futures: future.cancel()
+
+
+def _drain(script_queue: queue.Queue):
+    """Отменяет кадры сценариев, которые остались в очереди."""
+    while True:
+        try: item = script_queue.get_nowait()
+        except queue.Empty: return
+        if isinstance(item, tuple): _cancel_futures(item[1])
+
+
+def _wait_panels(panel_futures, stopped, poll: float = 0.2) -> bool:
+    """Ждет кадры страницы, проверяя остановку; False — остановлено раньше, чем кадры готовы."""
+    pending = set(panel_futures)
+    while pending:
+        if stopped(): return False
+        _, pending = wait(pending, timeout=poll)
+    return True
+
+
+def stream_comic_pages(scripter, artist_client, document_text: str, style: str, audience: str, max_pages: int,
+                       use_consistent_characters: bool = False, artifacts: dict | None = None, skip_pages=(), on_analysis=None,
+                       cancel: threading.Event | None = None):
+    """
+    Потоковый конвейер "сценарий -> кадры -> верстка". Сценарии пишутся в фоновом потоке, кадры каждого
+    сразу ставятся в общий пул генерации, так что кадры разных страниц рисуются одновременно,
+    а первая страница появляется, не дожидаясь остальных.
+    Генератор отдает словари: page_number, title, scenario, image, panels, failed_panels, draft_panels (кадры локального
+    бэкенда-черновика), filename, elapsed (секунды от старта).
+    В artifacts (если передан) сценарист записывает темы и общих персонажей, on_analysis получает их сразу после анализа;
+    skip_pages и готовые темы в artifacts — для продолжения прерванного запуска (см. ScripterAgent.iter_themed_scripts).
+    cancel — событие отмены извне: генератор завершается, не дожидаясь кадров текущей страницы. При отмене и при закрытии
+    генератора кадры, которые еще не начали рисоваться, снимаются с пула.
+    """
+    start = time.perf_counter()
+    script_queue = queue.Queue()
+    stop = threading.Event()
+    stopped = lambda: stop.is_set() or (cancel is not None and cancel.is_set())
+    producer = threading.Thread(
+        target=tracing.in_context(_produce_scripts),
+        args=(scripter, artist_client, script_queue, stopped, document_text, style, audience, max_pages, use_consistent_characters),
+        kwargs={"artifacts": artifacts, "skip_pages": skip_pages, "on_analysis": on_analysis},
+        daemon=True,
+    )
+    producer.start()
+    first_page_reported = False
+    draft = bool(getattr(artist_client, "draft", False))
+    panel_futures = []
+    try:
+        while not stopped():
+            try: item = script_queue.get(timeout=0.2)
+            except queue.Empty: continue
+            if item is _SCRIPTS_DONE: break
+            if isinstance(item, Exception): raise item
+
+            scenario, panel_futures = item
+            if not _wait_panels(panel_futures, stopped): break
+            failed_panels = []
+            panels = collect_panel_images(panel_futures, failed=failed_panels)
+            page_image = create_comic_page(scenario, panels, style)
+            elapsed = time.perf_counter() - start
+            if not first_page_reported:
+                print(f"Первая страница готова через {elapsed:.1f} с.")
+                first_page_reported = True
+            yield {
+                "page_number": scenario["page_number"],
+                "title": scenario.get("title", ""),
+                "scenario": scenario,
+                "image": page_image,
+                "panels": panels,
+                "failed_panels": failed_panels,
+                "draft_panels": [k for k in range(len(panels)) if k not in failed_panels] if draft else [],
+                "filename": page_filename(scenario["page_number"], style),
+                "elapsed": elapsed,
+            }
+            # Пока ждем кадры следующей страницы, изображения этой держит только потребитель.
+            del item, panels, page_image
+            panel_futures = []
+    finally:
+        stop.set()
+        _cancel_futures(panel_futures)
+        _drain(script_queue)
+
+
+class ComicRun:
+    """
+    Артефакты одного запуска на диске: текст документа, темы, общие персонажи, сценарии, кадры и страницы.
+    По ним можно перерисовать один кадр или одну страницу, не повторяя OCR и остальные запросы к API.
+
+        text.txt, themes.json, characters.json, run.json (настройки)
+        scenarios/page_<N>.json, panels/page_<N>_panel_<K>.png, pages/comic_page_<N>_<стиль>.png
+    """
+    def __init__(self, root: str, settings: dict | None = None):
+        self.store = RunStore(root)
+        self.run_id = os.path.basename(os.path.normpath(root))
+        if settings is not None: self.store.write_json("run.json", settings)
+        self.settings = self.store.read_json("run.json") or {}
+
+    @classmethod
+    def create(cls, settings: dict, runs_dir: str | None = None) -> "ComicRun":
+        run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        return cls(os.path.join(runs_dir or RUNS_DIR, run_id), settings)
+
+    @classmethod
+    def open(cls, run_id: str, runs_dir: str | None = None) -> "ComicRun":
+        root = os.path.join(runs_dir or RUNS_DIR, run_id)
+        if not os.path.isdir(root): raise FileNotFoundError(f"Запуск {run_id} не найден")
+        return cls(root)
+
+    @property
+    def style(self) -> str:
+        return self.settings.get("style", "")
+
+    def save_text(self, document_text: str):
+        self.store.write_text("text.txt", document_text)
+
+    def save_analysis(self, artifacts: dict):
+        """Темы и общие персонажи из ScripterAgent.iter_themed_scripts(..., artifacts=...)."""
+        if "themes" in artifacts: self.store.write_json("themes.json", artifacts["themes"])
+        if "global_characters" in artifacts: self.store.write_json("characters.json", artifacts["global_characters"])
+
+    def _scenario_name(self, page_number: int) -> str:
+        return os.path.join("scenarios", f"page_{page_number}.json")
+
+    def _panel_name(self, page_number: int, scene_index: int) -> str:
+        return os.path.join("panels", f"page_{page_number}_panel_{scene_index + 1}.png")
+
+    def page_name(self, page_number: int) -> str:
+        return os.path.join("pages", page_filename(page_number, self.style))
+
+    def save_page(self, scenario: dict, panels: list[Image.Image], page_png: bytes, failed_panels: list[int] = (),
+                  draft_panels: list[int] = ()) -> dict:
+        """Сохраняет сценарий, кадры и сверстанную страницу; возвращает описание страницы."""
+        page_number = scenario["page_number"]
+        for k, panel in enumerate(panels): self.store.save_image(self._panel_name(page_number, k), panel)
+        self.store.write_bytes(self.page_name(page_number), page_png)
+        self.store.write_json(self._scenario_name(page_number),
+                              {**scenario, "failed_panels": list(failed_panels), "draft_panels": list(draft_panels)})
+        return self.page_info(page_number)
+
+    def save_panels(self, scenario: dict, panels: list[Image.Image], failed_panels: list[int] = (), draft_panels: list[int] = ()):
+        """
+        Сохраняет сценарий и кадры без верстки; прежняя страница удаляется, чтобы устаревшая версия
+        не считалась готовой, пока compose_pages не сверстает новую.
+        """
+        page_number = scenario["page_number"]
+        self.store.remove(self.page_name(page_number))
+        for k, panel in enumerate(panels): self.store.save_image(self._panel_name(page_number, k), panel)
+        self.store.write_json(self._scenario_name(page_number),
+                              {**scenario, "failed_panels": list(failed_panels), "draft_panels": list(draft_panels)})
+
+    def has_panels(self, page_number: int) -> bool:
+        """Все кадры сценария страницы уже на диске: страницу можно сверстать без генерации."""
+        count = len(self.load_scenario(page_number).get("scenes", []))
+        return count > 0 and all(self.store.exists(self._panel_name(page_number, k)) for k in range(count))
+
+    def compose_pages(self, page_numbers: list[int], workers: int | None = None) -> list[dict]:
+        """
+        Верстает страницы из сохраненных кадров в пуле процессов (create_comic_pages): процессы получают
+        пути файлов кадров и сами пишут страницы на диск. Возвращает описания страниц.
+        """
+        jobs = []
+        for page_number in page_numbers:
+            scenario = self.load_scenario(page_number)
+            panel_paths = [self.store.path(self._panel_name(page_number, k)) for k in range(len(scenario.get("scenes", [])))]
+            jobs.append((scenario, panel_paths, self.style, self.store.path(self.page_name(page_number))))
+        create_comic_pages(jobs, workers=workers)
+        return [self.page_info(page_number) for page_number in page_numbers]
+
+    def has_page(self, page_number: int) -> bool:
+        return self.store.exists(self._scenario_name(page_number)) and self.store.exists(self.page_name(page_number))
+
+    def load_scenario(self, page_number: int) -> dict:
+        scenario = self.store.read_json(self._scenario_name(page_number))
+        if scenario is None: raise FileNotFoundError(f"Нет сценария страницы {page_number} в запуске {self.run_id}")
+        return scenario
+
+    def load_panels(self, page_number: int, count: int) -> list[Image.Image]:
+        """Кадры страницы с диска; недостающие заменяются серой заглушкой."""
+        panels = []
+        for k in range(count):
+            panel = self.store.load_image(self._panel_name(page_number, k))
+            panels.append(panel if panel is not None else Image.new('RGB', (1024, 1024), 'grey'))
+        return panels
+
+    def page_numbers(self) -> list[int]:
+        if not self.store.exists("scenarios"): return []
+        names = os.listdir(self.store.path("scenarios"))
+        return sorted(int(name[len("page_"):-len(".json")]) for name in names if name.startswith("page_") and name.endswith(".json"))
+
+    def page_info(self, page_number: int) -> dict:
+        scenario = self.load_scenario(page_number)
+        return {"page_number": page_number, "title": scenario.get("title", ""), "filename": page_filename(page_number, self.style),
+                "file": self.page_name(page_number), "panels": len(scenario.get("scenes", [])),
+                "failed_panels": scenario.get("failed_panels", []), "draft_panels": scenario.get("draft_panels", []), "run_id": self.run_id}
+
+    def page_png(self, page_number: int) -> bytes | None:
+        return self.store.read_bytes(self.page_name(page_number))
+
+    def regenerate_panels(self, artist_client, page_number: int, scene_indices: list[int] | None = None, compose: bool = True) -> dict:
+        """
+        Перерисовывает выбранные кадры страницы (по умолчанию все) в обход кэша изображений,
+        остальные берет с диска, и заново верстает только эту страницу. Кадры, нарисованные
+        локальным бэкендом (artist_client.draft), отмечаются как черновые. С compose=False страница
+        не верстается: ее вместе с другими потом сверстает compose_pages.
+        """
+        scenario = self.load_scenario(page_number)
+        count = len(scenario["scenes"])
+        scene_indices = list(range(count)) if scene_indices is None else sorted(set(scene_indices))
+        panels = self.load_panels(page_number, count)
+        style_keywords = STYLE_KEYWORDS.get(self.style, "comic book style")
+        failed = []
+        new_panels = collect_panel_images(submit_panel_images(artist_client, scenario, style_keywords, scene_indices, use_cache=False), failed=failed)
+        for scene_index, panel in zip(scene_indices, new_panels): panels[scene_index] = panel
+        failed_panels = sorted((set(scenario.get("failed_panels", [])) - set(scene_indices)) | {scene_indices[k] for k in failed})
+        redrawn = set(scene_indices) - set(failed_panels)
+        draft_panels = sorted((set(scenario.get("draft_panels", [])) - set(scene_indices)) | (redrawn if getattr(artist_client, "draft", False) else set()))
+        print(f"Страница {page_number}: перерисовано кадров {len(scene_indices)}, с ошибкой {len(failed)}.")
+        if not compose:
+            self.save_panels(scenario, panels, failed_panels, draft_panels)
+            return self.page_info(page_number)
+        return self.save_page(scenario, panels, encode_png(create_comic_page(scenario, panels, self.style)), failed_panels, draft_panels)
+
+    def finalize_page(self, artist_client, page_number: int, compose: bool = True) -> dict:
+        """Финальный проход: перерисовывает удаленным бэкендом только черновые кадры страницы."""
+        draft_panels = self.load_scenario(page_number).get("draft_panels", [])
+        if not draft_panels: return self.page_info(page_number)
+        return self.regenerate_panels(artist_client, page_number, draft_panels, compose=compose)
+
+    def rewrite_page(self, scripter, artist_client, page_number: int) -> dict:
+        """Новый сценарий страницы по сохраненной теме (и общим персонажам) и новые кадры для него."""
+        themes = self.store.read_json("themes.json") or []
+        if not 0 < page_number <= len(themes): raise ValueError(f"Нет темы для страницы {page_number}")
+        scenario = scripter.create_page_script(themes[page_number - 1], page_number, self.style, self.settings.get("audience", ""),
+                                               self.store.read_json("characters.json"))
+        if scenario is None: raise RuntimeError(f"Не удалось написать новый сценарий для страницы {page_number}")
+        # Кадры и страница прежнего сценария к новому не подходят: если перерисовка прервется, их нельзя верстать.
+        self.store.remove(self.page_name(page_number))
+        for k in range(len((self.store.read_json(self._scenario_name(page_number)) or {}).get("scenes", []))):
+            self.store.remove(self._panel_name(page_number, k))
+        self.store.write_json(self._scenario_name(page_number), scenario)
+        return self.regenerate_panels(artist_client, page_number)
@@ -0,0 +1,6 @@
+# tests/conftest.py
+import os
+import sys
+
+# Модули импортируются так же, как в приложении и бенчмарках: из папки srcs.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
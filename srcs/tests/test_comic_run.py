@@ -0,0 +1,31 @@
+# tests/test_comic_run.py
+from PIL import Image
+
+from pipeline import ComicRun
+
+
+def make_scenario(page_number, panels=2):
+    return {"page_number": page_number, "title": f"Страница {page_number}",
+            "scenes": [{"image_prompt": "кадр", "dialogue": "Реплика"} for _ in range(panels)]}
+
+
+def test_save_panels_then_compose_pages(tmp_path):
+    run = ComicRun(str(tmp_path / "run"), settings={"style": "Манга"})
+    for page_number in (1, 2):
+        run.save_panels(make_scenario(page_number), [Image.new('RGB', (64, 64), 'red')] * 2, draft_panels=[0, 1])
+        assert run.has_panels(page_number) and not run.has_page(page_number)
+
+    infos = run.compose_pages([1, 2], workers=1)
+    assert [info["page_number"] for info in infos] == [1, 2]
+    assert all(run.has_page(n) for n in (1, 2))
+    assert infos[0]["draft_panels"] == [0, 1]
+    with Image.open(run.store.path(infos[0]["file"])) as page:
+        assert page.size == (850, 1100)
+
+
+def test_save_panels_drops_stale_page(tmp_path):
+    run = ComicRun(str(tmp_path / "run"), settings={"style": "Манга"})
+    run.save_page(make_scenario(1), [Image.new('RGB', (64, 64))] * 2, b"old page")
+    assert run.has_page(1)
+    run.save_panels(make_scenario(1, panels=3), [Image.new('RGB', (64, 64))] * 2)
+    assert not run.has_page(1) and not run.has_panels(1)
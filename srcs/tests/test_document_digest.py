@@ -0,0 +1,48 @@
+# tests/test_document_digest.py
+import pytest
+
+from agents import scripter_agent
+from agents.scripter_agent import ScripterAgent
+from utils import cache
+from utils.text_chunks import estimate_tokens
+
+
+@pytest.fixture
+def scripter(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(cache, "_caches", {})
+    agent = ScripterAgent(map_reduce_threshold_tokens=300, chunk_tokens=200)
+    yield agent
+    agent.close()
+
+
+def make_document(paragraphs=40):
+    return "\n".join(f"Пункт {n}. Гражданин вправе подать обращение лично, по почте или через сайт ведомства." for n in range(paragraphs))
+
+
+def test_digest_is_reduced_until_it_fits(scripter, monkeypatch):
+    calls = []
+
+    def summarize(chunk_text):
+        calls.append(chunk_text)
+        return [{"topic_title": "Тема", "topic_summary": chunk_text[:len(chunk_text) // 3]}]
+
+    monkeypatch.setattr(scripter, "_summarize_chunk", summarize)
+    document = make_document()
+    digest = scripter._build_document_digest(document)
+    map_calls = len(scripter_agent.split_into_chunks(document, max_tokens=200))
+    assert len(calls) > map_calls
+    assert estimate_tokens(digest) <= 300
+
+
+def test_reduce_stops_when_digest_does_not_shrink(scripter, monkeypatch):
+    calls = []
+
+    def echo(chunk_text):
+        calls.append(chunk_text)
+        return [{"topic_title": "", "topic_summary": chunk_text}]
+
+    monkeypatch.setattr(scripter, "_summarize_chunk", echo)
+    digest = scripter._build_document_digest(make_document())
+    assert estimate_tokens(digest) > 300
+    assert len(calls) < 2 * len(scripter_agent.split_into_chunks(make_document(), max_tokens=200)) + 2
@@ -0,0 +1,66 @@
+# tests/test_json_repair.py
+from utils.json_repair import check_fields, parse_json
+
+
+def test_plain_object():
+    assert parse_json('{"a": 1}') == {"a": 1}
+
+
+def test_fenced_json_with_prose_around():
+    text = 'Вот сценарий:\n```json\n{"title": "Т", "scenes": []}\n```\nНадеюсь, подойдет!'
+    assert parse_json(text) == {"title": "Т", "scenes": []}
+
+
+def test_fence_without_language_and_closing():
+    assert parse_json('```\n[{"t": 1}]', list) == [{"t": 1}]
+
+
+def test_trailing_commas():
+    repairs = []
+    assert parse_json('{"a": [1, 2,], "b": {"c": 3,},}', dict, repairs) == {"a": [1, 2], "b": {"c": 3}}
+    assert repairs == ["trailing_comma"]
+
+
+def test_comma_inside_string_is_kept():
+    assert parse_json('{"a": "1, ]", "b": [1,]}') == {"a": "1, ]", "b": [1]}
+
+
+def test_newline_inside_string():
+    assert parse_json('{"dialogue": "Первая строка\nвторая"}') == {"dialogue": "Первая строка\nвторая"}
+
+
+def test_truncated_inside_string_keeps_complete_items():
+    repairs = []
+    text = '[{"theme_title": "Один"}, {"theme_title": "Два"}, {"theme_title": "Тр'
+    assert parse_json(text, list, repairs) == [{"theme_title": "Один"}, {"theme_title": "Два"}]
+    assert repairs == ["truncated"]
+
+
+def test_truncated_inside_nested_object():
+    repairs = []
+    text = '{"scenes": [{"panel": 1}, {"panel": 2, "extra": {"x": 1'
+    assert parse_json(text, dict, repairs) == {"scenes": [{"panel": 1}, {"panel": 2}]}
+    assert "truncated" in repairs
+
+
+def test_stray_brackets_in_prose():
+    text = 'Темы (см. [1] и {пример}) такие: [{"t": 1}, {"t": 2}]. Конец [2].'
+    assert parse_json(text, list) == [{"t": 1}, {"t": 2}]
+
+
+def test_expected_type_is_respected():
+    assert parse_json('[1, 2] и затем {"a": 1}', dict) == {"a": 1}
+    assert parse_json('{"a": [1, 2]}', list) == [1, 2]
+
+
+def test_no_json():
+    assert parse_json("") is None
+    assert parse_json("Извините, не могу ответить.") is None
+    assert parse_json("{не json}", dict) is None
+
+
+def test_check_fields():
+    schema = {"name": str, "tags": list, "age": (int, float), "meta": dict}
+    assert check_fields({"name": "A", "tags": ["x"], "age": 3, "meta": {"k": 1}}, schema) == []
+    assert check_fields({"name": "", "tags": [], "age": "3"}, schema) == ["name", "tags", "age", "meta"]
+    assert check_fields(["not", "a", "dict"], schema) == list(schema)
@@ -0,0 +1,34 @@
+# tests/test_memory_budget.py
+from utils.memory_budget import MB, MemoryBudget
+
+
+def make_pages(count, size_mb=1):
+    return [{"page_number": n, "path": f"page_{n}.png", "png": b"x" * int(size_mb * MB)} for n in range(1, count + 1)]
+
+
+def test_owners_add_up_and_oldest_owner_spills_first():
+    budget = MemoryBudget(limit_mb=3)
+    first, second = make_pages(2), make_pages(2)
+    budget.fit(first, owner="a")
+    assert budget.stats()["held_mb"] == 2
+    budget.fit(second, owner="b")
+    assert budget.stats()["held_mb"] == 3
+    assert [bool(page["png"]) for page in first + second] == [False, True, True, True]
+
+
+def test_release_frees_owner_share():
+    budget = MemoryBudget()
+    budget.fit(make_pages(2), owner="a")
+    budget.fit(make_pages(1), owner="b")
+    assert budget.stats()["held_mb"] == 3
+    budget.fit([], owner="a")
+    stats = budget.stats()
+    assert (stats["held_mb"], stats["peak_mb"], stats["spilled_pages"]) == (1, 3, 0)
+
+
+def test_page_without_path_stays_in_memory():
+    budget = MemoryBudget(limit_mb=1)
+    pages = make_pages(2)
+    pages[0]["path"] = None
+    budget.fit(pages, owner="a")
+    assert [bool(page["png"]) for page in pages] == [True, False]
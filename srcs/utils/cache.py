@@ -0,0 +1,95 @@
+# utils/cache.py
+import os
+import sqlite3
+import threading
+import time
+import hashlib
+
+CACHE_DIR = os.getenv("COMICS_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache'))
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def content_hash(*parts) -> str:
+    """SHA-256 от последовательности строк/байтов (с длинами, чтобы ('ab', 'c') != ('a', 'bc'))."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str): part = part.encode('utf-8')
+        elif not isinstance(part, (bytes, bytearray)): part = repr(part).encode('utf-8')
+        digest.update(len(part).to_bytes(8, 'little'))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class DiskLRUCache:
+    """
+    Персистентный кэш ключ -> bytes в SQLite с LRU-вытеснением по суммарному размеру
+    и счетчиками попаданий/промахов. Потокобезопасен; между процессами синхронизируется самим SQLite.
+    """
+    def __init__(self, path: str, max_bytes: int = 256 * 2**20):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _bump(self, name: str):
+        self._conn.execute("INSERT INTO counters (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._bump("misses")
+                return None
+            self._conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._bump("hits")
+            return row[0]
+
+    def put(self, key: str, value: bytes):
+        if len(value) > self.max_bytes: return
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)", (key, value, len(value), time.time()))
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total <= self.max_bytes: return
+            for old_key, size in self._conn.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall():
+                if total <= self.max_bytes: break
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (old_key,))
+                total -= size
+
+    def get_text(self, key: str) -> str | None:
+        value = self.get(key)
+        return value.decode('utf-8') if value is not None else None
+
+    def put_text(self, key: str, text: str):
+        self.put(key, text.encode('utf-8'))
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            counters = dict(self._conn.execute("SELECT name, value FROM counters").fetchall())
+        hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+        return {"entries": entries, "bytes": total, "max_bytes": self.max_bytes, "hits": hits, "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_cache(name: str, default_max_mb: int) -> DiskLRUCache:
+    """
+    Общий на процесс кэш с именем name (файл CACHE_DIR/<name>.sqlite).
+    Лимит размера переопределяется переменной окружения <NAME>_CACHE_MAX_MB.
+    """
+    with _caches_lock:
+        if name not in _caches:
+            max_mb = int(os.getenv(f"{name.upper()}_CACHE_MAX_MB", default_max_mb))
+            _caches[name] = DiskLRUCache(os.path.join(CACHE_DIR, f"{name}.sqlite"), max_bytes=max_mb * 2**20)
+        return _caches[name]
@@ -0,0 +1,126 @@
+# utils/json_repair.py
+"""
+Терпимый разбор JSON из ответов LLM: markdown-ограждения, текст до и после JSON, висячие запятые,
+переводы строк внутри строк и оборванный по лимиту токенов ответ (из него сохраняются все законченные
+элементы). Плюс простая проверка схемы, чтобы отличать годные элементы от испорченных.
+"""
+import json
+import re
+
+FENCE_RE = re.compile(r"```(?:json|JSON)?\s*(.*?)(?:```|$)", re.DOTALL)
+_CLOSERS = {"{": "}", "[": "]"}
+# Сколько открывающих скобок нужного вида пробовать как начало JSON (остальные — скобки в тексте вокруг).
+MAX_CANDIDATES = 5
+
+
+def _strip_trailing_commas(text: str) -> str:
+    """Удаляет запятые перед } и ] вне строк."""
+    out, in_string, escape = [], False, False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escape: escape = False
+            elif ch == "\\": escape = True
+            elif ch == '"': in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == ",":
+            rest = text[i + 1:].lstrip()
+            if rest[:1] in ("}", "]"): continue
+        out.append(ch)
+    return "".join(out)
+
+
+def _balance(text: str) -> tuple[str, bool]:
+    """
+    Обрезает text по концу первого законченного значения. Если значение оборвано, отрезает незаконченный
+    хвост до последнего целого элемента и закрывает открытые скобки. Возвращает (текст, был ли обрыв).
+    """
+    stack, in_string, escape, last_cut = [], False, False, None
+    for i, ch in enumerate(text):
+        if in_string:
+            if escape: escape = False
+            elif ch == "\\": escape = True
+            elif ch == '"': in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in _CLOSERS:
+            stack.append(_CLOSERS[ch])
+        elif ch in "}]":
+            if not stack or stack[-1] != ch: break
+            stack.pop()
+            if not stack: return text[:i + 1], False
+            last_cut = (i + 1, list(stack))
+        elif ch == "," and stack:
+            last_cut = (i, list(stack))
+    if last_cut is None: return text, True
+    end, stack = last_cut
+    return text[:end] + "".join(reversed(stack)), True
+
+
+def _loads(text: str):
+    return json.loads(text, strict=False)
+
+
+def _parse_from(text: str, start: int, repairs: list | None):
+    """
+    Разбирает значение, начинающееся с позиции start: (значение, позиция конца) или None, если не удалось
+    даже после починки. У оборванного ответа конец — конец текста.
+    """
+    try:
+        return json.JSONDecoder(strict=False).raw_decode(text, start)
+    except json.JSONDecodeError:
+        pass
+    balanced, truncated = _balance(text[start:])
+    end = len(text) if truncated else start + len(balanced)
+    for candidate, fixes in ((balanced, []), (_strip_trailing_commas(balanced), ["trailing_comma"])):
+        try:
+            value = _loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        if repairs is not None: repairs.extend(fixes + (["truncated"] if truncated else []))
+        return value, end
+    return None
+
+
+def parse_json(text: str, expect: type = dict, repairs: list | None = None):
+    """
+    Достает из ответа модели JSON-значение типа expect (dict или list); None, если его нет.
+    Сначала пробуется содержимое markdown-ограждения, затем весь текст. Из нескольких разобранных значений
+    (скобки в тексте вокруг, например "[1]") берется самое длинное. В repairs (если передан) добавляется,
+    что пришлось исправить в самом JSON: "trailing_comma", "truncated" (ответ оборван, хвост отброшен).
+    """
+    if not text: return None
+    opener = "{" if expect is dict else "["
+    fenced = FENCE_RE.search(text)
+    for source in ([fenced.group(1)] if fenced else []) + [text]:
+        best = None
+        start = source.find(opener)
+        for _ in range(MAX_CANDIDATES):
+            if start == -1: break
+            found = []
+            parsed = _parse_from(source, start, found)
+            if parsed is not None and isinstance(parsed[0], expect):
+                value, end = parsed
+                if best is None or end - start > best[0]: best = (end - start, value, found)
+                # Скобки внутри разобранного значения — его часть, а не новые кандидаты.
+                start = source.find(opener, end)
+            else:
+                start = source.find(opener, start + 1)
+        if best is not None:
+            if repairs is not None: repairs.extend(best[2])
+            return best[1]
+    return None
+
+
+def check_fields(item, schema: dict) -> list[str]:
+    """
+    Поля схемы {имя: тип или кортеж типов}, которых в item нет, которые пусты или другого типа.
+    Для не-словаря возвращаются все поля схемы.
+    """
+    if not isinstance(item, dict): return list(schema)
+    missing = []
+    for name, types in schema.items():
+        value = item.get(name)
+        if not isinstance(value, types) or (isinstance(value, (str, list, dict)) and not value): missing.append(name)
+    return missing
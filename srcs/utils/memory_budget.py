@@ -0,0 +1,62 @@
+# utils/memory_budget.py
+import threading
+
+from utils import tracing
+
+MB = 1024 * 1024
+
+
+class MemoryBudget:
+    """
+    Лимит сессии на PNG готовых страниц в памяти. Страница — словарь с "path" (PNG на диске) и, пока укладывается
+    в лимит, "png" (байты в памяти). Учитываются только эти байты, суммарно по всем владельцам (задачам сессии);
+    кадры и страница, которые еще рисуются и верстаются, в лимит не входят. Сверх лимита байты самых старых страниц
+    (сначала у давних владельцев) отпускаются: UI читает их с диска. limit_mb <= 0 — без лимита, только учет.
+    stats() — метрики для UI и отчетов.
+    """
+    def __init__(self, limit_mb: float = 0):
+        self.limit = int(limit_mb * MB)
+        self.held = 0
+        self.peak = 0
+        self.spilled_pages = 0
+        self.spilled_bytes = 0
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def fit(self, pages: list[dict], owner: str = ""):
+        """
+        Запоминает страницы владельца (по порядку списка — от старых к новым; пустой список — владелец больше
+        ничего не держит) и оставляет в памяти PNG самых новых страниц, пока их общий объем укладывается в лимит.
+        """
+        with self._lock:
+            self._pages.pop(owner, None)
+            if pages: self._pages[owner] = list(pages)
+            everything = [page for owned in self._pages.values() for page in owned]
+            held = sum(len(page["png"]) for page in everything if page.get("png"))
+            self.peak = max(self.peak, held)
+            if self.limit > 0:
+                for page in everything:
+                    if held <= self.limit: break
+                    if not page.get("png") or not page.get("path"): continue
+                    size = len(page["png"])
+                    page["png"] = None
+                    held -= size
+                    self.spilled_pages += 1
+                    self.spilled_bytes += size
+                    tracing.record("memory.spill", 0.0, bytes=size, page=page.get("page_number"))
+            self.held = held
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"held_mb": round(self.held / MB, 1), "peak_mb": round(self.peak / MB, 1),
+                    "limit_mb": round(self.limit / MB, 1), "spilled_pages": self.spilled_pages,
+                    "spilled_mb": round(self.spilled_bytes / MB, 1)}
+
+
+def page_bytes(page: dict) -> bytes | None:
+    """PNG страницы: из памяти, если он там остался, иначе с диска."""
+    if page.get("png"): return page["png"]
+    try:
+        with open(page["path"], 'rb') as f: return f.read()
+    except (KeyError, OSError):
+        return None
@@ -0,0 +1,27 @@
+# utils/rate_limit.py
+import threading
+import time
+
+
+class RateLimiter:
+    """Потокобезопасный ограничитель частоты запросов (token bucket): не больше rate запросов в секунду с запасом burst."""
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Блокирует вызывающий поток, пока не освободится токен."""
+        if self.rate <= 0: return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,73 @@
+# utils/run_store.py
+import json
+import os
+import shutil
+
+from PIL import Image
+
+
+class RunStore:
+    """
+    Папка с артефактами одного прогона (текст, сценарии, страницы). Все записи атомарны
+    (через временный файл и os.replace), поэтому после падения в папке нет "половинчатых" файлов.
+    """
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self.path(name))
+
+    def _atomic_write(self, name: str, write):
+        target = self.path(name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_path = f"{target}.tmp"
+        write(tmp_path)
+        os.replace(tmp_path, target)
+        return target
+
+    def write_bytes(self, name: str, data: bytes) -> str:
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f: f.write(data)
+        return self._atomic_write(name, write)
+
+    def read_bytes(self, name: str) -> bytes | None:
+        try:
+            with open(self.path(name), 'rb') as f: return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write_text(self, name: str, text: str) -> str:
+        return self.write_bytes(name, text.encode('utf-8'))
+
+    def read_text(self, name: str) -> str | None:
+        data = self.read_bytes(name)
+        return None if data is None else data.decode('utf-8')
+
+    def write_json(self, name: str, payload) -> str:
+        return self.write_text(name, json.dumps(payload, ensure_ascii=False, indent=2))
+
+    def read_json(self, name: str):
+        text = self.read_text(name)
+        if text is None: return None
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            return None
+
+    def save_image(self, name: str, image: Image.Image, format: str = "PNG") -> str:
+        return self._atomic_write(name, lambda tmp_path: image.save(tmp_path, format=format))
+
+    def load_image(self, name: str) -> Image.Image | None:
+        if not self.exists(name): return None
+        with Image.open(self.path(name)) as image:
+            image.load()
+            return image
+
+    def remove(self, name: str):
+        target = self.path(name)
+        if os.path.isdir(target): shutil.rmtree(target, ignore_errors=True)
+        elif os.path.exists(target): os.remove(target)
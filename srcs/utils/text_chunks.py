@@ -0,0 +1,69 @@
+# utils/text_chunks.py
+import re
+
+PAGE_BREAK = "--- Page Break ---"
+# Так IngestorAgent помечает заголовки, найденные по оформлению (кегль, полужирный) в текстовом слое PDF.
+HEADING_MARK = "## "
+HEADING_RE = re.compile(r"^\s*((?i:глава|раздел|часть|статья|приложение)\b|[IVXLC]+\.\s|\d+(\.\d+)*\.?\s+[А-ЯЁA-Z])")
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов: для русского текста ~3 символа на токен (с запасом)."""
+    return len(text) // 3 + 1
+
+
+def strip_heading_marks(text: str) -> str:
+    """Убирает HEADING_MARK в начале строк: разметка нужна для нарезки, а не для промптов."""
+    return "\n".join(line.removeprefix(HEADING_MARK) for line in text.split("\n"))
+
+
+def is_heading(line: str) -> bool:
+    """Строка с HEADING_MARK или короткая строка с нумерацией/ключевым словом раздела, или набранная капсом."""
+    if line.startswith(HEADING_MARK): return True
+    line = line.strip()
+    if not line or len(line) > 100: return False
+    if HEADING_RE.match(line): return True
+    letters = [c for c in line if c.isalpha()]
+    return len(letters) >= 4 and all(c.isupper() for c in letters)
+
+
+def _split_oversized(text: str, max_tokens: int) -> list[str]:
+    """Режет слишком длинный раздел по строкам (а строку длиннее бюджета — по символам)."""
+    pieces, current = [], []
+    for line in text.split("\n"):
+        while estimate_tokens(line) > max_tokens:
+            if current: pieces.append("\n".join(current)); current = []
+            pieces.append(line[:max_tokens * 3]); line = line[max_tokens * 3:]
+        if current and estimate_tokens("\n".join(current + [line])) > max_tokens:
+            pieces.append("\n".join(current)); current = []
+        current.append(line)
+    if current: pieces.append("\n".join(current))
+    return pieces
+
+
+def split_into_chunks(document_text: str, max_tokens: int = 3000) -> list[str]:
+    """
+    Делит документ на куски не длиннее max_tokens. Границы кусков по возможности проходят
+    по заголовкам разделов, затем по разрывам страниц (PAGE_BREAK), затем по строкам.
+    """
+    # Разделы: (текст, начинается ли с заголовка). Разрыв страницы тоже закрывает раздел.
+    sections, current, starts_with_heading = [], [], False
+    for line in document_text.split("\n"):
+        if line.strip() == PAGE_BREAK or is_heading(line):
+            if any(l.strip() for l in current): sections.append(("\n".join(current).strip(), starts_with_heading))
+            current, starts_with_heading = [], line.strip() != PAGE_BREAK
+            if not starts_with_heading: continue
+        current.append(line)
+    if any(l.strip() for l in current): sections.append(("\n".join(current).strip(), starts_with_heading))
+
+    chunks, chunk = [], ""
+    for text, heading in sections:
+        for piece in (_split_oversized(text, max_tokens) if estimate_tokens(text) > max_tokens else [text]):
+            candidate = f"{chunk}\n{piece}" if chunk else piece
+            # Новый раздел начинает новый кусок, если текущий уже заполнен хотя бы наполовину.
+            if chunk and (estimate_tokens(candidate) > max_tokens or (heading and estimate_tokens(chunk) >= max_tokens // 2)):
+                chunks.append(chunk); candidate = piece
+            chunk = candidate
+            heading = False
+    if chunk: chunks.append(chunk)
+    return chunks
@@ -0,0 +1,220 @@
+# utils/tracing.py
+"""
+Легкие замеры этапов конвейера: span'ы с длительностью, байтами, числом повторов и пиком RSS.
+
+    with tracing.span("layout.page", bytes=n): ...
+    @tracing.traced("gigachat.call")
+    tracing.current_span().add(retries=1)
+
+Включается для всего процесса переменной окружения COMICS_TRACE=1 или tracing.enable(), либо только для
+одной задачи блоком `with tracing.trace(job_id)`: span'ы внутри него (и в пулах ContextThreadPool, куда
+он ставит работу) помечаются trace_id, и сводку можно построить по одной задаче. В выключенном состоянии
+span() возвращает общий пустой объект, так что цена замера — один вызов функции.
+Экспорт — JSONL или формат Chrome trace (chrome://tracing, Perfetto).
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+MAX_SPANS = 100_000
+
+_enabled = os.getenv("COMICS_TRACE", "") not in ("", "0")
+_spans = deque(maxlen=MAX_SPANS)
+_spans_lock = threading.Lock()
+_local = threading.local()
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+_origin = time.perf_counter()
+
+
+def peak_rss_mb() -> float:
+    """Пиковый RSS процесса в МБ (ru_maxrss в Linux — в КБ); без модуля resource — 0."""
+    if resource is None: return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def enable(on: bool = True):
+    global _enabled
+    _enabled = on
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def _active() -> bool:
+    return _enabled or _trace_id.get() is not None
+
+
+@contextlib.contextmanager
+def trace(trace_id: str):
+    """Собирает span'ы блока с меткой trace_id, даже если трассировка процесса выключена."""
+    token = _trace_id.set(trace_id)
+    try:
+        yield
+    finally:
+        _trace_id.reset(token)
+
+
+def in_context(func):
+    """func, которая выполнится в копии текущего контекста (с его trace_id) — для threading.Thread(target=...)."""
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+class ContextThreadPool(ThreadPoolExecutor):
+    """ThreadPoolExecutor, задачи которого видят trace_id того, кто их поставил (сами contextvars в потоки не переходят)."""
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+class _NoopSpan:
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+    def add(self, **counters): pass
+    def set(self, **attrs): pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    __slots__ = ("name", "attrs", "start", "duration", "thread", "trace_id")
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.start = 0.0
+        self.duration = 0.0
+        self.thread = threading.current_thread().name
+        self.trace_id = _trace_id.get()
+
+    def add(self, **counters):
+        """Увеличивает счетчики span'а (bytes, retries, ...)."""
+        for key, value in counters.items(): self.attrs[key] = self.attrs.get(key, 0) + value
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None: stack = _local.stack = []
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        _local.stack.pop()
+        if exc_type is not None: self.attrs["error"] = exc_type.__name__
+        self.attrs["peak_rss_mb"] = round(peak_rss_mb(), 1)
+        with _spans_lock: _spans.append(self)
+        return False
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "start_s": round(self.start - _origin, 6), "duration_ms": round(self.duration * 1000, 3),
+                "thread": self.thread, **({"trace_id": self.trace_id} if self.trace_id else {}), **self.attrs}
+
+
+def span(name: str, **attrs):
+    """Контекстный менеджер замера; при выключенной трассировке — пустой объект."""
+    if not _active(): return NOOP_SPAN
+    return Span(name, attrs)
+
+
+def current_span():
+    """Открытый span текущего потока (или пустой), чтобы дописать в него байты и повторы из глубины вызовов."""
+    stack = getattr(_local, "stack", None) if _active() else None
+    return stack[-1] if stack else NOOP_SPAN
+
+
+def record(name: str, duration: float, **attrs):
+    """Добавляет уже измеренный интервал (например, из процесса-воркера), заканчивающийся сейчас."""
+    if not _active(): return
+    item = Span(name, attrs)
+    item.duration = duration
+    item.start = time.perf_counter() - duration
+    with _spans_lock: _spans.append(item)
+
+
+def traced(name: str):
+    """Декоратор: оборачивает каждый вызов функции в span с указанным именем."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _active(): return func(*args, **kwargs)
+            with Span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def reset():
+    with _spans_lock: _spans.clear()
+
+
+def discard(trace_id: str):
+    """Удаляет span'ы одной задачи (когда ее результаты больше не нужны)."""
+    with _spans_lock:
+        kept = [item for item in _spans if item.trace_id != trace_id]
+        _spans.clear(); _spans.extend(kept)
+
+
+def spans(trace_id: str | None = None) -> list[Span]:
+    """Все span'ы или только помеченные trace_id."""
+    with _spans_lock: items = list(_spans)
+    return items if trace_id is None else [item for item in items if item.trace_id == trace_id]
+
+
+def summary(trace_id: str | None = None) -> list[dict]:
+    """Сводка по именам span'ов: число вызовов, суммарное время, перцентили, байты, повторы, пик RSS."""
+    groups = {}
+    for item in spans(trace_id): groups.setdefault(item.name, []).append(item)
+    rows = []
+    for name, items in groups.items():
+        durations = sorted(item.duration * 1000 for item in items)
+        rows.append({
+            "stage": name,
+            "count": len(items),
+            "total_s": round(sum(durations) / 1000, 2),
+            "p50_ms": round(durations[len(durations) // 2], 1),
+            "p95_ms": round(durations[min(len(durations) - 1, int(len(durations) * 0.95))], 1),
+            "max_ms": round(durations[-1], 1),
+            "bytes": sum(item.attrs.get("bytes", 0) for item in items),
+            "retries": sum(item.attrs.get("retries", 0) for item in items),
+            "peak_rss_mb": max(item.attrs.get("peak_rss_mb", 0) for item in items),
+        })
+    return sorted(rows, key=lambda row: row["total_s"], reverse=True)
+
+
+def chrome_trace(trace_id: str | None = None) -> dict:
+    """Span'ы в формате Chrome trace (события "X", время в микросекундах)."""
+    thread_ids = {}
+    events = []
+    for item in spans(trace_id):
+        tid = thread_ids.setdefault(item.thread, len(thread_ids) + 1)
+        events.append({"name": item.name, "ph": "X", "pid": os.getpid(), "tid": tid,
+                       "ts": round((item.start - _origin) * 1e6), "dur": round(item.duration * 1e6), "args": item.attrs})
+    events.extend({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": thread}}
+                  for thread, tid in thread_ids.items())
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def export(path: str) -> str:
+    """Сохраняет span'ы: *.jsonl — по строке на span, иначе — Chrome trace JSON."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        if path.endswith(".jsonl"):
+            for item in spans(): f.write(json.dumps(item.to_dict(), ensure_ascii=False) + "\n")
+        else:
+            json.dump(chrome_trace(), f, ensure_ascii=False)
+    return path